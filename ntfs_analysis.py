@@ -1,36 +1,231 @@
+import argparse
+import datetime
+import glob
+import ipaddress
 import subprocess
 import os
-import hashlib
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
 from tabulate import tabulate
+from ntfs_arguments import (
+    add_analyze_arguments,
+    analyze_arguments_error,
+    add_import_arguments,
+    add_file_selection_arguments,
+    file_selection_error,
+    add_packet_filter_arguments,
+)
 from ntfs_capture import execute_tcpdump, import_pcap_file
-from ntfs_data import insert_pcap_analysis, get_case_details_by_id
+from ntfs_data import (
+    insert_pcap_analyses,
+    update_pcap_analyses,
+    get_case_details_by_id,
+    get_pcap_files_for_case,
+    get_known_file_hashes,
+    get_cached_pcap_analysis,
+    get_analysis_talkers,
+    get_analysis_half_open,
+    get_analysis_verdicts,
+    get_analysis_checkpoint,
+    get_checkpoint_state,
+    iter_case_source_sketches,
+    get_analyses_for_ip,
+    register_column_stores,
+)
+from ntfs_columns import build_column_store, column_store_info
+from ntfs_hash import calculate_prefix_hash
+from ntfs_engine import analyze_single_pass, TOP_IPS_LIMIT, ANALYZER_VERSION, COUNTER_NAMES
+from ntfs_store import calculate_evidence_hashes, is_store_pcap, store_pcap_files, verify_pcap_files
+from ntfs_index import (
+    query_packet_index,
+    open_packet_index,
+    filter_packet_index,
+    iter_indexed_records,
+    read_indexed_columns,
+    PROTOCOL_NUMBERS,
+)
+from ntfs_pcap import capture_compression, open_capture, is_plain_pcap
+from ntfs_reader import format_address
+from ntfs_series import DEFAULT_BUCKET_SECONDS, SERIES_PACKETS, series_from_blob, series_windows
+from ntfs_hll import distinct_from_blob, distinct_summary, merged_distinct_summary, classify_sources
 # from pcap_analysis_utils import count_total_packets, top_traffic_ips, count_packets, calculate_syn_ack_ratio, calculate_proportionality_ratio
 
+CACHED_ANALYSIS_KEYS = ['id', 'CaseName', 'total_packets', 'tcp_count', 'udp_count', 'http_count',
+                        'syn_count', 'syn_ack_count', 'ack_count', 'syn_without_ack_count', 'syn_ack_ratio',
+                        'syn_ack_feedback', 'proportionality_message', 'file_hash', 'series_bucket', 'series',
+                        'flow_count', 'half_open_count', 'distinct']
+
+# Window lengths, in seconds, the ratio checks also run over
+CHECK_WINDOWS = (1, 10, 60)
+FLAGGED_WINDOWS_LIMIT = 10
+
+# Packets shown by one `ntfs -d` page
+DISPLAY_PAGE_PACKETS = 50
+PROTOCOL_NAMES = {number: name for name, number in PROTOCOL_NUMBERS.items()}
+# TCP flags in the order tcpdump prints them
+TCP_FLAG_LETTERS = ((0x01, 'F'), (0x02, 'S'), (0x04, 'R'), (0x08, 'P'), (0x10, '.'), (0x20, 'U'), (0x40, 'E'),
+                    (0x80, 'W'))
+
+def is_command(command, flag):
+    # The flag alone or followed by arguments, not a longer flag starting with it
+    return command == flag or command.startswith(flag + " ")
+
 def handle_command(command, connection, case_id):
+    command = command.strip()
     if command.startswith("ntfs "):
-        if command.startswith("ntfs -i "):
-            file_location = command.split()[2]
-            import_pcap_file(file_location, connection, case_id)
-        elif command.startswith("ntfs -c "):
+        if is_command(command, "ntfs -i"):
+            args = parse_import_command(command)
+            if args:
+                for file_location in args.files:
+                    import_pcap_file(file_location, connection, case_id, compress=args.compress)
+        elif is_command(command, "ntfs -c"):
             execute_tcpdump(command, connection, case_id)
-        elif command.startswith("ntfs -a "):
-            filename = command.split()[2]
-            analyze_pcap_file(filename, connection, case_id)
-        elif command.startswith("ntfs -d "):
-            filename = command.split()[2]
-            display_pcap_file(filename)
+        elif is_command(command, "ntfs -m"):
+            from ntfs_rotation import execute_capture_jobs
+            execute_capture_jobs(command, connection, case_id)
+        elif is_command(command, "ntfs -a"):
+            args = parse_analyze_command(command)
+            if args:
+                pcap_filenames = resolve_pcap_filenames(args, connection, case_id)
+                if len(pcap_filenames) == 1 and not args.all:
+                    analyze_pcap_file(pcap_filenames[0], connection, case_id, workers=args.workers,
+                                      use_cache=not args.force, bucket_seconds=args.bucket, dump=args.dump,
+                                      columns=args.columns, incremental=args.incremental)
+                elif pcap_filenames:
+                    analyze_pcap_files(pcap_filenames, connection, case_id, jobs=args.jobs, workers=args.workers,
+                                       use_cache=not args.force, bucket_seconds=args.bucket, columns=args.columns,
+                                       incremental=args.incremental)
+                else:
+                    print("No pcap files to analyze.")
+        elif is_command(command, "ntfs -s"):
+            args = parse_search_command(command)
+            if args:
+                search_ip(args.ip, connection, case_id)
+        elif is_command(command, "ntfs -d"):
+            args = parse_display_command(command)
+            if args:
+                filters = {key: getattr(args, key) for key in ('src', 'dst', 'host', 'port', 'proto', 'start', 'end')}
+                display_pcap_file(args.filename, offset=args.offset, limit=args.limit, filters=filters,
+                                  use_tcpdump=args.tcpdump)
+        elif is_command(command, "ntfs -z"):
+            args = parse_store_command(command)
+            if args:
+                store_pcap_files(connection, case_id, resolve_pcap_filenames(args, connection, case_id))
+        elif is_command(command, "ntfs -v"):
+            verify_pcap_files(connection, case_id)
         else:
             print("Invalid command. Commands must start with 'ntfs'.")
     else:
         print("Invalid command. Commands must start with 'ntfs'.")
 
+def parse_import_command(command):
+    parser = argparse.ArgumentParser(prog="ntfs -i", description="Import pcap files into the case")
+    add_import_arguments(parser)
+    try:
+        return parser.parse_args(command.split()[2:])
+    except SystemExit:
+        return None
+
+def parse_search_command(command):
+    parser = argparse.ArgumentParser(prog="ntfs -s", description="Analyses of the case in which an IP is a talker")
+    parser.add_argument("ip", help="IP address")
+    try:
+        return parser.parse_args(command.split()[2:])
+    except SystemExit:
+        return None
+
+def parse_analyze_command(command):
+    parser = argparse.ArgumentParser(prog="ntfs -a", description="Analyze pcap files of the case")
+    add_analyze_arguments(parser)
+    parser.add_argument("--dump", action="store_true",
+                        help="Print every packet with tcpdump before analyzing a single file")
+    try:
+        args = parser.parse_args(command.split()[2:])
+    except SystemExit:
+        return None
+    error = analyze_arguments_error(args)
+    if error:
+        print(error)
+        return None
+    return args
+
+def parse_display_command(command):
+    parser = argparse.ArgumentParser(prog="ntfs -d", description="Show the packets of a pcap file a page at a time")
+    parser.add_argument("filename", help="Pcap file name in the outputs folder")
+    add_packet_filter_arguments(parser, DISPLAY_PAGE_PACKETS)
+    parser.add_argument("--tcpdump", action="store_true", help="Decode the page with tcpdump")
+    try:
+        args = parser.parse_args(command.split()[2:])
+    except SystemExit:
+        return None
+    if args.offset < 0 or args.limit < 1:
+        print("The offset cannot be negative and the limit must be at least 1.")
+        return None
+    return args
+
+def parse_store_command(command):
+    parser = argparse.ArgumentParser(prog="ntfs -z", description="Move pcap files of the case into the compressed "
+                                                                 "evidence store")
+    add_file_selection_arguments(parser, "Store")
+    try:
+        args = parser.parse_args(command.split()[2:])
+    except SystemExit:
+        return None
+    error = file_selection_error(args)
+    if error:
+        print(error)
+        return None
+    return args
+
+def resolve_pcap_filenames(args, connection, case_id):
+    if args.all:
+        case_details = get_case_details_by_id(connection, case_id)
+        if not case_details:
+            return []
+        pcap_files = get_pcap_files_for_case(connection, case_details[0])
+        # Segments deleted by a capture ring are not on disk anymore
+        return list(dict.fromkeys(os.path.basename(file_path) for file_path, _, status in pcap_files
+                                  if status != 'expired'))
+
+    pcap_filenames = []
+    for pattern in args.filenames:
+        if any(char in pattern for char in "*?["):
+            matches = sorted(os.path.basename(path) for path in glob.glob(os.path.join('outputs', pattern)))
+            if not matches:
+                print(f"No files match {pattern}")
+            pcap_filenames.extend(matches)
+        else:
+            pcap_filenames.append(pattern)
+    return list(dict.fromkeys(pcap_filenames))
+
+def search_ip(ip, connection, case_id):
+    # Analyses of the case in which the IP is one of the stored talkers
+    try:
+        ip = str(ipaddress.ip_address(ip))
+    except ValueError:
+        print(f"Invalid IP address: {ip}")
+        return
+    case_details = get_case_details_by_id(connection, case_id)
+    if not case_details:
+        print("Case details not found")
+        return
+
+    rows = get_analyses_for_ip(connection, ip, case_details[0])
+    if not rows:
+        print(f"{ip} is not among the talkers of any analysis of this case.")
+        return
+    headers = ['Analysis', 'Pcap File', 'Analysis Date', 'Direction', 'Packets', 'Bytes']
+    print(tabulate([[row[0]] + list(row[2:]) for row in rows], headers=headers, tablefmt='grid'))
+
 def calculate_file_hash(file_path):
+    file_hashes = calculate_all_file_hashes(file_path)
+    return file_hashes['md5'] if file_hashes else None
+
+def calculate_all_file_hashes(file_path, prefix=None):
     try:
-        hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        # Files in the compressed evidence store hash as their original content
+        return calculate_evidence_hashes(file_path, prefix)
     except Exception as e:
         print(f"Error calculating hash for file {file_path}: {e}")
         return None
@@ -38,21 +233,21 @@ def calculate_file_hash(file_path):
 
 def count_total_packets(pcap_file):
     try:
-        command = ['tcpdump', '-r', pcap_file, '-n']
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        count_process = subprocess.Popen(['wc', '-l'], stdin=process.stdout, stdout=subprocess.PIPE)
-        output, _ = count_process.communicate()
-        return int(output.decode('utf-8').strip())
+        return len(open_packet_index(pcap_file)['ts'])
     except Exception as e:
         print("An error occurred:", e)
         return None
 
 def count_packets(pcap_file, protocol):
+    # Protocols the packet index knows are always counted from it, built on
+    # first use, so VLAN-tagged packets count as they do in the analysis
+    # counters; other tcpdump filters are left to tcpdump
     try:
         if protocol == 'http':
-            command = ['tcpdump', '-r', pcap_file, '-n', 'tcp', 'port', '80']
-        else:
-            command = ['tcpdump', '-r', pcap_file, '-n', protocol]
+            return len(query_packet_index(open_packet_index(pcap_file), proto='tcp', port=80))
+        if protocol in PROTOCOL_NUMBERS:
+            return len(query_packet_index(open_packet_index(pcap_file), proto=protocol))
+        command = ['tcpdump', '-r', pcap_file, '-n', protocol]
         process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
         count_process = subprocess.Popen(['wc', '-l'], stdin=process.stdout, stdout=subprocess.PIPE)
         output, _ = count_process.communicate()
@@ -61,28 +256,15 @@ def count_packets(pcap_file, protocol):
         print("An error occurred:", e)
         return None
 
-def top_traffic_ips(pcap_file):
+def top_traffic_ips(pcap_file, limit=TOP_IPS_LIMIT):
     try:
-        command = ['tcpdump', '-r', pcap_file, '-n']
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-        awk_process = subprocess.Popen(['awk', '{print $3}'], stdin=process.stdout, stdout=subprocess.PIPE)
-        sort_process = subprocess.Popen(['sort'], stdin=awk_process.stdout, stdout=subprocess.PIPE)
-        uniq_process = subprocess.Popen(['uniq', '-c'], stdin=sort_process.stdout, stdout=subprocess.PIPE)
-        sort_count_process = subprocess.Popen(['sort', '-nr'], stdin=uniq_process.stdout, stdout=subprocess.PIPE)
-        top_five_process = subprocess.Popen(['head', '-n', '5'], stdin=sort_count_process.stdout, stdout=subprocess.PIPE)
-        output, _ = top_five_process.communicate()
-        
-        top_ips = []
-        for line in output.decode('utf-8').strip().split('\n'):
-            count, ip = line.strip().split()
-            top_ips.append((ip, int(count)))
-        
-        return top_ips
+        analysis_details = analyze_single_pass(pcap_file, top_k=limit)
+        return analysis_details['top_ips']
     except Exception as e:
         print("An error occurred:", e)
         return None
 
-def calculate_syn_ack_ratio(syn_count, syn_ack_count):
+def calculate_syn_ack_ratio(syn_count, syn_ack_count, verbose=True):
     try:
         ratio = syn_count / syn_ack_count if syn_ack_count != 0 else 0
         red_color = "\033[91m"
@@ -98,7 +280,8 @@ def calculate_syn_ack_ratio(syn_count, syn_ack_count):
             feedback = "SYN-ACK ratio within threshold."
         
         # Print the feedback message
-        print(feedback)
+        if verbose:
+            print(feedback)
 
         # Format ratio to display full value if it's not zero
         ratio_str = f"{ratio:.4f}" if ratio != 0 else "0"
@@ -109,7 +292,7 @@ def calculate_syn_ack_ratio(syn_count, syn_ack_count):
 
 
 
-def calculate_proportionality_ratio(tcp_count, udp_count, http_count, syn_count, syn_ack_count, ack_count):
+def calculate_proportionality_ratio(tcp_count, udp_count, http_count, syn_count, syn_ack_count, ack_count, verbose=True):
     value = http_count + syn_count + syn_ack_count + ack_count
     red_color = "\033[91m"
     reset_color = "\033[0m"
@@ -123,12 +306,59 @@ def calculate_proportionality_ratio(tcp_count, udp_count, http_count, syn_count,
     else:
         proportion = "Packets within proportional rate"
     
-    print(proportion) 
+    if verbose:
+        print(proportion)
 
     return proportion
 
 
-def display_pcap_file(pcap_filename):
+def pipe_to_tcpdump(chunks):
+    # Feeds the capture data to `tcpdump -r -`, which prints it
+    process = subprocess.Popen(['tcpdump', '-r', '-', '-n'], stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+
+def print_tcpdump(pcap_file_path):
+    if not capture_compression(pcap_file_path):
+        subprocess.run(['tcpdump', '-r', pcap_file_path, '-n'])
+        return
+
+    # tcpdump cannot read compressed files, it is fed the decompressed stream
+    with open_capture(pcap_file_path) as f:
+        pipe_to_tcpdump(iter(lambda: f.read(shutil.COPY_BUFSIZE), b''))
+
+
+def format_packet_line(number, packet):
+    # One line per packet, laid out like `tcpdump -n` prints it
+    clock = datetime.datetime.fromtimestamp(float(packet['ts'])).strftime('%H:%M:%S.%f')
+    if not packet['ip_version']:
+        return f"{number + 1:>8} {clock} non-IP, length {packet['wirelen']}"
+
+    family = 'IP' if packet['ip_version'] == 4 else 'IP6'
+    src, dst = format_address(packet['src']), format_address(packet['dst'])
+    if packet['has_ports']:
+        src, dst = f"{src}.{packet['sport']}", f"{dst}.{packet['dport']}"
+    proto = PROTOCOL_NAMES.get(int(packet['proto']), f"proto {packet['proto']}")
+    if packet['has_flags']:
+        flags = ''.join(letter for bit, letter in TCP_FLAG_LETTERS if packet['tcp_flags'] & bit) or 'none'
+        proto = f"{proto} [{flags}]"
+    return f"{number + 1:>8} {clock} {family} {src} > {dst}: {proto}, length {packet['wirelen']}"
+
+
+# `ntfs -d` shows one page of the packets matching the filters. The packets
+# are found through the sidecar index (built on first use), so only the
+# page's records are read, whatever the size of the capture.
+def display_pcap_file(pcap_filename, offset=0, limit=DISPLAY_PAGE_PACKETS, filters=None, use_tcpdump=False):
     pcap_file_path = os.path.join('outputs', pcap_filename)
 
     if not os.path.isfile(pcap_file_path):
@@ -136,91 +366,417 @@ def display_pcap_file(pcap_filename):
         return
 
     try:
-        command = ['tcpdump', '-r', pcap_file_path, '-n']
-        subprocess.run(command)
+        index = open_packet_index(pcap_file_path)
+        numbers = filter_packet_index(index, **(filters or {}))
+        page = numbers[offset:offset + limit]
+        if not len(page):
+            print(f"No packets after the first {offset} of {len(numbers)} matching." if offset
+                  else "No packets match.")
+            return
+
+        if use_tcpdump and (is_plain_pcap(pcap_file_path) or is_store_pcap(pcap_file_path)):
+            pipe_to_tcpdump(iter_indexed_records(pcap_file_path, index, page))
+        else:
+            if use_tcpdump:
+                print("Only pcap files can be paged through tcpdump, showing the packets here.")
+            columns = read_indexed_columns(pcap_file_path, index, page)
+            for number, packet in zip(page.tolist(), columns):
+                print(format_packet_line(number, packet))
+
+        last = offset + len(page)
+        more = f", next page with --offset {last}" if last < len(numbers) else ""
+        print(f"Packets {offset + 1}-{last} of {len(numbers)} matching{more}")
+    except ValueError as e:
+        print(e)
     except Exception as e:
         print("An error occurred during display:", e)
 
 
 
-def analyze_pcap_file(pcap_filename, connection, case_id):
+def compute_pcap_analysis(pcap_file_path, workers=1, bucket_seconds=DEFAULT_BUCKET_SECONDS, columns=False,
+                          resume=None, checkpoint=False):
+    # Only reads the file and writes its packet index (and column store), so
+    # batch analysis can run it in a worker process. A resumed analysis only
+    # reads what was appended; the index is rebuilt on first use instead
+    analysis_details = analyze_single_pass(pcap_file_path, workers=workers, bucket_seconds=bucket_seconds,
+                                           build_index=True, build_columns=columns, resume=resume,
+                                           checkpoint=checkpoint)
+    if resume and columns:
+        analysis_details['column_store'] = build_column_store(pcap_file_path)
+    return analysis_details
+
+
+def run_in_pool(function, calls, jobs):
+    # Yields (result, error) for each tuple of arguments, in the order given
+    executor = None
+    if jobs > 1 and len(calls) > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        pending = [executor.submit(function, *arguments) for arguments in calls]
+
+    try:
+        for i, arguments in enumerate(calls):
+            try:
+                result = pending[i].result() if executor else function(*arguments)
+            except Exception as e:
+                yield None, e
+                continue
+            yield result, None
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def analysis_details_from_row(row, talkers, half_open_hosts, verdicts):
+    analysis_details = dict(zip(CACHED_ANALYSIS_KEYS, row))
+    analysis_details['talkers'] = talkers
+    analysis_details['half_open_hosts'] = half_open_hosts
+    analysis_details['verdicts'] = verdicts
+    analysis_details['top_ips'] = [(ip, packets) for ip, direction, packets, _ in talkers
+                                   if direction == 'source'][:TOP_IPS_LIMIT]
+    if analysis_details['series'] is not None:
+        analysis_details['series'] = series_from_blob(analysis_details['series'])
+    if analysis_details['distinct'] is not None:
+        analysis_details['distinct'] = distinct_from_blob(analysis_details['distinct'])
+        analysis_details['source_diversity'] = distinct_summary(analysis_details['distinct'])
+    return analysis_details
+
+
+def case_source_diversity(connection, case_name):
+    return merged_distinct_summary(distinct_from_blob(blob) for blob in iter_case_source_sketches(connection, case_name))
+
+
+def check_alerts(counts):
+    # Messages of the ratio checks that flag an attack (the ones printed in red)
+    _, syn_ack_feedback = calculate_syn_ack_ratio(counts['syn_count'], counts['syn_ack_count'], verbose=False)
+    proportion = calculate_proportionality_ratio(
+        counts['tcp_count'], counts['udp_count'], counts['http_count'],
+        counts['syn_count'], counts['syn_ack_count'], counts['ack_count'], verbose=False
+    )
+    return tuple(message for message in (syn_ack_feedback, proportion) if message.startswith("\033[91m"))
+
+
+def flagged_windows(series, bucket_seconds, windows=CHECK_WINDOWS):
+    # [(start timestamp, window seconds, packet counts, messages)] for every
+    # window of the series that trips a ratio check
+    flagged = []
+    # Windows shorter than a bucket become one bucket long
+    for buckets_per_window in sorted({max(1, window // bucket_seconds) for window in windows}):
+        window_seconds = buckets_per_window * bucket_seconds
+        windowed = series_windows(series, buckets_per_window)
+        columns = {name: windowed[name][:, SERIES_PACKETS].tolist() for name in COUNTER_NAMES}
+        for i, number in enumerate(windowed['bucket'].tolist()):
+            counts = {name: column[i] for name, column in columns.items()}
+            messages = check_alerts(counts)
+            if messages:
+                flagged.append((number * window_seconds, window_seconds, counts, messages))
+    return flagged
+
+
+def apply_ratio_checks(analysis_details):
+    syn_ack_ratio, syn_ack_feedback = calculate_syn_ack_ratio(analysis_details['syn_count'], analysis_details['syn_ack_count'])
+    proportion = calculate_proportionality_ratio(
+        analysis_details['tcp_count'],
+        analysis_details['udp_count'],
+        analysis_details['http_count'],
+        analysis_details['syn_count'],
+        analysis_details['syn_ack_count'],
+        analysis_details['ack_count']
+    )
+
+    analysis_details['syn_ack_ratio'] = syn_ack_ratio
+    analysis_details['syn_ack_feedback'] = syn_ack_feedback
+    analysis_details['proportionality_message'] = proportion
+
+
+def print_analysis_details(analysis_details):
+    # Display analysis details in tabular form with specified headings
+    print("\nAnalysis Details:")
+    headers = ['Parameter', 'Value']
+    data = [
+        ['Total Packets', analysis_details['total_packets']],
+        ['TCP Count', analysis_details['tcp_count']],
+        ['UDP Count', analysis_details['udp_count']],
+        ['HTTP Count', analysis_details['http_count']],
+        ['SYN Count', analysis_details['syn_count']],
+        ['SYN-ACK Count', analysis_details['syn_ack_count']],
+        ['ACK Count', analysis_details['ack_count']],
+        ['SYN without ACK Count', analysis_details['syn_without_ack_count']],
+        ['SYN-ACK Ratio', f"{analysis_details['syn_ack_ratio']} - {analysis_details['syn_ack_feedback']}"],
+        ['Proportionality Message', analysis_details['proportionality_message']],
+        ['TCP Flows', analysis_details['flow_count']],
+        ['Half-open Handshakes', analysis_details['half_open_count']],
+        ['Distinct Sources', analysis_details['source_diversity']['sources']],
+        ['Distinct Source /24s', analysis_details['source_diversity']['networks']],
+    ]
+
+    # Print main analysis details using tabulate
+    print(tabulate(data, headers=headers, tablefmt='grid'))
+
+    print_verdicts(analysis_details['verdicts'])
+
+    if analysis_details.get('series') is not None:
+        print_flagged_windows(analysis_details['series'], analysis_details['series_bucket'])
+
+    print_source_diversity(analysis_details['source_diversity'])
+
+    # Hosts sent SYNs they never saw completed, and hosts that sent them
+    for title, role in [("Half-open Targets", 'target'), ("Half-open Sources", 'source')]:
+        hosts = [[ip, half_open, handshakes] for ip, host_role, half_open, handshakes
+                 in analysis_details['half_open_hosts'] if host_role == role][:TOP_IPS_LIMIT]
+        if hosts:
+            print(f"\n{title}:")
+            print(tabulate(hosts, headers=['IP', 'Half-open', 'Handshakes'], tablefmt='grid'))
+
+    if 'top_talkers' not in analysis_details:
+        print("\nTop IPs:")
+        print(tabulate(analysis_details['top_ips'], headers=['IP', 'Count'], tablefmt='grid'))
+        return
+
+    # Display top talkers in separate tables, counts are upper bounds within the error shown
+    for title, dimension in [("Top IPs", 'sources'), ("Top Destinations", 'destinations'), ("Top Conversations", 'pairs')]:
+        print(f"\n{title}:")
+        headers_top_ips = ['IP', 'Packets', 'Error', 'IP (by bytes)', 'Bytes', 'Error']
+        by_packets = analysis_details['top_talkers'][dimension]['packets']
+        by_bytes = analysis_details['top_talkers'][dimension]['bytes']
+        data_top_ips = [list(p) + list(b) for p, b in zip(by_packets, by_bytes)]
+        print(tabulate(data_top_ips, headers=headers_top_ips, tablefmt='grid'))
+
+
+def format_verdict_window(verdict):
+    if verdict['start'] is None:
+        return "whole capture"
+    start = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(verdict['start']))
+    return f"{start} ({verdict['end'] - verdict['start']:g}s)"
+
+
+def print_verdicts(verdicts):
+    # Verdicts of the detection rules, see ntfs_rules
+    print("\nDetections:")
+    if not verdicts:
+        print("No detection rule was triggered.")
+        return
+    data = [[verdict['severity'], verdict['attack'], verdict['target'] or '', format_verdict_window(verdict),
+             verdict['message']] for verdict in verdicts]
+    print(tabulate(data, headers=['Severity', 'Attack', 'Target', 'Window', 'Evidence'], tablefmt='grid'))
+
+
+def print_source_diversity(diversity):
+    # Estimated distinct sources toward the busiest destinations, the DoS / DDoS distinction
+    print("\nSource Diversity:")
+    data = [[ip, sources, networks, classify_sources(sources, networks)]
+            for ip, sources, networks in diversity['destinations'][:TOP_IPS_LIMIT]]
+    print(tabulate(data, headers=['Destination', 'Sources', 'Source /24s', 'Traffic'], tablefmt='grid'))
+    if diversity['peak']:
+        start, sources, networks = diversity['peak']
+        print(f"Most sources in one bucket: about {sources} from {networks} /24s, starting "
+              f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start))}")
+
+
+def print_flagged_windows(series, bucket_seconds):
+    flagged = flagged_windows(series, bucket_seconds)
+    print("\nFlagged Windows:")
+    if not flagged:
+        print("No window trips the SYN-ACK or proportionality checks.")
+        return
+    # Longest windows first, they summarize the shorter ones inside them
+    flagged.sort(key=lambda row: (-row[1], row[0]))
+    headers = ['Start', 'Window', 'SYN', 'SYN-ACK', 'TCP', 'UDP', 'Message']
+    data = [[time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), f"{window}s", counts['syn_count'],
+             counts['syn_ack_count'], counts['tcp_count'], counts['udp_count'], "\n".join(messages)]
+            for start, window, counts, messages in flagged[:FLAGGED_WINDOWS_LIMIT]]
+    print(tabulate(data, headers=headers, tablefmt='grid'))
+    if len(flagged) > FLAGGED_WINDOWS_LIMIT:
+        print(f"... and {len(flagged) - FLAGGED_WINDOWS_LIMIT} more flagged windows.")
+
+
+def analyze_pcap_file(pcap_filename, connection, case_id, workers=1, use_cache=True,
+                      bucket_seconds=DEFAULT_BUCKET_SECONDS, dump=False, columns=False, incremental=False):
     pcap_file_path = os.path.join('outputs', pcap_filename)
 
     if not os.path.isfile(pcap_file_path):
         print("File does not exist")
         return
 
-    try:
-        command = ['tcpdump', '-r', pcap_file_path, '-n']
-        subprocess.run(command)
-        
-        case_details = get_case_details_by_id(connection, case_id)
-        if not case_details:
-            print("Case details not found")
-            return
-        case_name, org_name, _, _ = case_details
-        
-        analysis_details = {}
-        analysis_details['total_packets'] = count_total_packets(pcap_file_path)
-        analysis_details['top_ips'] = top_traffic_ips(pcap_file_path)
-        analysis_details['tcp_count'] = count_packets(pcap_file_path, 'tcp')
-        analysis_details['udp_count'] = count_packets(pcap_file_path, 'udp')
-        analysis_details['http_count'] = count_packets(pcap_file_path, 'http')
-        analysis_details['syn_count'] = count_packets(pcap_file_path, 'tcp[13] & 2 != 0')
-        analysis_details['syn_ack_count'] = count_packets(pcap_file_path, 'tcp[13] & 18 == 18')
-        analysis_details['ack_count'] = count_packets(pcap_file_path, 'tcp[13] & 16 != 0')
-        analysis_details['syn_without_ack_count'] = count_packets(pcap_file_path, 'tcp[13] & 18 == 2')
-        
-        # Calculate ratios
-        syn_ack_ratio, syn_ack_feedback = calculate_syn_ack_ratio(analysis_details['syn_count'], analysis_details['syn_ack_count'])
-        proportion = calculate_proportionality_ratio(
-            analysis_details['tcp_count'],
-            analysis_details['udp_count'],
-            analysis_details['http_count'],
-            analysis_details['syn_count'],
-            analysis_details['syn_ack_count'],
-            analysis_details['ack_count']
-        )
-        
-        analysis_details['syn_ack_ratio'] = syn_ack_ratio
-        analysis_details['syn_ack_feedback'] = syn_ack_feedback
-        analysis_details['proportionality_message'] = proportion
-        
-        # Calculate file hash
-        file_hash = calculate_file_hash(pcap_file_path)
-        if not file_hash:
+    # Dumping every packet takes far longer than the analysis on large
+    # captures; `ntfs -d` pages through them instead
+    if dump:
+        try:
+            print_tcpdump(pcap_file_path)
+        except Exception as e:
+            print("An error occurred during display:", e)
+
+    analyze_pcap_files([pcap_filename], connection, case_id, workers=workers, use_cache=use_cache,
+                       bucket_seconds=bucket_seconds, columns=columns, incremental=incremental)
+
+
+def resume_point(pcap_filename, pcap_file_path, checkpoints, file_hashes):
+    # (analysis_id, end_offset) to go on from, if the file only grew since its
+    # checkpoint was taken
+    if pcap_filename not in checkpoints:
+        return None
+    analysis_id, end_offset, prefix_sha256 = checkpoints[pcap_filename]
+    if 'prefix_sha256' in file_hashes[pcap_filename]:
+        current_sha256 = file_hashes[pcap_filename]['prefix_sha256']
+    else:
+        current_sha256 = calculate_prefix_hash(pcap_file_path, end_offset)
+    if current_sha256 != prefix_sha256:
+        print(f"\n{pcap_filename} changed within the first {end_offset} bytes analyzed by analysis #{analysis_id}, "
+              f"analyzing it from the start.")
+        return None
+    return analysis_id, end_offset
+
+
+def checkpoint_prefix_hash(pcap_file_path, file_stat, end_offset, file_hashes):
+    # The analysis usually stopped at the end of the file hashed as evidence,
+    # the prefix is only read again when records were appended since
+    if end_offset == file_stat.st_size:
+        return file_hashes['sha256']
+    return calculate_prefix_hash(pcap_file_path, end_offset)
+
+
+def analyze_pcap_files(pcap_filenames, connection, case_id, jobs=1, workers=1, use_cache=True,
+                       bucket_seconds=DEFAULT_BUCKET_SECONDS, columns=False, incremental=False):
+    case_details = get_case_details_by_id(connection, case_id)
+    if not case_details:
+        print("Case details not found")
+        return
+    case_name, org_name, _, _ = case_details
+
+    pcap_files = []
+    for pcap_filename in pcap_filenames:
+        pcap_file_path = os.path.join('outputs', pcap_filename)
+        if os.path.isfile(pcap_file_path):
+            pcap_files.append((pcap_filename, pcap_file_path, os.stat(pcap_file_path)))
+        else:
+            print(f"File does not exist: {pcap_filename}")
+
+    # Pcap files still being written to are analyzed again from where their
+    # last analysis in the case stopped: (analysis_id, end_offset,
+    # prefix_sha256) of its checkpoint. Only analyses run with `incremental`,
+    # and those resumed from them, keep a checkpoint.
+    checkpoints = {}
+    if use_cache:
+        for pcap_filename, pcap_file_path, _ in pcap_files:
+            if is_plain_pcap(pcap_file_path):
+                checkpoint = get_analysis_checkpoint(connection, case_name, pcap_filename, ANALYZER_VERSION,
+                                                     bucket_seconds)
+                if checkpoint:
+                    checkpoints[pcap_filename] = checkpoint
+
+    # Hashes taken at import/capture time, or at the last analysis, are reused as
+    # long as the file's size and mtime did not change since
+    file_hashes = {}
+    unhashed = []
+    for pcap_filename, pcap_file_path, file_stat in pcap_files:
+        known_hashes = get_known_file_hashes(connection, pcap_file_path, file_stat.st_size, file_stat.st_mtime_ns)
+        if known_hashes and known_hashes[1]:
+            file_hashes[pcap_filename] = {'md5': known_hashes[0], 'sha256': known_hashes[1]}
+        else:
+            unhashed.append((pcap_filename, pcap_file_path))
+
+    # The checkpointed prefix of a grown file is hashed in the same read
+    hash_calls = [(pcap_file_path, checkpoints[pcap_filename][1] if pcap_filename in checkpoints else None)
+                  for pcap_filename, pcap_file_path in unhashed]
+    hash_results = run_in_pool(calculate_all_file_hashes, hash_calls, jobs)
+    for (pcap_filename, _), (hashes, _) in zip(unhashed, hash_results):
+        if hashes:
+            file_hashes[pcap_filename] = hashes
+        else:
             print(f"Failed to calculate hash for file: {pcap_filename}")
-            return
-        
-        # Insert analysis details into the database
-        insert_pcap_analysis(connection, case_name, org_name, pcap_filename, analysis_details, file_hash)
-
-        print("Analysis complete. Details stored in the database.")
-
-        # Display analysis details in tabular form with specified headings
-        print("\nAnalysis Details:")
-        headers = ['Parameter', 'Value']
-        data = [
-            ['Total Packets', analysis_details['total_packets']],
-            ['TCP Count', analysis_details['tcp_count']],
-            ['UDP Count', analysis_details['udp_count']],
-            ['HTTP Count', analysis_details['http_count']],
-            ['SYN Count', analysis_details['syn_count']],
-            ['SYN-ACK Count', analysis_details['syn_ack_count']],
-            ['ACK Count', analysis_details['ack_count']],
-            ['SYN without ACK Count', analysis_details['syn_without_ack_count']],
-            ['SYN-ACK Ratio', f"{analysis_details['syn_ack_ratio']} - {analysis_details['syn_ack_feedback']}"],
-            ['Proportionality Message', analysis_details['proportionality_message']]
-        ] 
-
-        # Print main analysis details using tabulate
-        print(tabulate(data, headers=headers, tablefmt='grid'))
-
-        # Display top IPs in a separate table
-        print("\nTop IPs:")
-        headers_top_ips = ['IP', 'Count']
-        data_top_ips = [[ip, count] for ip, count in analysis_details['top_ips']]
-        print(tabulate(data_top_ips, headers=headers_top_ips, tablefmt='grid'))
 
-    except Exception as e:
-        print("An error occurred during analysis:", e)
+    analyses = []
+    # (analysis_id, pcap_filename, analysis_details, file_hash) of the resumed analyses
+    updates = []
+    # (pcap_filename, analysis_details) of every file analyzed or found in the cache
+    results = []
+    pending = []
+    # (pcap_filename, store) of the column stores to register for the case
+    column_stores = []
+    for pcap_filename, pcap_file_path, file_stat in pcap_files:
+        if pcap_filename not in file_hashes:
+            continue
+        cached = None
+        if use_cache:
+            cached = get_cached_pcap_analysis(connection, file_hashes[pcap_filename]['md5'], ANALYZER_VERSION, case_name,
+                                              bucket_seconds)
+        if not cached:
+            pending.append((pcap_filename, pcap_file_path, file_stat,
+                            resume_point(pcap_filename, pcap_file_path, checkpoints, file_hashes)))
+            continue
+
+        print(f"\nCache hit: {pcap_filename} has the same content as analysis #{cached[0]}, not analyzing it again.")
+        analysis_details = analysis_details_from_row(cached, get_analysis_talkers(connection, cached[0]),
+                                                     get_analysis_half_open(connection, cached[0]),
+                                                     get_analysis_verdicts(connection, cached[0]))
+        print_analysis_details(analysis_details)
+        results.append((pcap_filename, analysis_details))
+        if columns:
+            # Cached analyses did not read the file, its store is written now if it has none
+            store = column_store_info(pcap_file_path) or build_column_store(pcap_file_path)
+            column_stores.append((pcap_filename, store))
+        if analysis_details['CaseName'] != case_name:
+            # The same evidence was analyzed for another case, record it for this one too
+            analysis_details.update(analyzer_version=ANALYZER_VERSION, file_size=file_stat.st_size,
+                                    file_mtime=file_stat.st_mtime_ns, file_sha256=file_hashes[pcap_filename]['sha256'])
+            analyses.append((pcap_filename, analysis_details, file_hashes[pcap_filename]['md5']))
+
+    # With several files in flight each one is analyzed by a single process
+    file_workers = 1 if jobs > 1 and len(pending) > 1 else workers
+    calls = []
+    for pcap_filename, pcap_file_path, _, resume in pending:
+        if resume:
+            analysis_id, end_offset = resume
+            print(f"\nResuming analysis #{analysis_id} of {pcap_filename} from byte {end_offset}.")
+            resume = (get_checkpoint_state(connection, analysis_id), end_offset)
+        calls.append((pcap_file_path, file_workers, bucket_seconds, columns, resume, incremental or bool(resume)))
+    for (pcap_filename, pcap_file_path, file_stat, resume), (analysis_details, error) in zip(pending, run_in_pool(compute_pcap_analysis, calls, jobs)):
+        if error:
+            print(f"An error occurred during analysis of {pcap_filename}:", error)
+            continue
+
+        checkpoint = analysis_details.pop('checkpoint', None)
+        if checkpoint:
+            prefix_sha256 = checkpoint_prefix_hash(pcap_file_path, file_stat, checkpoint[1], file_hashes[pcap_filename])
+            if prefix_sha256:
+                analysis_details['checkpoint'] = checkpoint + (prefix_sha256,)
+
+        if len(pcap_files) > 1:
+            print(f"\n{pcap_filename}:")
+        analysis_details.update(analyzer_version=ANALYZER_VERSION, file_size=file_stat.st_size,
+                                file_mtime=file_stat.st_mtime_ns, file_sha256=file_hashes[pcap_filename]['sha256'])
+        apply_ratio_checks(analysis_details)
+        print_analysis_details(analysis_details)
+        results.append((pcap_filename, analysis_details))
+        if resume:
+            # The resumed analysis replaces the one it went on from
+            updates.append((resume[0], pcap_filename, analysis_details, file_hashes[pcap_filename]['md5']))
+        else:
+            analyses.append((pcap_filename, analysis_details, file_hashes[pcap_filename]['md5']))
+        if columns:
+            column_stores.append((pcap_filename, analysis_details['column_store']))
+
+    if len(results) > 1:
+        diversity = merged_distinct_summary(analysis_details['distinct'] for _, analysis_details in results
+                                            if analysis_details.get('distinct') is not None)
+        if diversity:
+            print(f"\nAll {len(results)} files together:")
+            print_source_diversity(diversity)
+
+    # Files whose analysis could not be saved are left out of the results
+    unsaved = set()
+    if analyses:
+        # Insert every analysis of the batch in one transaction
+        if insert_pcap_analyses(connection, case_name, org_name, analyses):
+            print(f"\nAnalysis complete. Details of {len(analyses)} file(s) stored in the database.")
+        else:
+            unsaved.update(pcap_filename for pcap_filename, _, _ in analyses)
+    if updates:
+        if update_pcap_analyses(connection, case_name, org_name, updates):
+            print(f"\nAnalysis complete. Details of {len(updates)} resumed file(s) updated in the database.")
+        else:
+            unsaved.update(pcap_filename for _, pcap_filename, _, _ in updates)
+    if column_stores:
+        register_column_stores(connection, case_name, column_stores)
+        print(f"Column stores of {len(column_stores)} file(s) registered for the case.")
+    return [(pcap_filename, analysis_details) for pcap_filename, analysis_details in results
+            if pcap_filename not in unsaved]
@@ -0,0 +1,72 @@
+# Options shared by the interactive `ntfs -x` commands and the scripted
+# subcommands of ntfs_cli. Only argparse is imported here, so building the
+# scripted parser does not load numpy.
+
+# Same default as ntfs_series.DEFAULT_BUCKET_SECONDS, not imported to keep numpy out of startup
+DEFAULT_BUCKET_SECONDS = 1
+
+
+def add_import_arguments(parser):
+    parser.add_argument("files", nargs="+", help="Pcap files to import")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        help="Keep the files in the compressed evidence store")
+
+
+def add_file_selection_arguments(parser, verb):
+    parser.add_argument("filenames", nargs="*", help="Pcap file names or glob patterns in the outputs folder")
+    parser.add_argument("--all", action="store_true", help=f"{verb} every pcap file registered for the case")
+
+
+def file_selection_error(args):
+    if not args.filenames and not args.all:
+        return "Specify pcap file names, glob patterns or --all."
+    return None
+
+
+def add_analyze_arguments(parser):
+    add_file_selection_arguments(parser, "Analyze")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files analyzed concurrently")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of processes used to analyze one large file")
+    parser.add_argument("--force", action="store_true",
+                        help="Analyze again even if the same content was already analyzed")
+    parser.add_argument("-b", "--bucket", type=int, default=DEFAULT_BUCKET_SECONDS,
+                        help="Width in seconds of the time-series buckets")
+    parser.add_argument("--columns", action="store_true",
+                        help="Also write the column store queried by `ntfs_tool.py query`")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Keep a checkpoint so the next analysis of a growing pcap only reads what was appended")
+
+
+def analyze_arguments_error(args):
+    error = file_selection_error(args)
+    if error:
+        return error
+    if args.bucket < 1:
+        return "The bucket width must be at least 1 second."
+    return None
+
+
+def add_packet_filter_arguments(parser, limit):
+    parser.add_argument("--host", help="Packets from or to this IP address")
+    parser.add_argument("--src", help="Packets from this IP address")
+    parser.add_argument("--dst", help="Packets to this IP address")
+    parser.add_argument("--port", type=int, help="Packets from or to this port")
+    parser.add_argument("--proto", help="IP protocol, by name (tcp, udp, icmp) or number")
+    parser.add_argument("--start", help="First time, as epoch seconds, ISO date and time or HH:MM[:SS]")
+    parser.add_argument("--end", help="Time before which packets are shown, same formats as --start")
+    parser.add_argument("--offset", type=int, default=0, help="Matching packets skipped")
+    parser.add_argument("--limit", type=int, default=limit, help="Matching packets shown")
+
+
+def add_rotation_arguments(parser):
+    parser.add_argument("-i", "--interface", action="append", default=[],
+                        help="Interface to capture on, as IFACE or IFACE=FILTER; repeat for several captures")
+    parser.add_argument("-c", "--count", type=int, help="Packets each capture stops after")
+    parser.add_argument("-G", "--seconds", type=int, help="Start a new file every N seconds")
+    parser.add_argument("-C", "--size", type=int, help="Start a new file once the current one reaches N MB")
+    parser.add_argument("-W", "--files", type=int, help="Keep only the last N files of each capture")
+    parser.add_argument("--max-disk", type=int, help="Delete the oldest files beyond N MB of captures in total")
+    parser.add_argument("--duration", type=int, help="Stop all captures after N seconds")
+    parser.add_argument("-z", "--compress", action="store_true", help="Keep the files in the compressed evidence store")
+    parser.add_argument("target", nargs="*", help="Filter of the interfaces given without one")
@@ -0,0 +1,406 @@
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from ntfs_pcap import PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN, LINKTYPE_ETHERNET, IPPROTO_TCP, IPPROTO_UDP
+
+# Benchmark of the analysis pipeline on synthetic captures, e.g.
+#   python3 ntfs_bench.py --sizes 10MB 1GB --scenarios syn_flood benign --output bench.json
+# Captures are generated offline from a seed, so every run over the same
+# arguments measures the same bytes. Each stage runs in a fresh process to
+# get its own peak RSS.
+
+BENCH_ORG_NAME = "bench"
+STAGES = ('generate', 'ingest', 'analyze', 'top_ips', 'report')
+BATCH_PACKETS = 8192
+BASE_TIMESTAMP = 1700000000
+# Cold start budget of the scripted `list` command
+STARTUP_TARGET_MS = 100
+
+SIZE_UNITS = {'KB': 1 << 10, 'MB': 1 << 20, 'GB': 1 << 30, 'TB': 1 << 40}
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+TCP_PSH_ACK = 0x18
+TCP_SYN_ACK = 0x12
+
+HTTP_GET = b"GET / HTTP/1.1\r\nHost: victim.example\r\nUser-Agent: bench\r\nAccept: */*\r\n\r\n"
+
+# kind: (protocol, TCP flags, payload length, payload)
+PACKET_KINDS = {
+    'syn': (IPPROTO_TCP, TCP_SYN, 0, b""),
+    'syn_ack': (IPPROTO_TCP, TCP_SYN_ACK, 0, b""),
+    'ack': (IPPROTO_TCP, TCP_ACK, 0, b""),
+    'data': (IPPROTO_TCP, TCP_PSH_ACK, 1200, b""),
+    'http_get': (IPPROTO_TCP, TCP_PSH_ACK, len(HTTP_GET), HTTP_GET),
+    'dns': (IPPROTO_UDP, 0, 40, b""),
+    'udp': (IPPROTO_UDP, 0, 512, b""),
+}
+
+# (weight, kind, source pool, destination pool, source port, destination port);
+# ports are numbers, 'ephemeral' or 'random'
+BENIGN_MIX = [
+    (0.10, 'syn', 'clients', 'servers', 'ephemeral', 443),
+    (0.10, 'syn_ack', 'servers', 'clients', 443, 'ephemeral'),
+    (0.25, 'ack', 'clients', 'servers', 'ephemeral', 443),
+    (0.35, 'data', 'servers', 'clients', 443, 'ephemeral'),
+    (0.05, 'http_get', 'clients', 'servers', 'ephemeral', 80),
+    (0.15, 'dns', 'clients', 'resolver', 'ephemeral', 53),
+]
+
+# Attack traffic, on top of 10% benign traffic; rate is packets per second of capture time
+SCENARIOS = {
+    'syn_flood': {'rate': 200000, 'mix': [
+        (0.90, 'syn', 'spoofed', 'victim', 'random', 80),
+    ]},
+    'udp_flood': {'rate': 150000, 'mix': [
+        (0.90, 'udp', 'botnet', 'victim', 'random', 'random'),
+    ]},
+    'http_flood': {'rate': 50000, 'mix': [
+        (0.15, 'syn', 'botnet', 'victim', 'ephemeral', 80),
+        (0.15, 'syn_ack', 'victim', 'botnet', 80, 'ephemeral'),
+        (0.20, 'ack', 'botnet', 'victim', 'ephemeral', 80),
+        (0.40, 'http_get', 'botnet', 'victim', 'ephemeral', 80),
+    ]},
+    'benign': {'rate': 20000, 'mix': []},
+}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for unit, factor in SIZE_UNITS.items():
+        if text.endswith(unit):
+            return int(float(text[:-len(unit)]) * factor)
+    return int(text)
+
+
+def scenario_mix(scenario):
+    mix = SCENARIOS[scenario]['mix']
+    attack_weight = sum(entry[0] for entry in mix)
+    return mix + [(weight * (1 - attack_weight),) + tuple(entry) for weight, *entry in BENIGN_MIX]
+
+
+def address_pools(rng):
+    return {
+        'clients': (0x0A000000 + rng.integers(1, 1 << 16, 200)).astype(np.uint32),    # 10.0.0.0/16
+        'servers': (0xC6336400 + rng.integers(1, 255, 5)).astype(np.uint32),          # 198.51.100.0/24
+        'resolver': np.array([0x08080808], dtype=np.uint32),
+        'victim': np.array([0xC000020A], dtype=np.uint32),                            # 192.0.2.10
+        'botnet': rng.integers(1 << 24, 0xDF000000, 2000).astype(np.uint32),
+    }
+
+
+def _addresses(rng, pools, pool, n):
+    if pool == 'spoofed':
+        return rng.integers(1 << 24, 0xDF000000, n).astype(np.uint32)
+    return pools[pool][rng.integers(0, len(pools[pool]), n)]
+
+
+def _ports(rng, spec, n):
+    if spec == 'ephemeral':
+        return rng.integers(1024, 65536, n)
+    if spec == 'random':
+        return rng.integers(1, 65536, n)
+    return np.full(n, spec)
+
+
+def _put(rows, start, values, dtype):
+    width = np.dtype(dtype).itemsize
+    values = np.ascontiguousarray(np.broadcast_to(values, (len(rows),)), dtype=dtype)
+    rows[:, start:start + width] = values.view(np.uint8).reshape(-1, width)
+
+
+def build_records(kind, ts, src, dst, sport, dport, rng):
+    # (n, record length) array of pcap records (header + Ethernet/IPv4 frame)
+    proto, flags, payload_len, payload = PACKET_KINDS[kind]
+    transport_len = 20 if proto == IPPROTO_TCP else 8
+    frame_len = 14 + 20 + transport_len + payload_len
+    rows = np.zeros((len(ts), PCAP_RECORD_HEADER_LEN + frame_len), dtype=np.uint8)
+
+    seconds = np.floor(ts)
+    _put(rows, 0, seconds, '<u4')
+    _put(rows, 4, (ts - seconds) * 1e6, '<u4')
+    _put(rows, 8, frame_len, '<u4')
+    _put(rows, 12, frame_len, '<u4')
+
+    ip = PCAP_RECORD_HEADER_LEN + 14
+    rows[:, ip - 2] = 0x08                     # EtherType IPv4
+    rows[:, ip] = 0x45
+    _put(rows, ip + 2, frame_len - 14, '>u2')
+    _put(rows, ip + 4, rng.integers(0, 1 << 16, len(ts)), '>u2')
+    rows[:, ip + 8] = 64
+    rows[:, ip + 9] = proto
+    _put(rows, ip + 12, src, '>u4')
+    _put(rows, ip + 16, dst, '>u4')
+
+    transport = ip + 20
+    _put(rows, transport, sport, '>u2')
+    _put(rows, transport + 2, dport, '>u2')
+    if proto == IPPROTO_TCP:
+        _put(rows, transport + 4, rng.integers(0, 1 << 32, len(ts)), '>u4')
+        rows[:, transport + 12] = 0x50
+        rows[:, transport + 13] = flags
+        _put(rows, transport + 14, 0xFFFF, '>u2')
+    else:
+        _put(rows, transport + 4, transport_len + payload_len, '>u2')
+    if payload:
+        start = transport + transport_len
+        rows[:, start:start + len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+    return rows
+
+
+def generate_pcap(path, scenario, size, seed):
+    # Writes records until the file reaches `size` bytes; returns the packet count
+    rng = np.random.default_rng(seed)
+    pools = address_pools(rng)
+    mix = scenario_mix(scenario)
+    weights = np.array([entry[0] for entry in mix])
+    weights /= weights.sum()
+    rate = SCENARIOS[scenario]['rate']
+
+    packets = 0
+    written = PCAP_GLOBAL_HEADER_LEN
+    with open(path, 'wb') as f:
+        header = np.array([0xA1B2C3D4], dtype='<u4').tobytes()
+        header += np.array([2, 4], dtype='<u2').tobytes()
+        header += np.array([0, 0, 65535, LINKTYPE_ETHERNET], dtype='<u4').tobytes()
+        f.write(header)
+        while written < size:
+            kinds = rng.choice(len(mix), size=BATCH_PACKETS, p=weights)
+            ts = BASE_TIMESTAMP + (packets + np.arange(BATCH_PACKETS)) / rate
+            built = []
+            for k, (_, kind, src_pool, dst_pool, sport, dport) in enumerate(mix):
+                index = np.flatnonzero(kinds == k)
+                if len(index):
+                    n = len(index)
+                    built.append((index, build_records(kind, ts[index], _addresses(rng, pools, src_pool, n),
+                                                       _addresses(rng, pools, dst_pool, n),
+                                                       _ports(rng, sport, n), _ports(rng, dport, n), rng)))
+
+            # Interleave the records of every kind back in packet order
+            lengths = np.zeros(BATCH_PACKETS, dtype=np.int64)
+            for index, rows in built:
+                lengths[index] = rows.shape[1]
+            offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+            batch = np.empty(int(lengths.sum()), dtype=np.uint8)
+            for index, rows in built:
+                batch[offsets[index][:, None] + np.arange(rows.shape[1])] = rows
+
+            f.write(batch.tobytes())
+            written += len(batch)
+            packets += BATCH_PACKETS
+    return packets
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in KB on Linux; worker processes count too
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _run_stage(stage, workdir, pcap_filename, options):
+    os.chdir(workdir)
+    from ntfs_data import create_connection
+    connection = create_connection("ntfs.db")
+    pcap_file_path = os.path.join('outputs', pcap_filename)
+    result = {}
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        if stage == 'generate':
+            result['packets'] = generate_pcap(pcap_file_path, options['scenario'], options['size'], options['seed'])
+        elif stage == 'ingest':
+            from ntfs_data import insert_pcap_file
+            from ntfs_hash import calculate_file_hashes
+            insert_pcap_file(connection, options['case_name'], pcap_file_path, 'imported',
+                             calculate_file_hashes(pcap_file_path))
+        elif stage == 'analyze':
+            from ntfs_analysis import analyze_pcap_files
+            analyze_pcap_files([pcap_filename], connection, options['case_id'], workers=options['workers'],
+                               use_cache=False)
+        elif stage == 'top_ips':
+            from ntfs_analysis import top_traffic_ips
+            top_traffic_ips(pcap_file_path)
+        elif stage == 'report':
+            from ntfs_data import get_case_details_by_id, get_pcap_files_for_case
+            from ntfs_report import generate_pdf_report
+            generate_pdf_report(get_case_details_by_id(connection, options['case_id']),
+                                get_pcap_files_for_case(connection, options['case_name']), connection)
+        result['seconds'] = time.perf_counter() - start
+
+    connection.close()
+    result['peak_rss_kb'] = _peak_rss_kb()
+    return result
+
+
+def run_stage(stage, workdir, pcap_filename, options):
+    # Spawned rather than forked so the stage does not inherit earlier allocations
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(_run_stage, (stage, workdir, pcap_filename, options))
+
+
+def prepare_case(workdir, case_name):
+    # One case per capture in the benchmark's own database, emptied before every
+    # run so the report stage always covers just that capture; cached report
+    # sections are dropped too so every report is laid out from scratch
+    from ntfs_data import create_connection, create_tables, get_registration_id_by_name, insert_registration
+    from ntfs_report import REPORT_CACHE_DIR
+    os.makedirs(os.path.join(workdir, 'outputs'), exist_ok=True)
+    shutil.rmtree(os.path.join(workdir, REPORT_CACHE_DIR), ignore_errors=True)
+    connection = create_connection(os.path.join(workdir, "ntfs.db"))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        create_tables(connection)
+        with connection:
+            connection.execute("DELETE FROM pcap_file WHERE CaseName=?", (case_name,))
+            connection.execute("DELETE FROM pcap_analysis WHERE CaseName=?", (case_name,))
+        case_id = get_registration_id_by_name(connection, case_name)
+        if not case_id:
+            case_id = insert_registration(connection, case_name, BENCH_ORG_NAME, "bench", time.strftime('%Y-%m-%d'))
+    connection.close()
+    return case_id
+
+
+def measure_startup(workdir, runs):
+    # Wall-clock time of the scripted `list` command in a fresh interpreter,
+    # the cold start paid by every cron or playbook call
+    tool = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ntfs_tool.py')
+    command = [sys.executable, tool, '--db', os.path.join(workdir, 'ntfs.db'), '--quiet', 'list']
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {'command': 'list', 'runs': runs, 'median_ms': timings[len(timings) // 2], 'min_ms': timings[0],
+            'target_ms': STARTUP_TARGET_MS}
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(args):
+    from ntfs_engine import ANALYZER_VERSION
+    workdir = os.path.abspath(args.workdir)
+    results = {
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'revision': git_revision(),
+        'analyzer_version': ANALYZER_VERSION,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'workers': args.workers,
+        'seed': args.seed,
+        'runs': [],
+    }
+
+    for size_text in args.sizes:
+        size = parse_size(size_text)
+        for scenario in args.scenarios:
+            case_name = f"bench-{scenario}-{size_text.upper()}-s{args.seed}"
+            pcap_filename = f"{case_name}.pcap"
+            pcap_file_path = os.path.join(workdir, 'outputs', pcap_filename)
+            options = {'scenario': scenario, 'size': size, 'seed': args.seed, 'workers': args.workers,
+                       'case_name': case_name, 'case_id': prepare_case(workdir, case_name)}
+            run = {'scenario': scenario, 'size': size_text.upper(), 'stages': {}}
+            print(f"\n{scenario} {size_text.upper()}:")
+
+            # Generated captures are kept and reused by later runs with the same arguments
+            meta_path = pcap_file_path + '.json'
+            meta = None
+            if os.path.isfile(meta_path) and os.path.isfile(pcap_file_path):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                if meta.get('options') != [scenario, size, args.seed]:
+                    meta = None
+            if not meta or args.regenerate:
+                result = run_stage('generate', workdir, pcap_filename, options)
+                meta = {'options': [scenario, size, args.seed], 'packets': result['packets']}
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+                if 'generate' in args.stages:
+                    run['stages']['generate'] = result
+
+            for stage in args.stages:
+                if stage != 'generate':
+                    run['stages'][stage] = run_stage(stage, workdir, pcap_filename, options)
+
+            run['file_bytes'] = os.path.getsize(pcap_file_path)
+            run['packets'] = meta['packets']
+            for stage, result in run['stages'].items():
+                seconds = max(result['seconds'], 1e-9)
+                result['packets_per_sec'] = run['packets'] / seconds
+                result['mb_per_sec'] = run['file_bytes'] / (1 << 20) / seconds
+                result.pop('packets', None)
+                print(f"  {stage:<9} {result['seconds']:9.3f} s {result['packets_per_sec']:14,.0f} pkt/s "
+                      f"{result['mb_per_sec']:9.1f} MB/s {result['peak_rss_kb'] / 1024:9.1f} MB peak RSS")
+            results['runs'].append(run)
+
+    if args.startup_runs:
+        os.makedirs(workdir, exist_ok=True)
+        startup = measure_startup(workdir, args.startup_runs)
+        verdict = "within" if startup['median_ms'] <= STARTUP_TARGET_MS else "OVER"
+        print(f"\nCold start of `list`: {startup['median_ms']:.1f} ms median, {startup['min_ms']:.1f} ms best "
+              f"({verdict} the {STARTUP_TARGET_MS} ms target)")
+        results['startup'] = startup
+    return results
+
+
+def compare_results(previous, current):
+    # Stage times of the current run relative to an earlier results file
+    earlier = {(run['scenario'], run['size'], stage): result['seconds']
+               for run in previous['runs'] for stage, result in run['stages'].items()}
+    print(f"\nCompared with {previous.get('revision')} ({previous.get('date')}):")
+    for run in current['runs']:
+        for stage, result in run['stages'].items():
+            key = (run['scenario'], run['size'], stage)
+            if key in earlier and earlier[key] > 0:
+                change = (result['seconds'] - earlier[key]) / earlier[key] * 100
+                print(f"  {run['scenario']:<10} {run['size']:<6} {stage:<9} "
+                      f"{earlier[key]:9.3f} s -> {result['seconds']:9.3f} s ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline on synthetic captures")
+    parser.add_argument("--sizes", nargs="+", default=["10MB"], help="Capture sizes, e.g. 10MB 1GB 20GB")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help="Traffic scenarios to generate")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES), help="Pipeline stages to time")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Processes used to analyze one file")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the capture generator")
+    parser.add_argument("--regenerate", action="store_true",
+                        help="Generate the captures again even if they already exist")
+    parser.add_argument("--workdir", default="bench", help="Folder for the captures, database and reports")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON file the results are saved to")
+    parser.add_argument("--compare", help="Earlier results file to compare stage times with")
+    parser.add_argument("--startup-runs", type=int, default=10,
+                        help="Times the scripted `list` command is started to measure cold start, 0 to skip")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
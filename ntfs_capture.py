@@ -2,19 +2,40 @@ import argparse
 import os
 import shutil
 import subprocess
+import tempfile
 
 from ntfs_data import insert_pcap_file, get_case_details_by_id, get_pcap_count_for_case
+from ntfs_hash import copy_and_hash
+from ntfs_pcap import capture_extension, capture_compression, CAPTURE_EXTENSIONS, COMPRESSED_EXTENSIONS
+from ntfs_store import new_store_writer, store_consumer, store_close, STORE_EXTENSION
+
+def open_pcap_output(connection, case_name, organization_name, output_folder="outputs", extension=".pcap"):
+    # Files are numbered after the case's pcap count, and created exclusively so
+    # captures running at the same time never write to the same file
+    pcap_count = get_pcap_count_for_case(connection, case_name)
+    while True:
+        pcap_count += 1
+        output_file = os.path.join(output_folder, f"{organization_name}-{case_name}-{pcap_count}{extension}")
+        try:
+            return output_file, open(output_file, 'xb')
+        except FileExistsError:
+            continue
 
 def execute_tcpdump(command, connection, case_id):
     parser = argparse.ArgumentParser(description="Packet capture utility using tcpdump")
     parser.add_argument("-c", "--count", type=int, help="Number of packets to capture", required=True)
     parser.add_argument("-i", "--interface", help="Interface to capture packets from")
+    parser.add_argument("--live", action="store_true", help="Analyze packets while they are captured")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        help="Keep the capture in the compressed evidence store")
     parser.add_argument("target", nargs="+", help="Target specification (e.g., src host 192.168.1.1)")
     args = parser.parse_args(command.split()[1:])
     
-    capture_packets(args.count, case_id, args.interface, " ".join(args.target), connection)
+    capture_packets(args.count, case_id, args.interface, " ".join(args.target), connection, args.live,
+                    args.compress)
 
-def capture_packets(packet_count, case_id, interface=None, target=None, connection=None):
+def capture_packets(packet_count, case_id, interface=None, target=None, connection=None, live=False,
+                    compress=False):
     output_folder = "outputs"
     
     # Retrieve case details
@@ -23,17 +44,13 @@ def capture_packets(packet_count, case_id, interface=None, target=None, connecti
         print("Invalid case ID.")
         return
 
-    case_name, organization_name, _ = case_details
-
-    # Get the pcap file count for naming
-    pcap_count = get_pcap_count_for_case(connection, case_name) + 1
-    output_filename = f"{organization_name}-{case_name}-{pcap_count}.pcap"
-    output_file = os.path.join(output_folder, output_filename)
-
-    # Setting timeout for 10 seconds
-    timeout = 10
+    case_name, organization_name, _, _ = case_details
 
-    command = ["tcpdump", "-c", str(packet_count), "-G", str(timeout), "-w", output_file]
+    # tcpdump writes the capture to stdout so it can be hashed while it is saved
+    command = ["tcpdump", "-c", str(packet_count), "-w", "-"]
+    if live:
+        # Write every packet out as soon as it is captured instead of when the buffer fills
+        command.append("-U")
 
     if interface:
         command.extend(["-i", interface])
@@ -41,24 +58,53 @@ def capture_packets(packet_count, case_id, interface=None, target=None, connecti
     if target:
         command.extend([target])
 
+    live_state = consumer = None
+    if live:
+        from ntfs_live import new_live_state, feed_live_capture, finish_live_capture
+        live_state = new_live_state()
+        consumer = lambda block: feed_live_capture(live_state, block)
+
+    output_file, f = open_pcap_output(connection, case_name, organization_name, output_folder,
+                                      ".pcap" + STORE_EXTENSION if compress else ".pcap")
     try:
-        # Execute the command, capturing the output
-        subprocess.check_output(command, stderr=subprocess.STDOUT)
+        with tempfile.TemporaryFile() as errors, f:
+            destination = f
+            if compress:
+                # Compressed on the way to disk; the hashes are still those of the pcap
+                writer = new_store_writer(f)
+                destination, consumer = None, store_consumer(writer, consumer)
+            # Unbuffered so the live analysis sees packets as soon as tcpdump writes them
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors, bufsize=0 if live else -1)
+            file_hashes = copy_and_hash(process.stdout, destination, consumer)
+            process.stdout.close()
+            if compress:
+                store_close(writer)
+            if process.wait() != 0:
+                errors.seek(0)
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=errors.read())
 
         print(f"{packet_count} packets captured successfully and saved to {output_file}")
 
         # Insert the pcap file path into the database with reference to the case
-        insert_pcap_file(connection, case_name, output_file, 'collected')
+        insert_pcap_file(connection, case_name, output_file, 'collected', file_hashes)
+
+        if live:
+            finish_live_capture(live_state, connection, case_name, organization_name, output_file, file_hashes)
+        return output_file, file_hashes
     except subprocess.CalledProcessError as e:
         print("Error capturing packets:", e)
+        if e.stderr:
+            print(e.stderr.decode('utf-8', 'replace').strip())
 
-def import_pcap_file(file_location, connection, case_id):
+def import_pcap_file(file_location, connection, case_id, compress=False):
     output_folder = "outputs"
     filename = os.path.basename(file_location)
     
     # Validate file extension
-    if not filename.lower().endswith('.pcap'):
-        print("Error: Invalid file format. Only pcap files are allowed.")
+    extension = capture_extension(filename)
+    if not extension:
+        print(f"Error: Invalid file format. Only {', '.join(CAPTURE_EXTENSIONS)} files are allowed, "
+              f"optionally compressed ({', '.join(COMPRESSED_EXTENSIONS)}).")
         return
 
     # Retrieve case details
@@ -69,18 +115,31 @@ def import_pcap_file(file_location, connection, case_id):
 
     case_name, organization_name, _, _ = case_details
 
-    # Get the pcap file count for naming
-    pcap_count = get_pcap_count_for_case(connection, case_name) + 1
-    output_filename = f"{organization_name}-{case_name}-{pcap_count}.pcap"
-    output_file = os.path.join(output_folder, output_filename)
-
     try:
-        # Copy the file to the outputs folder
-        shutil.copy2(file_location, output_file)
+        if compress and capture_compression(file_location):
+            # Recompressing would lose the hash of the file as it was handed over
+            print(f"File '{filename}' is already compressed, importing it as is.")
+            compress = False
+        # Copy the file to the outputs folder, hashing it in the same pass
+        with open(file_location, 'rb') as source:
+            # Imported as is, compressed files stay compressed
+            output_file, destination = open_pcap_output(connection, case_name, organization_name, output_folder,
+                                                        extension + STORE_EXTENSION if compress else extension)
+            with destination:
+                if compress:
+                    writer = new_store_writer(destination)
+                    file_hashes = copy_and_hash(source, consumer=store_consumer(writer))
+                    store_close(writer)
+                else:
+                    file_hashes = copy_and_hash(source, destination)
+        shutil.copystat(file_location, output_file)
         print(f"File '{filename}' imported successfully!")
+        print(f"MD5: {file_hashes['md5']}")
+        print(f"SHA-256: {file_hashes['sha256']}")
 
         # Insert the pcap file path into the database with reference to the case
-        insert_pcap_file(connection, case_name, output_file, 'imported')
+        insert_pcap_file(connection, case_name, output_file, 'imported', file_hashes)
+        return output_file, file_hashes
     except FileNotFoundError:
         print(f"File '{filename}' not found!")
     except Exception as e:
@@ -0,0 +1,395 @@
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import os
+import re
+import sys
+
+from ntfs_arguments import (
+    add_analyze_arguments,
+    analyze_arguments_error,
+    add_import_arguments,
+    add_file_selection_arguments,
+    file_selection_error,
+    add_packet_filter_arguments,
+    add_rotation_arguments,
+)
+from ntfs_data import (
+    create_connection,
+    create_tables,
+    get_existing_cases,
+    get_registration_id_by_name,
+    insert_registration,
+    get_case_details_by_id,
+    get_pcap_files_for_case,
+    iter_pcap_analysis_for_case,
+    iter_case_source_sketches,
+    get_analysis_verdicts,
+    get_case_column_stores,
+)
+
+# Non-interactive commands for scripts: `python ntfs_tool.py <command> ...`
+# prints one JSON document on stdout, the tool's usual messages go to stderr.
+# Modules that pull in numpy, tabulate or reportlab are imported by the
+# commands that need them, so `list` only pays for sqlite3.
+
+LIST_ANALYSIS_COLUMNS = ['id', 'pcap_file_name', 'analysis_date', 'total_packets', 'syn_ack_ratio',
+                         'syn_ack_message', 'proportionality_message', 'file_hash', 'distinct_sources',
+                         'distinct_networks']
+
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+ALERT_COLOR = "\033[91m"
+
+
+def plain_message(message):
+    return ANSI_ESCAPE.sub("", message or "")
+
+
+def alert_messages(*messages):
+    # The ratio checks print attack verdicts in red
+    return [plain_message(message) for message in messages if message and message.startswith(ALERT_COLOR)]
+
+
+class CommandError(Exception):
+    pass
+
+
+def find_case(connection, case_name):
+    case_id = get_registration_id_by_name(connection, case_name)
+    if not case_id:
+        raise CommandError(f"Case not found: {case_name}")
+    return case_id
+
+
+def case_record(case_id, case_details):
+    case_name, organization, investigator_name, date = case_details
+    return {'id': case_id, 'name': case_name, 'organization': organization,
+            'investigator': investigator_name, 'date': str(date)}
+
+
+def pcap_file_record(file_path, file_hashes):
+    return {'file': file_path, 'md5': file_hashes['md5'], 'sha256': file_hashes['sha256']}
+
+
+def run_register(args, connection):
+    if get_registration_id_by_name(connection, args.name):
+        raise CommandError(f"Case name already exists: {args.name}")
+    case_id = insert_registration(connection, args.name, args.org, args.investigator, datetime.date.today())
+    if not case_id:
+        raise CommandError("Failed to register the case.")
+    return {'case': case_record(case_id, get_case_details_by_id(connection, case_id))}
+
+
+def run_import(args, connection):
+    from ntfs_capture import import_pcap_file
+    case_id = find_case(connection, args.case)
+    imported = []
+    failed = []
+    for file_location in args.files:
+        result = import_pcap_file(file_location, connection, case_id, args.compress)
+        if result:
+            imported.append(pcap_file_record(*result))
+        else:
+            failed.append(file_location)
+    return {'imported': imported, 'failed': failed}
+
+
+def run_capture(args, connection):
+    from ntfs_capture import capture_packets
+    case_id = find_case(connection, args.case)
+    result = capture_packets(args.count, case_id, args.interface, " ".join(args.target) or None, connection,
+                             args.live, args.compress)
+    if not result:
+        raise CommandError("Capture failed.")
+    return {'captured': pcap_file_record(*result)}
+
+
+def run_rotate(args, connection):
+    from ntfs_rotation import capture_jobs_from_args, run_capture_jobs
+    case_id = find_case(connection, args.case)
+    jobs = capture_jobs_from_args(args)
+    if not jobs:
+        raise CommandError("Invalid capture options.")
+    registered = run_capture_jobs(connection, case_id, jobs, args.seconds, args.size, args.files, args.max_disk,
+                                  args.duration, args.compress)
+    return {'captured': [pcap_file_record(*segment) for segment in registered or []]}
+
+
+def analysis_record(pcap_filename, analysis_details):
+    from ntfs_engine import COUNTER_NAMES, TOP_IPS_LIMIT
+    record = {'pcap_file': pcap_filename, 'cached': 'id' in analysis_details}
+    record.update((name, analysis_details[name]) for name in COUNTER_NAMES)
+    record['syn_ack_ratio'] = analysis_details['syn_ack_ratio']
+    record['syn_ack_message'] = plain_message(analysis_details['syn_ack_feedback'])
+    record['proportionality_message'] = plain_message(analysis_details['proportionality_message'])
+    record['alerts'] = alert_messages(analysis_details['syn_ack_feedback'],
+                                      analysis_details['proportionality_message'])
+    record['top_ips'] = [{'ip': ip, 'packets': packets, 'bytes': byte_count}
+                         for ip, direction, packets, byte_count in analysis_details.get('talkers', [])
+                         if direction == 'source'][:TOP_IPS_LIMIT]
+    record['flow_count'] = analysis_details['flow_count']
+    record['half_open_count'] = analysis_details['half_open_count']
+    record['half_open_targets'] = [{'ip': ip, 'half_open': half_open, 'handshakes': handshakes}
+                                   for ip, role, half_open, handshakes in analysis_details.get('half_open_hosts', [])
+                                   if role == 'target'][:TOP_IPS_LIMIT]
+    record['source_diversity'] = diversity_record(analysis_details.get('source_diversity'))
+    record['verdicts'] = analysis_details.get('verdicts', [])
+    return record
+
+
+def case_diversity_record(connection, case_name):
+    # Sketches of every analysis of the case merged; numpy is only loaded for
+    # a case that has some
+    blobs = iter_case_source_sketches(connection, case_name)
+    first = next(blobs, None)
+    if first is None:
+        return None
+    from ntfs_hll import distinct_from_blob, merged_distinct_summary
+    return diversity_record(merged_distinct_summary(map(distinct_from_blob, itertools.chain([first], blobs))))
+
+
+def diversity_record(diversity):
+    from ntfs_hll import classify_sources
+    if not diversity:
+        return None
+    return {'sources': diversity['sources'], 'networks': diversity['networks'],
+            'destinations': [{'ip': ip, 'sources': sources, 'networks': networks,
+                              'traffic': classify_sources(sources, networks)}
+                             for ip, sources, networks in diversity['destinations']]}
+
+
+def run_analyze(args, connection):
+    from ntfs_analysis import resolve_pcap_filenames, analyze_pcap_files
+    error = analyze_arguments_error(args)
+    if error:
+        raise CommandError(error)
+    case_id = find_case(connection, args.case)
+    pcap_filenames = resolve_pcap_filenames(args, connection, case_id)
+    if not pcap_filenames:
+        raise CommandError("No pcap files to analyze.")
+    results = analyze_pcap_files(pcap_filenames, connection, case_id, jobs=args.jobs, workers=args.workers,
+                                 use_cache=not args.force, bucket_seconds=args.bucket, columns=args.columns,
+                                 incremental=args.incremental) or []
+    analyses = [analysis_record(pcap_filename, analysis_details) for pcap_filename, analysis_details in results]
+    analyzed = {analysis['pcap_file'] for analysis in analyses}
+    return {'analyses': analyses, 'failed': [name for name in pcap_filenames if name not in analyzed]}
+
+
+def run_store(args, connection):
+    from ntfs_analysis import resolve_pcap_filenames
+    from ntfs_store import store_pcap_files
+    error = file_selection_error(args)
+    if error:
+        raise CommandError(error)
+    case_id = find_case(connection, args.case)
+    pcap_filenames = resolve_pcap_filenames(args, connection, case_id)
+    stored, failed = store_pcap_files(connection, case_id, pcap_filenames)
+    return {'stored': [pcap_file_record(*result) for result in stored], 'failed': failed}
+
+
+def run_verify(args, connection):
+    from ntfs_store import verify_pcap_files
+    case_id = find_case(connection, args.case)
+    results = [{'file': file_path, 'result': result} for file_path, result in verify_pcap_files(connection, case_id)]
+    return {'files': results, 'failed': [record['file'] for record in results
+                                         if record['result'] in ('mismatch', 'missing')]}
+
+
+def packet_record(number, packet, format_address):
+    record = {'number': number + 1, 'time': datetime.datetime.fromtimestamp(packet['ts']).isoformat(),
+              'length': int(packet['wirelen'])}
+    if packet['ip_version']:
+        record.update(src=format_address(packet['src']), dst=format_address(packet['dst']), proto=int(packet['proto']))
+    if packet['has_ports']:
+        record.update(sport=int(packet['sport']), dport=int(packet['dport']))
+    if packet['has_flags']:
+        record['tcp_flags'] = int(packet['tcp_flags'])
+    return record
+
+
+def run_packets(args, connection):
+    from ntfs_index import open_packet_index, filter_packet_index, read_indexed_columns
+    from ntfs_reader import format_address
+    find_case(connection, args.case)
+    pcap_file_path = os.path.join('outputs', args.filename)
+    if not os.path.isfile(pcap_file_path):
+        raise CommandError(f"File does not exist: {args.filename}")
+    if args.offset < 0 or args.limit < 0:
+        raise CommandError("--offset and --limit cannot be negative.")
+    try:
+        index = open_packet_index(pcap_file_path)
+        numbers = filter_packet_index(index, args.src, args.dst, args.host, args.port, args.proto, args.start,
+                                      args.end)
+        page = numbers[args.offset:args.offset + args.limit]
+        columns = read_indexed_columns(pcap_file_path, index, page)
+    except ValueError as e:
+        raise CommandError(str(e))
+    return {'file': args.filename, 'matched': len(numbers), 'offset': args.offset,
+            'packets': [packet_record(int(number), packet, format_address)
+                        for number, packet in zip(page.tolist(), columns)]}
+
+
+def run_query(args, connection):
+    from ntfs_columns import query_case_columns
+    from ntfs_index import parse_capture_time
+    case_id = find_case(connection, args.case)
+    case_name = get_case_details_by_id(connection, case_id)[0]
+    stores = get_case_column_stores(connection, case_name)
+    if not stores:
+        raise CommandError("No column stores for this case, analyze its files with --columns first.")
+    try:
+        # Times of day are on the date of the case's first packet
+        first_ts = min((store[2] for store in stores if store[2] is not None), default=None)
+        start = parse_capture_time(args.start, first_ts) if args.start else None
+        end = parse_capture_time(args.end, first_ts) if args.end else None
+        result = query_case_columns(get_case_column_stores(connection, case_name, start, end), args.group_by, start,
+                                    end, args.host, args.net, args.port, args.proto, args.limit)
+    except ValueError as e:
+        raise CommandError(str(e))
+    result['groups'] = [{args.group_by: key, 'packets': packets, 'bytes': byte_count}
+                        for key, packets, byte_count in result['groups']]
+    return {'case': case_name, 'group_by': args.group_by, **result}
+
+
+def run_report(args, connection):
+    from ntfs_report import generate_pdf_report
+    case_id = find_case(connection, args.case)
+    case_details = get_case_details_by_id(connection, case_id)
+    pdf_file = generate_pdf_report(case_details, get_pcap_files_for_case(connection, case_details[0]), connection)
+    if not pdf_file:
+        raise CommandError("Failed to generate the report.")
+    return {'report': os.path.abspath(pdf_file)}
+
+
+def run_list(args, connection):
+    if not args.case:
+        return {'cases': [case_record(row[0], row[1:]) for row in get_existing_cases(connection)]}
+
+    case_id = find_case(connection, args.case)
+    case_details = get_case_details_by_id(connection, case_id)
+    pcap_files = [{'file': file_path, 'date': date, 'status': status}
+                  for file_path, date, status in get_pcap_files_for_case(connection, case_details[0])]
+    analyses = []
+    for analysis in iter_pcap_analysis_for_case(connection, case_details[0], LIST_ANALYSIS_COLUMNS):
+        analysis['alerts'] = alert_messages(analysis['syn_ack_message'], analysis['proportionality_message'])
+        analysis['syn_ack_message'] = plain_message(analysis['syn_ack_message'])
+        analysis['proportionality_message'] = plain_message(analysis['proportionality_message'])
+        analysis['verdicts'] = get_analysis_verdicts(connection, analysis['id'])
+        analyses.append(analysis)
+    return {'case': case_record(case_id, case_details), 'pcap_files': pcap_files, 'analyses': analyses,
+            'source_diversity': case_diversity_record(connection, case_details[0])}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="ntfs_tool.py",
+                                     description="Network forensic tool, run without a command for the menu")
+    parser.add_argument("--db", default="ntfs.db", help="SQLite database of the cases")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Only print the JSON result")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    register = commands.add_parser("register", help="Register a case")
+    register.add_argument("name", help="Case name")
+    register.add_argument("--org", required=True, help="Organization")
+    register.add_argument("--investigator", required=True, help="Investigator name")
+    register.set_defaults(run=run_register)
+
+    import_files = commands.add_parser("import", help="Import pcap files into a case")
+    import_files.add_argument("--case", required=True, help="Case name")
+    add_import_arguments(import_files)
+    import_files.set_defaults(run=run_import)
+
+    capture = commands.add_parser("capture", help="Capture packets with tcpdump into a case")
+    capture.add_argument("--case", required=True, help="Case name")
+    capture.add_argument("-c", "--count", type=int, required=True, help="Number of packets to capture")
+    capture.add_argument("-i", "--interface", help="Interface to capture packets from")
+    capture.add_argument("--live", action="store_true", help="Analyze packets while they are captured")
+    capture.add_argument("-z", "--compress", action="store_true",
+                         help="Keep the capture in the compressed evidence store")
+    capture.add_argument("target", nargs="*", help="Target specification (e.g., src host 192.168.1.1)")
+    capture.set_defaults(run=run_capture)
+
+    rotate = commands.add_parser("rotate", help="Capture on several interfaces at once into rotating files")
+    rotate.add_argument("--case", required=True, help="Case name")
+    add_rotation_arguments(rotate)
+    rotate.set_defaults(run=run_rotate)
+
+    analyze = commands.add_parser("analyze", help="Analyze pcap files of a case")
+    analyze.add_argument("--case", required=True, help="Case name")
+    add_analyze_arguments(analyze)
+    analyze.set_defaults(run=run_analyze)
+
+    store = commands.add_parser("store", help="Move pcap files of a case into the compressed evidence store")
+    store.add_argument("--case", required=True, help="Case name")
+    add_file_selection_arguments(store, "Store")
+    store.set_defaults(run=run_store)
+
+    verify = commands.add_parser("verify", help="Check the files of a case against their recorded hashes")
+    verify.add_argument("--case", required=True, help="Case name")
+    verify.set_defaults(run=run_verify)
+
+    packets = commands.add_parser("packets", help="Packets of a pcap file, found through its packet index")
+    packets.add_argument("--case", required=True, help="Case name")
+    packets.add_argument("filename", help="Pcap file name in the outputs folder")
+    add_packet_filter_arguments(packets, 100)
+    packets.set_defaults(run=run_packets)
+
+    query = commands.add_parser("query", help="Packets and bytes across the column stores of a case, grouped")
+    query.add_argument("--case", required=True, help="Case name")
+    # Same choices as ntfs_columns.GROUP_KEYS, not imported to keep numpy out of startup
+    query.add_argument("--group-by", required=True, choices=('src', 'dst', 'sport', 'dport', 'proto', 'minute'),
+                       help="What packets and bytes are summed by")
+    query.add_argument("--host", help="Packets from or to this IP address")
+    query.add_argument("--net", help="Packets from or to this network, e.g. 10.1.0.0/16")
+    query.add_argument("--port", type=int, help="Packets from or to this port")
+    query.add_argument("--proto", help="IP protocol, by name (tcp, udp, icmp) or number")
+    query.add_argument("--start", help="First time, as epoch seconds, ISO date and time or HH:MM[:SS]")
+    query.add_argument("--end", help="Time before which packets are counted, same formats as --start")
+    query.add_argument("--limit", type=int, default=20, help="Groups listed")
+    query.set_defaults(run=run_query)
+
+    report = commands.add_parser("report", help="Generate the PDF report of a case")
+    report.add_argument("--case", required=True, help="Case name")
+    report.set_defaults(run=run_report)
+
+    list_cases = commands.add_parser("list", help="List cases, or the files and analyses of one case")
+    list_cases.add_argument("--case", help="Case name")
+    list_cases.set_defaults(run=run_list)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    messages = open(os.devnull, 'w') if args.quiet else sys.stderr
+    status = 0
+    try:
+        with contextlib.redirect_stdout(messages):
+            connection = create_connection(args.db)
+            if connection is None:
+                raise CommandError(f"Cannot open database {args.db}")
+            try:
+                create_tables(connection)
+                result = args.run(args, connection)
+            finally:
+                connection.close()
+    except CommandError as e:
+        result = {'error': str(e)}
+        status = 1
+    except Exception as e:
+        # Unexpected failures are reported in the same shape, not as a traceback
+        result = {'error': f"{type(e).__name__}: {e}"}
+        status = 1
+    finally:
+        if args.quiet:
+            messages.close()
+
+    # Files that could not be imported or analyzed fail the command too
+    if result.get('failed'):
+        status = 1
+    print(json.dumps(result, indent=2))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+import datetime
+import ipaddress
+import os
+import shutil
+
+import numpy as np
+
+from ntfs_reader import PACKET_DTYPE, IPV4_MAPPED_PREFIX, format_address, iter_capture_columns
+from ntfs_index import address_key, protocol_number
+from ntfs_sketch import unique_keys
+
+# Saved with every column store; bump it whenever its layout changes
+COLUMNS_VERSION = 1
+COLUMNS_SUFFIX = '.cols'
+# Packet columns kept, as the reader decodes them
+STORE_COLUMNS = ('ts', 'src', 'dst', 'sport', 'dport', 'proto', 'tcp_flags', 'wirelen')
+# Every zone of this many rows has its first and last timestamp recorded, so
+# a time range only reads the zones that overlap it
+ZONE_ROWS = 1 << 16
+# What query results can be grouped by
+GROUP_KEYS = ('src', 'dst', 'sport', 'dport', 'proto', 'minute')
+QUERY_GROUPS_LIMIT = 20
+
+
+# Column store of a capture: one uncompressed .npy file per packet column in
+# a hidden directory next to the capture, written from the columns of the
+# analysis pass. Files are memory-mapped when queried, so a query only reads
+# the columns it needs and, within them, the zones of its time range. Stores
+# are registered per case in the database, with the time span of the capture,
+# so captures outside a time range are not opened at all.
+def column_store_path(pcap_file):
+    directory, name = os.path.split(pcap_file)
+    return os.path.join(directory, f".{name}{COLUMNS_SUFFIX}")
+
+
+def new_column_store():
+    return {name: [] for name in STORE_COLUMNS}
+
+
+def column_store_update(store, columns):
+    for name in STORE_COLUMNS:
+        store[name].append(columns[name].copy())
+
+
+def merge_column_stores(first, second):
+    # `second` holds the packets right after those of `first`
+    return {name: first[name] + second[name] for name in STORE_COLUMNS}
+
+
+def save_column_store(pcap_file, store):
+    # Returns what ntfs_data registers: packets and time span of the capture
+    arrays = {name: np.concatenate(store[name]) if store[name] else np.zeros(0, dtype=PACKET_DTYPE[name])
+              for name in STORE_COLUMNS}
+    ts = arrays['ts']
+    starts = np.arange(0, len(ts), ZONE_ROWS)
+    zones = np.zeros((len(starts), 2), dtype=np.float64)
+    if len(ts):
+        zones[:, 0] = np.minimum.reduceat(ts, starts)
+        zones[:, 1] = np.maximum.reduceat(ts, starts)
+    file_stat = os.stat(pcap_file)
+    # The store is only used while the capture keeps this size and mtime
+    arrays['meta'] = np.array([COLUMNS_VERSION, file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64)
+    arrays['zones'] = zones
+
+    path = column_store_path(pcap_file)
+    temp_path = path + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(temp_path, name + '.npy'), array)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temp_path, path)
+    return {
+        'packets': len(ts),
+        'first_ts': float(ts.min()) if len(ts) else None,
+        'last_ts': float(ts.max()) if len(ts) else None,
+        'file_size': file_stat.st_size,
+        'file_mtime': file_stat.st_mtime_ns,
+    }
+
+
+def build_column_store(pcap_file):
+    # For captures analyzed without one, or taken from the analysis cache
+    store = new_column_store()
+    for columns in iter_capture_columns(pcap_file):
+        column_store_update(store, columns)
+    return save_column_store(pcap_file, store)
+
+
+def column_store_info(pcap_file):
+    # What save_column_store returned for the capture's store, None when the
+    # capture has no store or changed since it was written
+    path = column_store_path(pcap_file)
+    try:
+        meta = np.load(os.path.join(path, 'meta.npy'))
+        zones = np.load(os.path.join(path, 'zones.npy'))
+        packets = len(np.load(os.path.join(path, 'ts.npy'), mmap_mode='r'))
+        file_stat = os.stat(pcap_file)
+    except (OSError, ValueError):
+        return None
+    if meta.tolist() != [COLUMNS_VERSION, file_stat.st_size, file_stat.st_mtime_ns]:
+        return None
+    return {
+        'packets': packets,
+        'first_ts': float(zones[:, 0].min()) if len(zones) else None,
+        'last_ts': float(zones[:, 1].max()) if len(zones) else None,
+        'file_size': file_stat.st_size,
+        'file_mtime': file_stat.st_mtime_ns,
+    }
+
+
+def column_store_is_current(pcap_file):
+    return column_store_info(pcap_file) is not None
+
+
+def remove_column_store(pcap_file):
+    shutil.rmtree(column_store_path(pcap_file), ignore_errors=True)
+
+
+def move_column_store(pcap_file, new_pcap_file):
+    # The capture was moved with the same packets, e.g. into the evidence
+    # store: its store follows it, tied to the size and mtime of the new file.
+    # Returns column_store_info of the moved store
+    path = column_store_path(new_pcap_file)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(column_store_path(pcap_file), path)
+    file_stat = os.stat(new_pcap_file)
+    np.save(os.path.join(path, 'meta.npy'),
+            np.array([COLUMNS_VERSION, file_stat.st_size, file_stat.st_mtime_ns], dtype=np.int64))
+    return column_store_info(new_pcap_file)
+
+
+def scan_column_store(pcap_file, names, start=None, end=None):
+    # {name: array} of the rows with start <= ts < end, only the zones of the
+    # range read from the memory-mapped columns
+    path = column_store_path(pcap_file)
+    ts = np.load(os.path.join(path, 'ts.npy'), mmap_mode='r')
+    zones = np.load(os.path.join(path, 'zones.npy'))
+    keep = np.ones(len(zones), dtype=bool)
+    if start is not None:
+        keep &= zones[:, 1] >= start
+    if end is not None:
+        keep &= zones[:, 0] < end
+    ranges = [(i * ZONE_ROWS, min((i + 1) * ZONE_ROWS, len(ts))) for i in np.flatnonzero(keep).tolist()]
+
+    rows = None
+    if start is not None or end is not None:
+        zone_ts = np.concatenate([ts[first:last] for first, last in ranges]) if ranges else np.zeros(0)
+        rows = np.ones(len(zone_ts), dtype=bool)
+        if start is not None:
+            rows &= zone_ts >= start
+        if end is not None:
+            rows &= zone_ts < end
+    arrays = {}
+    for name in names:
+        column = ts if name == 'ts' else np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        if ranges:
+            values = np.concatenate([column[first:last] for first, last in ranges])
+        else:
+            values = np.zeros(0, dtype=column.dtype)
+        arrays[name] = values if rows is None else values[rows]
+    return arrays
+
+
+def iter_case_columns(stores, names, start=None, end=None):
+    # Yields (pcap_filename, arrays) for every current store of `stores`,
+    # rows of ntfs_data.get_case_column_stores, and (pcap_filename, None) for
+    # the captures that changed since their store was written
+    for pcap_filename, _, _, _ in stores:
+        pcap_file = os.path.join('outputs', pcap_filename)
+        if not column_store_is_current(pcap_file):
+            yield pcap_filename, None
+            continue
+        yield pcap_filename, scan_column_store(pcap_file, names, start, end)
+
+
+def _address_words(addresses):
+    return np.ascontiguousarray(addresses).view('>u8').reshape(-1, 2)
+
+
+def network_mask(addresses, network):
+    # Addresses in an IPv4 or IPv6 network given as text, e.g. 10.1.0.0/16
+    network = ipaddress.ip_network(network, strict=False)
+    if network.version == 4:
+        raw = IPV4_MAPPED_PREFIX + network.network_address.packed
+        prefix = network.prefixlen + 96
+    else:
+        raw = network.network_address.packed
+        prefix = network.prefixlen
+    wanted = np.frombuffer(raw, dtype='>u8').astype(np.uint64)
+    words = _address_words(addresses).astype(np.uint64)
+    mask = np.ones(len(addresses), dtype=bool)
+    for i in range(2):
+        bits = min(max(prefix - 64 * i, 0), 64)
+        if bits:
+            word_mask = np.uint64(((1 << bits) - 1) << (64 - bits))
+            mask &= words[:, i] & word_mask == wanted[i] & word_mask
+    return mask
+
+
+def filter_columns(arrays, host=None, net=None, port=None, proto=None):
+    # Rows matching every condition given; `host` and `net` match either end,
+    # `port` either port
+    mask = np.ones(len(arrays['ts']), dtype=bool)
+    if host is not None:
+        key = address_key(host)
+        mask &= (arrays['src'] == key) | (arrays['dst'] == key)
+    if net is not None:
+        mask &= network_mask(arrays['src'], net) | network_mask(arrays['dst'], net)
+    if port is not None:
+        mask &= (arrays['sport'] == port) | (arrays['dport'] == port)
+    if proto is not None:
+        mask &= arrays['proto'] == protocol_number(proto)
+    return mask
+
+
+def _group_values(arrays, group_by):
+    if group_by == 'minute':
+        return (arrays['ts'] // 60).astype(np.int64) * 60
+    return arrays[group_by]
+
+
+def _group_label(group_by, key):
+    if group_by in ('src', 'dst'):
+        return format_address(key)
+    if group_by == 'minute':
+        return datetime.datetime.fromtimestamp(int(key)).isoformat()
+    return int(key)
+
+
+def query_case_columns(stores, group_by, start=None, end=None, host=None, net=None, port=None, proto=None,
+                       limit=QUERY_GROUPS_LIMIT):
+    # Packets and bytes of the matching rows of every store, per value of
+    # `group_by`: {'files', 'stale', 'packets', 'bytes', 'groups': [(label,
+    # packets, bytes)]}, most bytes first, or in time order by minute
+    if group_by not in GROUP_KEYS:
+        raise ValueError(f"Unknown group: {group_by}")
+    names = {'ts', 'wirelen'}
+    if group_by != 'minute':
+        names.add(group_by)
+    if host is not None or net is not None:
+        names.update(('src', 'dst'))
+    if port is not None:
+        names.update(('sport', 'dport'))
+    if proto is not None:
+        names.add('proto')
+
+    result = {'files': [], 'stale': [], 'packets': 0, 'bytes': 0, 'groups': []}
+    parts = []
+    for pcap_filename, arrays in iter_case_columns(stores, sorted(names), start, end):
+        if arrays is None:
+            result['stale'].append(pcap_filename)
+            continue
+        result['files'].append(pcap_filename)
+        mask = filter_columns(arrays, host, net, port, proto)
+        values = _group_values(arrays, group_by)[mask]
+        wirelen = arrays['wirelen'][mask].astype(np.int64)
+        uniq, inverse = unique_keys(values)
+        parts.append((uniq, np.bincount(inverse, minlength=len(uniq)),
+                      np.bincount(inverse, weights=wirelen, minlength=len(uniq)).astype(np.int64)))
+    if not parts:
+        return result
+
+    uniq, inverse = unique_keys(np.concatenate([part[0] for part in parts]))
+    packets = np.bincount(inverse, weights=np.concatenate([part[1] for part in parts]), minlength=len(uniq))
+    byte_counts = np.bincount(inverse, weights=np.concatenate([part[2] for part in parts]), minlength=len(uniq))
+    result['packets'] = int(packets.sum())
+    result['bytes'] = int(byte_counts.sum())
+    if group_by == 'minute':
+        order = np.argsort(uniq, kind='stable')
+    else:
+        order = np.lexsort((-packets, -byte_counts))
+    result['groups'] = [(_group_label(group_by, uniq[i]), int(packets[i]), int(byte_counts[i]))
+                        for i in order[:limit].tolist()]
+    return result
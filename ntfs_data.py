@@ -1,16 +1,49 @@
+import ast
+import ipaddress
+import json
+import os
 import sqlite3
 from sqlite3 import Error
 from datetime import datetime
 
+# Bumped with every change to the schema, see migrate_schema
+SCHEMA_VERSION = 7
+
+# Rows fetched at a time when streaming analyses
+REPORT_PAGE_SIZE = 200
+
 def create_connection(db_file):
     try:
-        connection = sqlite3.connect(db_file)
+        # The rotating capture registers segments from its writer thread, one
+        # statement at a time while the caller waits, see ntfs_rotation
+        connection = sqlite3.connect(db_file, check_same_thread=False)
+        # Readers (reports, batch analysis) do not block the writer and commits
+        # only wait for the log, not for every page of the database file
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("PRAGMA temp_store=MEMORY")
         return connection
     except Error as e:
         print(e)
     return None
 
+# Brings the schema up to date; a database already at SCHEMA_VERSION costs a
+# single PRAGMA read
 def create_tables(connection):
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        with connection:
+            # One transaction, so an interrupted migration leaves the old schema
+            connection.execute("BEGIN")
+            migrate_schema(connection.cursor(), version)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        print("Tables created successfully.")
+    except Error as e:
+        print(e)
+
+def migrate_schema(cursor, version):
     create_registration_table_sql = """CREATE TABLE IF NOT EXISTS registration (
                                         id INTEGER PRIMARY KEY,
                                         CaseName TEXT NOT NULL,
@@ -48,59 +81,457 @@ def create_tables(connection):
                                             FOREIGN KEY (CaseName) REFERENCES registration(CaseName)
                                         );"""
 
-    try:
-        cursor = connection.cursor()
+    if version < 1:
         cursor.execute(create_registration_table_sql)
         cursor.execute(create_pcap_file_table_sql)
         cursor.execute(create_pcap_analysis_table_sql)
-        connection.commit()
-        print("Tables created successfully.")
-    except Error as e:
-        print(e)
+        # Columns added after the first release of the tool
+        add_missing_columns(cursor, 'pcap_file', [
+            ('md5', 'TEXT'),
+            ('sha256', 'TEXT'),
+            ('file_size', 'INTEGER'),
+            ('file_mtime', 'INTEGER'),
+        ])
+        add_missing_columns(cursor, 'pcap_analysis', [
+            ('analyzer_version', 'TEXT'),
+            ('file_size', 'INTEGER'),
+            ('file_mtime', 'INTEGER'),
+            ('file_sha256', 'TEXT'),
+            ('series_bucket', 'INTEGER'),
+            ('series', 'BLOB'),
+        ])
+        # Every lookup filters on one of these
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_registration_case ON registration (CaseName)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_file_case ON pcap_file (CaseName)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_file_path ON pcap_file (FilePath)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_case ON pcap_analysis (CaseName)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_file ON pcap_analysis (pcap_file_name)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_hash ON pcap_analysis (file_hash, analyzer_version)")
 
-def insert_pcap_file(connection, case_name, file_path, status='collected'):
-    sql_query = """INSERT INTO pcap_file (CaseName, FilePath, Date, Status) 
-                   VALUES (?, ?, DATE('now'), ?)"""
-    try:
-        cursor = connection.cursor()
-        cursor.execute(sql_query, (case_name, file_path, status))
-        connection.commit()
+    if version < 2:
+        # Talkers of an analysis, replacing the str() of a list kept in top_ips
+        cursor.execute("""CREATE TABLE IF NOT EXISTS pcap_analysis_ip (
+                              analysis_id INTEGER NOT NULL,
+                              ip TEXT NOT NULL,
+                              direction TEXT NOT NULL,
+                              packets INTEGER,
+                              bytes INTEGER,
+                              FOREIGN KEY (analysis_id) REFERENCES pcap_analysis(id)
+                          );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_ip_ip ON pcap_analysis_ip (ip)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_ip_analysis ON pcap_analysis_ip (analysis_id)")
+        migrate_legacy_top_ips(cursor)
+
+    if version < 3:
+        # TCP handshakes that never completed, by the host that was sent the SYN
+        # (target) and the one that sent it (source), see ntfs_flows
+        add_missing_columns(cursor, 'pcap_analysis', [
+            ('flow_count', 'INTEGER'),
+            ('half_open_count', 'INTEGER'),
+        ])
+        cursor.execute("""CREATE TABLE IF NOT EXISTS pcap_analysis_half_open (
+                              analysis_id INTEGER NOT NULL,
+                              ip TEXT NOT NULL,
+                              role TEXT NOT NULL,
+                              half_open INTEGER,
+                              handshakes INTEGER,
+                              FOREIGN KEY (analysis_id) REFERENCES pcap_analysis(id)
+                          );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_half_open_ip ON pcap_analysis_half_open (ip)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_half_open_analysis "
+                       "ON pcap_analysis_half_open (analysis_id)")
+
+    if version < 4:
+        # Estimated distinct sources and source /24s, and the HyperLogLog
+        # sketches they come from so analyses can be merged, see ntfs_hll
+        add_missing_columns(cursor, 'pcap_analysis', [
+            ('distinct_sources', 'INTEGER'),
+            ('distinct_networks', 'INTEGER'),
+            ('source_sketch', 'BLOB'),
+        ])
+
+    if version < 5:
+        # Verdicts of the detection rules, their evidence as JSON, see ntfs_rules
+        cursor.execute("""CREATE TABLE IF NOT EXISTS pcap_analysis_verdict (
+                              analysis_id INTEGER NOT NULL,
+                              rule TEXT NOT NULL,
+                              attack TEXT NOT NULL,
+                              severity TEXT NOT NULL,
+                              target TEXT,
+                              window_start REAL,
+                              window_end REAL,
+                              evidence TEXT,
+                              message TEXT,
+                              FOREIGN KEY (analysis_id) REFERENCES pcap_analysis(id)
+                          );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_verdict_analysis "
+                       "ON pcap_analysis_verdict (analysis_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_analysis_verdict_target ON pcap_analysis_verdict (target)")
+
+    if version < 6:
+        # Column stores of the captures of a case and the time span they
+        # cover, see ntfs_columns
+        cursor.execute("""CREATE TABLE IF NOT EXISTS pcap_column_store (
+                              id INTEGER PRIMARY KEY,
+                              CaseName TEXT NOT NULL,
+                              pcap_file_name TEXT NOT NULL,
+                              packets INTEGER,
+                              first_ts REAL,
+                              last_ts REAL,
+                              file_size INTEGER,
+                              file_mtime INTEGER,
+                              created DATE NOT NULL
+                          );""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_pcap_column_store_case ON pcap_column_store (CaseName, first_ts)")
+
+    if version < 7:
+        # State of the latest analysis of a pcap file and where in the file it
+        # stopped, so the next analysis of the grown file can go on from there
+        cursor.execute("""CREATE TABLE IF NOT EXISTS pcap_analysis_checkpoint (
+                              analysis_id INTEGER PRIMARY KEY,
+                              end_offset INTEGER NOT NULL,
+                              prefix_sha256 TEXT NOT NULL,
+                              state BLOB NOT NULL,
+                              FOREIGN KEY (analysis_id) REFERENCES pcap_analysis(id)
+                          );""")
+
+def legacy_talker_ip(text):
+    # top_ips of older analyses came from tcpdump output, as "ip" or "ip.port"
+    for candidate in (text, text.rpartition('.')[0]):
+        try:
+            return str(ipaddress.ip_address(candidate))
+        except ValueError:
+            continue
+    return None
+
+def migrate_legacy_top_ips(cursor):
+    cursor.execute("SELECT id, top_ips FROM pcap_analysis WHERE top_ips IS NOT NULL AND top_ips != 'None'")
+    rows = []
+    for analysis_id, top_ips in cursor.fetchall():
+        try:
+            talkers = ast.literal_eval(top_ips)
+        except (ValueError, SyntaxError):
+            continue
+        packets = {}
+        for text, count in talkers:
+            ip = legacy_talker_ip(str(text))
+            if ip:
+                packets[ip] = packets.get(ip, 0) + count
+        rows.extend((analysis_id, ip, 'source', count, None) for ip, count in packets.items())
+    cursor.executemany("INSERT INTO pcap_analysis_ip (analysis_id, ip, direction, packets, bytes) VALUES (?, ?, ?, ?, ?)",
+                       rows)
+
+def add_missing_columns(cursor, table_name, columns):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    for column_name, column_type in columns:
+        if column_name not in existing_columns:
+            cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+# file_hashes are the digests computed while the file was written, see ntfs_hash
+def insert_pcap_file(connection, case_name, file_path, status='collected', file_hashes=None):
+    if insert_pcap_files(connection, case_name, [(file_path, status, file_hashes)]):
         print("PCAP file inserted into the database successfully!")
+
+# Insert several (file_path, status, file_hashes) files with a single commit
+def insert_pcap_files(connection, case_name, pcap_files):
+    sql_query = """INSERT INTO pcap_file (CaseName, FilePath, Date, Status, md5, sha256, file_size, file_mtime) 
+                   VALUES (?, ?, DATE('now'), ?, ?, ?, ?, ?)"""
+    rows = []
+    for file_path, status, file_hashes in pcap_files:
+        file_hashes = file_hashes or {}
+        file_size = file_mtime = None
+        if file_hashes:
+            file_stat = os.stat(file_path)
+            file_size, file_mtime = file_stat.st_size, file_stat.st_mtime_ns
+        rows.append((case_name, file_path, status, file_hashes.get('md5'), file_hashes.get('sha256'),
+                     file_size, file_mtime))
+    try:
+        with connection:
+            connection.executemany(sql_query, rows)
+        return True
     except Error as e:
         print("Error inserting PCAP file:", e)
+        return False
+
+def update_pcap_file_status(connection, file_path, status):
+    try:
+        with connection:
+            connection.execute("UPDATE pcap_file SET Status=? WHERE FilePath=?", (status, file_path))
+    except Error as e:
+        print("Error updating PCAP file:", e)
+
+# The file was moved, e.g. into the compressed evidence store; its hashes are
+# those of the original content and stay as they are
+def update_pcap_file_path(connection, file_path, new_file_path):
+    file_stat = os.stat(new_file_path)
+    try:
+        with connection:
+            connection.execute("UPDATE pcap_file SET FilePath=?, file_size=?, file_mtime=? WHERE FilePath=?",
+                               (new_file_path, file_stat.st_size, file_stat.st_mtime_ns, file_path))
+    except Error as e:
+        print("Error updating PCAP file:", e)
 
 # Function to insert analysis details into the pcap_analysis table
 def insert_pcap_analysis(connection, case_name, org_name, pcap_filename, analysis_details, file_hash):
-    insert_pcap_analysis_sql = """INSERT INTO pcap_analysis (CaseName, org_name, pcap_file_name, total_packets, top_ips,
-                                    tcp_count, udp_count, http_count, syn_count, syn_ack_count, ack_count,
-                                    syn_without_ack_count, syn_ack_ratio, syn_ack_message, proportionality_message,
-                                    file_hash, analysis_date)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+    insert_pcap_analyses(connection, case_name, org_name, [(pcap_filename, analysis_details, file_hash)])
+
+ANALYSIS_COLUMNS = ('CaseName', 'org_name', 'pcap_file_name', 'total_packets', 'tcp_count', 'udp_count', 'http_count',
+                    'syn_count', 'syn_ack_count', 'ack_count', 'syn_without_ack_count', 'syn_ack_ratio',
+                    'syn_ack_message', 'proportionality_message', 'file_hash', 'analysis_date', 'analyzer_version',
+                    'file_size', 'file_mtime', 'file_sha256', 'series_bucket', 'series', 'flow_count',
+                    'half_open_count', 'distinct_sources', 'distinct_networks', 'source_sketch')
+
+# Values of ANALYSIS_COLUMNS for an analysis
+def analysis_row(case_name, org_name, pcap_filename, analysis_details, file_hash, analysis_date):
+    # numpy comes in with the series helpers, only loaded by the commands that store or read series
+    from ntfs_series import series_to_blob
+    from ntfs_hll import distinct_to_blob
+    series = analysis_details.get('series')
+    distinct = analysis_details.get('distinct')
+    diversity = analysis_details.get('source_diversity') or {}
+    return (
+        case_name,
+        org_name,
+        pcap_filename,
+        analysis_details.get('total_packets'),
+        analysis_details.get('tcp_count'),
+        analysis_details.get('udp_count'),
+        analysis_details.get('http_count'),
+        analysis_details.get('syn_count'),
+        analysis_details.get('syn_ack_count'),
+        analysis_details.get('ack_count'),
+        analysis_details.get('syn_without_ack_count'),
+        analysis_details.get('syn_ack_ratio'),
+        analysis_details.get('syn_ack_feedback'),
+        analysis_details.get('proportionality_message'),
+        file_hash,
+        analysis_date,
+        analysis_details.get('analyzer_version'),
+        analysis_details.get('file_size'),
+        analysis_details.get('file_mtime'),
+        analysis_details.get('file_sha256'),
+        analysis_details.get('series_bucket'),
+        series_to_blob(series) if series is not None else None,  # Whole series in one compressed blob
+        analysis_details.get('flow_count'),
+        analysis_details.get('half_open_count'),
+        diversity.get('sources'),
+        diversity.get('networks'),
+        distinct_to_blob(distinct) if distinct is not None else None,
+    )
+
+# Talkers, half-open hosts, verdicts and checkpoint of an analysis
+def insert_analysis_rows(connection, analysis_id, case_name, pcap_filename, analysis_details):
+    connection.executemany("""INSERT INTO pcap_analysis_ip (analysis_id, ip, direction, packets, bytes)
+                              VALUES (?, ?, ?, ?, ?);""",
+                           [(analysis_id,) + tuple(talker) for talker in analysis_details.get('talkers', [])])
+    connection.executemany("""INSERT INTO pcap_analysis_half_open (analysis_id, ip, role, half_open, handshakes)
+                              VALUES (?, ?, ?, ?, ?);""",
+                           [(analysis_id,) + tuple(host) for host in analysis_details.get('half_open_hosts', [])])
+    connection.executemany("""INSERT INTO pcap_analysis_verdict (analysis_id, rule, attack, severity, target,
+                                                                 window_start, window_end, evidence, message)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                           [verdict_row(analysis_id, verdict) for verdict in analysis_details.get('verdicts', [])])
+    # Only the latest analysis of a file is ever resumed, whether or not it
+    # has a checkpoint of its own
+    connection.execute("""DELETE FROM pcap_analysis_checkpoint WHERE analysis_id IN
+                          (SELECT id FROM pcap_analysis WHERE CaseName=? AND pcap_file_name=?)""",
+                       (case_name, pcap_filename))
+    if analysis_details.get('checkpoint'):
+        state, end_offset, prefix_sha256 = analysis_details['checkpoint']
+        connection.execute("""INSERT INTO pcap_analysis_checkpoint (analysis_id, end_offset, prefix_sha256, state)
+                              VALUES (?, ?, ?, ?)""", (analysis_id, end_offset, prefix_sha256, state))
+
+# Insert several (pcap_filename, analysis_details, file_hash) analyses with a
+# single commit; False if none was stored
+def insert_pcap_analyses(connection, case_name, org_name, analyses):
+    insert_pcap_analysis_sql = (f"INSERT INTO pcap_analysis ({', '.join(ANALYSIS_COLUMNS)}) "
+                                f"VALUES ({', '.join('?' * len(ANALYSIS_COLUMNS))});")
+    analysis_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Use datetime.now() to get current timestamp
+    rows = [analysis_row(case_name, org_name, pcap_filename, analysis_details, file_hash, analysis_date)
+            for pcap_filename, analysis_details, file_hash in analyses]
     try:
-        cursor = connection.cursor()
-        cursor.execute(insert_pcap_analysis_sql, (
-            case_name,
-            org_name,
-            pcap_filename,
-            analysis_details.get('total_packets'),
-            str(analysis_details.get('top_ips')),  # Convert list to string for storage
-            analysis_details.get('tcp_count'),
-            analysis_details.get('udp_count'),
-            analysis_details.get('http_count'),
-            analysis_details.get('syn_count'),
-            analysis_details.get('syn_ack_count'),
-            analysis_details.get('ack_count'),
-            analysis_details.get('syn_without_ack_count'),
-            analysis_details.get('syn_ack_ratio'),
-            analysis_details.get('syn_ack_feedback'),
-            analysis_details.get('proportionality_message'),
-            file_hash,
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Use datetime.now() to get current timestamp
-        ))
-        connection.commit()
+        with connection:
+            for row, (pcap_filename, analysis_details, _) in zip(rows, analyses):
+                analysis_id = connection.execute(insert_pcap_analysis_sql, row).lastrowid
+                insert_analysis_rows(connection, analysis_id, case_name, pcap_filename, analysis_details)
     except sqlite3.Error as e:
         print(f"Error inserting into pcap_analysis table: {e}")
+        return False
+    return True
+
+# Replace several (analysis_id, pcap_filename, analysis_details, file_hash)
+# analyses in place, e.g. resumed ones, with a single commit; False if none
+# was updated
+def update_pcap_analyses(connection, case_name, org_name, analyses):
+    update_pcap_analysis_sql = (f"UPDATE pcap_analysis SET {', '.join(f'{column}=?' for column in ANALYSIS_COLUMNS)} "
+                                f"WHERE id=?;")
+    analysis_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        with connection:
+            for analysis_id, pcap_filename, analysis_details, file_hash in analyses:
+                row = analysis_row(case_name, org_name, pcap_filename, analysis_details, file_hash, analysis_date)
+                connection.execute(update_pcap_analysis_sql, row + (analysis_id,))
+                for table in ('pcap_analysis_ip', 'pcap_analysis_half_open', 'pcap_analysis_verdict'):
+                    connection.execute(f"DELETE FROM {table} WHERE analysis_id=?", (analysis_id,))
+                insert_analysis_rows(connection, analysis_id, case_name, pcap_filename, analysis_details)
+    except sqlite3.Error as e:
+        print(f"Error updating pcap_analysis table: {e}")
+        return False
+    return True
+
+
+def verdict_row(analysis_id, verdict):
+    return (analysis_id, verdict['rule'], verdict['attack'], verdict['severity'], verdict['target'],
+            verdict['start'], verdict['end'], json.dumps(verdict['evidence']), verdict['message'])
+
 
+CACHED_ANALYSIS_COLUMNS = ("id, CaseName, total_packets, tcp_count, udp_count, http_count, syn_count, "
+                           "syn_ack_count, ack_count, syn_without_ack_count, syn_ack_ratio, syn_ack_message, "
+                           "proportionality_message, file_hash, series_bucket, series, flow_count, half_open_count, "
+                           "source_sketch")
+
+# (md5, sha256) recorded when the file was ingested or last analyzed, as long as
+# its size and mtime did not change since
+def get_known_file_hashes(connection, pcap_file_path, file_size, file_mtime):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT md5, sha256 FROM pcap_file
+                      WHERE FilePath=? AND file_size=? AND file_mtime=? AND md5 IS NOT NULL
+                      ORDER BY id DESC LIMIT 1""", (pcap_file_path, file_size, file_mtime))
+    row = cursor.fetchone()
+    if row:
+        return row
+    cursor.execute("""SELECT file_hash, file_sha256 FROM pcap_analysis
+                      WHERE pcap_file_name=? AND file_size=? AND file_mtime=? AND file_hash IS NOT NULL
+                      ORDER BY id DESC LIMIT 1""", (os.path.basename(pcap_file_path), file_size, file_mtime))
+    return cursor.fetchone()
+
+# Latest analysis of the same content by the same analyzer version and series
+# bucket, rows of the given case first
+def get_cached_pcap_analysis(connection, file_hash, analyzer_version, case_name, series_bucket):
+    cursor = connection.cursor()
+    cursor.execute(f"""SELECT {CACHED_ANALYSIS_COLUMNS} FROM pcap_analysis
+                       WHERE file_hash=? AND analyzer_version=? AND series_bucket=?
+                       ORDER BY CaseName=? DESC, id DESC LIMIT 1""",
+                   (file_hash, analyzer_version, series_bucket, case_name))
+    return cursor.fetchone()
+
+# [(ip, direction, packets, bytes)] of an analysis, busiest first
+def get_analysis_talkers(connection, analysis_id):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT ip, direction, packets, bytes FROM pcap_analysis_ip WHERE analysis_id=?
+                      ORDER BY direction DESC, packets IS NULL, packets DESC, bytes DESC""", (analysis_id,))
+    return cursor.fetchall()
+
+# [(ip, role, half_open, handshakes)] of an analysis, most half-open first
+def get_analysis_half_open(connection, analysis_id):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT ip, role, half_open, handshakes FROM pcap_analysis_half_open WHERE analysis_id=?
+                      ORDER BY role DESC, half_open DESC""", (analysis_id,))
+    return cursor.fetchall()
+
+# (analysis_id, end_offset, prefix_sha256) of the checkpoint of the latest
+# analysis of a file in a case by the same analyzer version and series bucket,
+# or None
+def get_analysis_checkpoint(connection, case_name, pcap_filename, analyzer_version, series_bucket):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT c.analysis_id, c.end_offset, c.prefix_sha256
+                      FROM pcap_analysis_checkpoint c JOIN pcap_analysis a ON a.id = c.analysis_id
+                      WHERE a.CaseName=? AND a.pcap_file_name=? AND a.analyzer_version=? AND a.series_bucket=?
+                      ORDER BY a.id DESC LIMIT 1""", (case_name, pcap_filename, analyzer_version, series_bucket))
+    return cursor.fetchone()
+
+def get_checkpoint_state(connection, analysis_id):
+    cursor = connection.cursor()
+    cursor.execute("SELECT state FROM pcap_analysis_checkpoint WHERE analysis_id=?", (analysis_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+# Verdicts of an analysis in the form evaluate_rules returns them, most severe first
+def get_analysis_verdicts(connection, analysis_id):
+    cursor = connection.cursor()
+    cursor.execute("""SELECT rule, attack, severity, target, window_start, window_end, evidence, message
+                      FROM pcap_analysis_verdict WHERE analysis_id=? ORDER BY rowid""", (analysis_id,))
+    return [{'rule': rule, 'attack': attack, 'severity': severity, 'target': target, 'start': start, 'end': end,
+             'evidence': json.loads(evidence) if evidence else {}, 'message': message}
+            for rule, attack, severity, target, start, end, evidence, message in cursor.fetchall()]
+
+# Records the column stores written for files of a case, replacing older ones
+# of the same files; `stores` are (pcap_filename, store) with store as
+# ntfs_columns.save_column_store returns it
+def register_column_stores(connection, case_name, stores):
+    created = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        with connection:
+            for pcap_filename, store in stores:
+                connection.execute("DELETE FROM pcap_column_store WHERE CaseName=? AND pcap_file_name=?",
+                                   (case_name, pcap_filename))
+                connection.execute("""INSERT INTO pcap_column_store (CaseName, pcap_file_name, packets, first_ts,
+                                                                    last_ts, file_size, file_mtime, created)
+                                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                   (case_name, pcap_filename, store['packets'], store['first_ts'], store['last_ts'],
+                                    store['file_size'], store['file_mtime'], created))
+    except sqlite3.Error as e:
+        print(f"Error registering column stores: {e}")
+
+# The file's column store was deleted, e.g. with the capture itself
+def unregister_column_store(connection, case_name, pcap_filename):
+    try:
+        with connection:
+            connection.execute("DELETE FROM pcap_column_store WHERE CaseName=? AND pcap_file_name=?",
+                               (case_name, pcap_filename))
+    except sqlite3.Error as e:
+        print(f"Error unregistering column store: {e}")
+
+# [(pcap_filename, packets, first_ts, last_ts)] of the column stores of a case
+# whose time span overlaps start <= ts < end, in time order
+def get_case_column_stores(connection, case_name, start=None, end=None):
+    sql_query = "SELECT pcap_file_name, packets, first_ts, last_ts FROM pcap_column_store WHERE CaseName=?"
+    parameters = [case_name]
+    if start is not None:
+        sql_query += " AND last_ts >= ?"
+        parameters.append(start)
+    if end is not None:
+        sql_query += " AND first_ts < ?"
+        parameters.append(end)
+    cursor = connection.cursor()
+    cursor.execute(sql_query + " ORDER BY first_ts, id", parameters)
+    return cursor.fetchall()
+
+# Yields the source sketch blob of every analysis of the case that has one
+def iter_case_source_sketches(connection, case_name, page_size=REPORT_PAGE_SIZE):
+    cursor = connection.cursor()
+    cursor.execute("SELECT source_sketch FROM pcap_analysis WHERE CaseName=? AND source_sketch IS NOT NULL ORDER BY id",
+                   (case_name,))
+    while True:
+        rows = cursor.fetchmany(page_size)
+        if not rows:
+            break
+        for row in rows:
+            yield row[0]
+
+# Analyses in which an IP is one of the stored talkers, of one case or of all
+def get_analyses_for_ip(connection, ip, case_name=None):
+    sql_query = """SELECT a.id, a.CaseName, a.pcap_file_name, a.analysis_date, t.direction, t.packets, t.bytes
+                   FROM pcap_analysis_ip t JOIN pcap_analysis a ON a.id = t.analysis_id
+                   WHERE t.ip=?"""
+    parameters = [ip]
+    if case_name is not None:
+        sql_query += " AND a.CaseName=?"
+        parameters.append(case_name)
+    cursor = connection.cursor()
+    cursor.execute(sql_query + " ORDER BY a.id, t.direction DESC", parameters)
+    return cursor.fetchall()
+
+# (bucket seconds, series) of an analysis, or None for analyses stored without one
+def get_analysis_series(connection, analysis_id):
+    from ntfs_series import series_from_blob
+    cursor = connection.cursor()
+    cursor.execute("SELECT series_bucket, series FROM pcap_analysis WHERE id=?", (analysis_id,))
+    row = cursor.fetchone()
+    if not row or row[1] is None:
+        return None
+    return row[0], series_from_blob(row[1])
 
 def get_existing_cases(connection):
     cursor = connection.cursor()
@@ -123,9 +554,8 @@ def insert_registration(connection, case_name, organization, investigator_name,
                    VALUES (?, ?, ?, ?)"""
     data = (case_name, organization, investigator_name, current_date)
     try:
-        cursor = connection.cursor()
-        cursor.execute(sql_query, data)
-        connection.commit()
+        with connection:
+            cursor = connection.execute(sql_query, data)
         print("Case registration successful!")
         return cursor.lastrowid
     except Error as e:
@@ -148,12 +578,29 @@ def get_pcap_files_for_case(connection, case_name):
     rows = cursor.fetchall()
     return rows
 
+# (FilePath, Status, md5, sha256) of the case's files, as recorded at capture or import
+def get_pcap_file_hashes_for_case(connection, case_name):
+    cursor = connection.cursor()
+    cursor.execute("SELECT FilePath, Status, md5, sha256 FROM pcap_file WHERE CaseName=? ORDER BY id", (case_name,))
+    return cursor.fetchall()
+
 def get_pcap_analysis_for_case(connection, case_name):
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM pcap_analysis WHERE CaseName=?", (case_name,))
     rows = cursor.fetchall()
     return rows
 
+# Yields the case's analyses as {column: value} dicts, fetching `page_size` rows at a time
+def iter_pcap_analysis_for_case(connection, case_name, columns, page_size=REPORT_PAGE_SIZE):
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT {', '.join(columns)} FROM pcap_analysis WHERE CaseName=? ORDER BY id", (case_name,))
+    while True:
+        rows = cursor.fetchmany(page_size)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(columns, row))
+
 def get_existing_cases(connection):
     cursor = connection.cursor()
     cursor.execute("SELECT id, CaseName, OrganizationName, InvestigatorsName, Date FROM registration ORDER BY Date DESC")
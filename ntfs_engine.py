@@ -0,0 +1,367 @@
+import io
+import json
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ntfs_pcap import IPPROTO_TCP, IPPROTO_UDP, PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN, is_plain_pcap
+from ntfs_reader import (
+    iter_packet_columns,
+    iter_capture_columns,
+    iter_store_columns,
+    format_address,
+    plan_segments,
+    SEGMENT_BYTES,
+)
+from ntfs_flows import new_flow_table, flow_update, merge_flow_tables, flow_results, half_open_rows, \
+    flow_table_snapshot, restore_flow_table
+from ntfs_hll import DISTINCT_DESTINATIONS, new_distinct_state, distinct_update, merge_distinct_states, \
+    distinct_summary
+from ntfs_columns import new_column_store, column_store_update, merge_column_stores, save_column_store
+from ntfs_index import new_packet_index, index_update, merge_packet_indexes, save_packet_index
+from ntfs_rules import new_rule_state, rule_update, merge_rule_states, evaluate_rules
+from ntfs_series import DEFAULT_BUCKET_SECONDS, new_series, series_update, finish_series, merge_series
+from ntfs_sketch import DEFAULT_SKETCH_CAPACITY, new_topk_sketch, topk_update, topk_items, merge_topk_sketches
+from ntfs_store import is_store_pcap, plan_store_segments
+
+# Stored with every analysis; bump it whenever the analysis results change so
+# cached analyses of older versions are not reused
+ANALYZER_VERSION = "8"
+
+# Checkpoints are written after every analysis of a pcap file, so they are
+# compressed for speed rather than size
+CHECKPOINT_COMPRESS_LEVEL = 1
+
+TOP_IPS_LIMIT = 5
+# Talkers per direction stored with an analysis, see talker_rows
+STORED_TALKERS_LIMIT = 100
+
+COUNTER_NAMES = ('total_packets', 'tcp_count', 'udp_count', 'http_count', 'syn_count',
+                 'syn_ack_count', 'ack_count', 'syn_without_ack_count')
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+# Boolean masks over the flags column, one per `tcp[13]` filter the analysis used
+FLAG_COUNTERS = {
+    'syn_count': lambda flags: flags & TCP_SYN != 0,                                   # tcp[13] & 2 != 0
+    'syn_ack_count': lambda flags: flags & (TCP_SYN | TCP_ACK) == TCP_SYN | TCP_ACK,  # tcp[13] & 18 == 18
+    'ack_count': lambda flags: flags & TCP_ACK != 0,                                   # tcp[13] & 16 != 0
+    'syn_without_ack_count': lambda flags: flags & (TCP_SYN | TCP_ACK) == TCP_SYN,    # tcp[13] & 18 == 2
+}
+
+# Talker dimensions tracked by the heavy-hitter sketches and the address
+# columns that make up their key
+TALKER_DIMENSIONS = {
+    'sources': ('src',),
+    'destinations': ('dst',),
+    'pairs': ('src', 'dst'),
+}
+TALKER_METRICS = ('packets', 'bytes')
+
+
+def new_analysis_state(sketch_capacity=DEFAULT_SKETCH_CAPACITY, bucket_seconds=DEFAULT_BUCKET_SECONDS,
+                       build_index=False, build_columns=False):
+    sketches = {}
+    for dimension, fields in TALKER_DIMENSIONS.items():
+        for metric in TALKER_METRICS:
+            sketches[(dimension, metric)] = new_topk_sketch(f"V{16 * len(fields)}", sketch_capacity)
+
+    return {
+        'total_packets': 0,
+        'tcp_count': 0,
+        'udp_count': 0,
+        'http_count': 0,
+        'syn_count': 0,
+        'syn_ack_count': 0,
+        'ack_count': 0,
+        'syn_without_ack_count': 0,
+        'sketches': sketches,
+        # Per-bucket counters of the same packets, see ntfs_series
+        'series_bucket': bucket_seconds,
+        'series': new_series(COUNTER_NAMES),
+        'series_chunks': [],
+        # Sidecar packet index built in the same pass, see ntfs_index
+        'index': new_packet_index() if build_index else None,
+        # Column store written in the same pass, see ntfs_columns
+        'columns': new_column_store() if build_columns else None,
+        # TCP connections and their handshakes, see ntfs_flows
+        'flows': new_flow_table(sketch_capacity=sketch_capacity),
+        # Distinct sources and source /24s, see ntfs_hll
+        'distinct': new_distinct_state(),
+        # Features the detection rules look at, see ntfs_rules
+        'rules': new_rule_state(),
+    }
+
+
+def _talker_keys(columns, fields):
+    if len(fields) == 1:
+        return columns[fields[0]]
+    raw = [np.ascontiguousarray(columns[field]).view(np.uint8).reshape(-1, 16) for field in fields]
+    return np.concatenate(raw, axis=1).view(f"V{16 * len(fields)}").ravel()
+
+
+def busiest_destinations(state, limit=DISTINCT_DESTINATIONS):
+    items = topk_items(state['sketches'][('destinations', 'packets')], limit)
+    return np.array([key for key, _, _ in items], dtype='V16')
+
+
+def counter_masks(columns):
+    # One boolean mask per counter of the analysis, in COUNTER_NAMES order
+    is_ip = columns['ip_version'] != 0
+    # VLAN-tagged frames are never matched by plain `tcp`/`udp` filters
+    plain = is_ip & ~columns['encapsulated']
+    proto = columns['proto']
+    tcp = plain & (proto == IPPROTO_TCP)
+    http = tcp & columns['has_ports'] & ((columns['sport'] == 80) | (columns['dport'] == 80))
+    flagged = plain & columns['has_flags']
+    flags = columns['tcp_flags']
+
+    masks = {
+        'total_packets': np.ones(len(columns), dtype=bool),
+        'tcp_count': tcp,
+        'udp_count': plain & (proto == IPPROTO_UDP),
+        'http_count': http,
+    }
+    for key, mask in FLAG_COUNTERS.items():
+        masks[key] = flagged & mask(flags)
+    return masks
+
+
+def update_analysis_state(state, columns):
+    masks = counter_masks(columns)
+    for key, mask in masks.items():
+        state[key] += int(np.count_nonzero(mask))
+    series_update(state, state['series_bucket'], columns['ts'], columns['wirelen'], masks)
+    if state['index'] is not None:
+        index_update(state['index'], columns)
+    if state['columns'] is not None:
+        column_store_update(state['columns'], columns)
+    flow_update(state['flows'], columns[masks['tcp_count'] & columns['has_ports']])
+    rule_update(state['rules'], columns, masks)
+
+    is_ip = columns['ip_version'] != 0
+    ip_columns = columns[is_ip]
+    wirelen = ip_columns['wirelen'].astype(np.int64)
+    for dimension, fields in TALKER_DIMENSIONS.items():
+        keys = _talker_keys(ip_columns, fields)
+        topk_update(state['sketches'][(dimension, 'packets')], keys)
+        topk_update(state['sketches'][(dimension, 'bytes')], keys, wirelen)
+    distinct_update(state['distinct'], ip_columns['ts'], ip_columns['src'], ip_columns['dst'],
+                    busiest_destinations(state))
+
+
+def merge_analysis_states(first, second):
+    merged = {}
+    for key, value in first.items():
+        if key == 'sketches':
+            merged[key] = {name: merge_topk_sketches(sketch, second[key][name]) for name, sketch in value.items()}
+        elif key == 'series':
+            merged[key] = merge_series(finish_series(first), finish_series(second))
+        elif key == 'series_chunks':
+            merged[key] = []
+        elif key == 'series_bucket':
+            merged[key] = value
+        elif key == 'index':
+            merged[key] = merge_packet_indexes(value, second[key]) if value is not None else None
+        elif key == 'columns':
+            merged[key] = merge_column_stores(value, second[key]) if value is not None else None
+        elif key == 'flows':
+            merged[key] = merge_flow_tables(value, second[key])
+        elif key == 'rules':
+            merged[key] = merge_rule_states(value, second[key])
+        elif key != 'distinct':
+            merged[key] = value + second[key]
+    # Destinations keep their sketches if they are among the busiest of both
+    merged['distinct'] = merge_distinct_states(first['distinct'], second['distinct'], busiest_destinations(merged))
+    return merged
+
+
+def _talker_label(key):
+    raw = bytes(key)
+    return ' -> '.join(format_address(raw[i:i + 16]) for i in range(0, len(raw), 16))
+
+
+def top_talkers(state, limit=TOP_IPS_LIMIT):
+    # {dimension: {metric: [(label, count, error), ...]}}, highest count first
+    talkers = {}
+    for (dimension, metric), sketch in state['sketches'].items():
+        talkers.setdefault(dimension, {})[metric] = [
+            (_talker_label(key), count, error) for key, count, error in topk_items(sketch, limit)
+        ]
+    return talkers
+
+
+def talker_rows(state, limit=STORED_TALKERS_LIMIT):
+    # [(ip, direction, packets, bytes)] for the top `limit` hosts of each
+    # direction by packets and by bytes. A host that is top by one metric
+    # gets the other metric from its sketch, or None if it is not tracked there.
+    rows = []
+    for dimension, direction in (('sources', 'source'), ('destinations', 'destination')):
+        tracked = {}
+        keys = {}
+        for metric in TALKER_METRICS:
+            sketch = state['sketches'][(dimension, metric)]
+            tracked[metric] = dict(zip(map(bytes, sketch['keys']), sketch['counts'].tolist()))
+            keys.update((bytes(key), None) for key, _, _ in topk_items(sketch, limit))
+        for key in keys:
+            rows.append((format_address(key), direction, tracked['packets'].get(key), tracked['bytes'].get(key)))
+    return rows
+
+
+def analysis_details_from_state(state, top_k=TOP_IPS_LIMIT):
+    finish_series(state)
+    analysis_details = {key: value for key, value in state.items()
+                        if key not in ('sketches', 'series_chunks', 'index', 'columns', 'flows', 'rules')}
+    analysis_details['talkers'] = talker_rows(state)
+    flows = flow_results(state['flows'])
+    analysis_details['flow_count'] = flows['flows']
+    analysis_details['half_open_count'] = flows['half_open']
+    analysis_details['half_open_hosts'] = half_open_rows(flows, STORED_TALKERS_LIMIT)
+    analysis_details['verdicts'] = evaluate_rules(state['rules'], flows)
+    analysis_details['source_diversity'] = distinct_summary(state['distinct'])
+    analysis_details['top_talkers'] = top_talkers(state, top_k)
+    analysis_details['top_ips'] = [
+        (ip, count) for ip, count, _ in analysis_details['top_talkers']['sources']['packets']
+    ]
+    return analysis_details
+
+
+def analyze_segment(pcap_file, start, end, sketch_capacity=DEFAULT_SKETCH_CAPACITY,
+                    bucket_seconds=DEFAULT_BUCKET_SECONDS, build_index=False, build_columns=False):
+    # Returns the partial state and the offset right after the last record read
+    state = new_analysis_state(sketch_capacity, bucket_seconds, build_index, build_columns)
+    stop = start
+    read_columns = iter_packet_columns if is_plain_pcap(pcap_file) else iter_store_columns
+    for columns in read_columns(pcap_file, start, end):
+        update_analysis_state(state, columns)
+        last = columns[-1]
+        stop = int(last['offset']) + PCAP_RECORD_HEADER_LEN + int(last['caplen'])
+    return state, stop
+
+
+def analyze_segments(pcap_file, workers=1, sketch_capacity=DEFAULT_SKETCH_CAPACITY, segment_bytes=SEGMENT_BYTES,
+                     bucket_seconds=DEFAULT_BUCKET_SECONDS, build_index=False, build_columns=False,
+                     start=PCAP_GLOBAL_HEADER_LEN):
+    # Every run folds the same segments in the same order, so the result does
+    # not depend on the number of workers, sketches included. Returns the state
+    # and, for pcap files, the offset right after the last complete record;
+    # `start` is where reading begins in those.
+    if is_plain_pcap(pcap_file):
+        segments = plan_segments(pcap_file, segment_bytes, start)
+    elif is_store_pcap(pcap_file):
+        # Split at frame boundaries of the evidence store
+        segments = plan_store_segments(pcap_file, segment_bytes)
+    else:
+        # pcapng and other compressed captures cannot be split, they are read in one stream
+        state = new_analysis_state(sketch_capacity, bucket_seconds, build_index, build_columns)
+        for columns in iter_capture_columns(pcap_file):
+            update_analysis_state(state, columns)
+        return state, None
+
+    executor = None
+    futures = []
+    if workers > 1 and len(segments) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(segments)))
+        futures = [executor.submit(analyze_segment, pcap_file, start, end, sketch_capacity, bucket_seconds,
+                                   build_index, build_columns)
+                   for start, end in segments]
+
+    try:
+        state = new_analysis_state(sketch_capacity, bucket_seconds, build_index, build_columns)
+        pos = segments[0][0]
+        for i, (start, end) in enumerate(segments):
+            if futures and start == pos:
+                partial, stop = futures[i].result()
+            else:
+                # Serial run, or the guessed split point was not a record start:
+                # continue from where the previous segment's records really ended
+                partial, stop = analyze_segment(pcap_file, pos, end, sketch_capacity, bucket_seconds, build_index,
+                                                build_columns)
+            state = merge_analysis_states(state, partial)
+            pos = max(stop, pos)
+        return state, pos
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+
+def _encode(value, arrays):
+    # JSON skeleton of a state, its arrays collected into `arrays`
+    if isinstance(value, dict):
+        return {'dict': [[list(key) if isinstance(key, tuple) else key, _encode(item, arrays)]
+                         for key, item in value.items()]}
+    if isinstance(value, np.ndarray):
+        name = f"array{len(arrays)}"
+        arrays[name] = value
+        return {'array': name}
+    if isinstance(value, np.generic):
+        return {'value': value.item()}
+    return {'value': value}
+
+
+def _decode(node, arrays):
+    if 'dict' in node:
+        return {tuple(key) if isinstance(key, list) else key: _decode(item, arrays) for key, item in node['dict']}
+    if 'array' in node:
+        return arrays[node['array']]
+    return node['value']
+
+
+# Everything an analysis needs to go on from where it stopped: counters,
+# sketches, series, the live flows, HyperLogLog and rule state. The packet
+# index and column store are left out, they are rebuilt for the whole file
+# when next needed. Arrays go into an .npz and the rest into a JSON skeleton,
+# so loading a checkpoint never unpickles anything. A resumed analysis merges
+# like two segments of one pass: the heavy-hitter sketches and per-destination
+# source counts are approximate across the split, see ntfs_sketch and ntfs_hll.
+def checkpoint_to_blob(state):
+    arrays = {}
+    finish_series(state)
+    finish_series(state['rules'])
+    snapshot = dict(state, index=None, columns=None, flows=flow_table_snapshot(state['flows']))
+    skeleton = json.dumps(_encode(snapshot, arrays))
+    arrays['skeleton'] = np.frombuffer(skeleton.encode(), dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return zlib.compress(buffer.getvalue(), CHECKPOINT_COMPRESS_LEVEL)
+
+
+def checkpoint_from_blob(blob):
+    with np.load(io.BytesIO(zlib.decompress(blob)), allow_pickle=False) as data:
+        arrays = {name: data[name] for name in data.files}
+    state = _decode(json.loads(arrays.pop('skeleton').tobytes()), arrays)
+    state['flows'] = restore_flow_table(state['flows'])
+    # Checkpoints hold finished series, and older ones no chunk lists at all
+    state['series_chunks'] = []
+    state['rules']['series_chunks'] = []
+    return state
+
+
+def analyze_single_pass(pcap_file, top_k=TOP_IPS_LIMIT, sketch_capacity=DEFAULT_SKETCH_CAPACITY, workers=1,
+                        bucket_seconds=DEFAULT_BUCKET_SECONDS, build_index=False, build_columns=False, resume=None,
+                        checkpoint=False):
+    # `resume` is (checkpoint blob, offset) of an earlier analysis of the
+    # first `offset` bytes of the pcap file: only the records after them are
+    # read, and no packet index or column store is built from them alone
+    # With `checkpoint`, details['checkpoint'] of a plain pcap file is (blob,
+    # end offset) for the next analysis to go on from
+    if resume:
+        blob, start = resume
+        state, end = analyze_segments(pcap_file, workers, sketch_capacity, bucket_seconds=bucket_seconds,
+                                      start=start)
+        state = merge_analysis_states(checkpoint_from_blob(blob), state)
+        build_index = build_columns = False
+    else:
+        state, end = analyze_segments(pcap_file, workers, sketch_capacity, bucket_seconds=bucket_seconds,
+                                      build_index=build_index, build_columns=build_columns)
+    if build_index:
+        save_packet_index(pcap_file, state['index'])
+    analysis_details = analysis_details_from_state(state, top_k)
+    if build_columns:
+        analysis_details['column_store'] = save_column_store(pcap_file, state['columns'])
+    if checkpoint and end is not None and is_plain_pcap(pcap_file):
+        # Offsets of other formats are not positions in the file on disk
+        analysis_details['checkpoint'] = (checkpoint_to_blob(state), end)
+    return analysis_details
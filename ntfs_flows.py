@@ -0,0 +1,357 @@
+import numpy as np
+
+from ntfs_reader import format_address
+from ntfs_sketch import DEFAULT_SKETCH_CAPACITY, new_topk_sketch, topk_update, topk_items, merge_topk_sketches
+
+# Slots of a flow table, a power of two of about 80 bytes each. A table
+# starts small and doubles as flows pile up, up to the maximum, so memory
+# stays bounded no matter how many flows the capture has
+INITIAL_FLOW_CAPACITY = 1 << 12
+DEFAULT_FLOW_CAPACITY = 1 << 18
+# Live flows are kept under this share of the slots so probe runs stay short
+FLOW_MAX_LOAD = 0.5
+# A flow with no packet for this long is finished when room is needed
+FLOW_IDLE_SECONDS = 60
+
+# Low-and-slow HTTP: an established connection to a web port held open this
+# long while sending no more than this many bytes a second, the way Slowloris
+# keeps a server's connection slots busy
+SLOW_HTTP_PORTS = (80, 8080)
+SLOW_FLOW_SECONDS = 30
+SLOW_FLOW_MAX_RATE = 100
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+# Handshake events seen on a flow; A and B are its two endpoints, in key order
+SYN_A = 0x01
+SYN_B = 0x02
+SYN_ACK_A = 0x04
+SYN_ACK_B = 0x08
+ACK_A = 0x10
+ACK_B = 0x20
+RST_SEEN = 0x40
+FIN_SEEN = 0x80
+
+FLOW_COUNTERS = ('flows', 'handshakes', 'established', 'half_open', 'reset', 'slow', 'evicted')
+# Tallies by the address of the side that answered the SYN (target) or that
+# sent it (source)
+FLOW_TALLIES = (('targets', 'half_open'), ('targets', 'handshakes'), ('sources', 'half_open'),
+                ('sources', 'handshakes'), ('targets', 'slow'))
+# Per-flow arrays of a slot, in the order _upsert takes them
+ENTRY_FIELDS = ('keys', 'hashes', 'bits', 'packets', 'bytes', 'first_ts', 'last_ts')
+# Per-flow arrays flow_outcomes looks at
+OUTCOME_FIELDS = ('keys', 'bits', 'bytes', 'first_ts', 'last_ts')
+
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_MIX_MULTIPLIER = np.uint64(0xBF58476D1CE4E5B9)
+
+
+# TCP connection tracking over an open-addressing hash table kept as arrays.
+# A flow is keyed by its 5-tuple with the two endpoints in a fixed order, so
+# both directions land on the same slot; packets are folded in a chunk at a
+# time. Flows that go idle, or the oldest ones when the table fills up, are
+# finished: their handshake outcome goes into counters and half-open sketches
+# by target and source, and their slots are reused.
+def new_flow_table(max_capacity=DEFAULT_FLOW_CAPACITY, sketch_capacity=DEFAULT_SKETCH_CAPACITY):
+    table = {
+        'max_capacity': max_capacity,
+        'live': 0,
+        'now': 0.0,
+        'tallies': {name: new_topk_sketch('V16', sketch_capacity) for name in FLOW_TALLIES},
+    }
+    table.update(_flow_slots(min(INITIAL_FLOW_CAPACITY, max_capacity)))
+    table.update((name, 0) for name in FLOW_COUNTERS)
+    return table
+
+
+def _flow_slots(capacity):
+    return {
+        'capacity': capacity,
+        'used': np.zeros(capacity, dtype=bool),
+        'hashes': np.zeros(capacity, dtype=np.uint64),
+        # Endpoint A address (2 words), endpoint B address (2 words), then
+        # A port << 32 | B port << 16 | protocol
+        'keys': np.zeros((capacity, 5), dtype=np.uint64),
+        'bits': np.zeros(capacity, dtype=np.uint8),
+        'packets': np.zeros(capacity, dtype=np.int64),
+        'bytes': np.zeros(capacity, dtype=np.int64),
+        'first_ts': np.zeros(capacity, dtype=np.float64),
+        'last_ts': np.zeros(capacity, dtype=np.float64),
+    }
+
+
+def _address_words(addresses):
+    return np.ascontiguousarray(addresses).view('>u8').reshape(-1, 2).astype(np.uint64)
+
+
+def _hash_keys(keys):
+    hashes = np.zeros(len(keys), dtype=np.uint64)
+    for i in range(keys.shape[1]):
+        hashes = (hashes ^ keys[:, i]) * _HASH_MULTIPLIER
+    hashes ^= hashes >> np.uint64(31)
+    return hashes * _MIX_MULTIPLIER
+
+
+def _same_keys(first, second):
+    return (first == second).all(axis=1)
+
+
+def flow_entries(columns):
+    # Key, hash and handshake event bits of every packet; `columns` holds TCP
+    # packets with ports only
+    src = _address_words(columns['src'])
+    dst = _address_words(columns['dst'])
+    sport = columns['sport'].astype(np.uint64)
+    dport = columns['dport'].astype(np.uint64)
+    from_a = ((src[:, 0] < dst[:, 0])
+              | (src[:, 0] == dst[:, 0]) & ((src[:, 1] < dst[:, 1]) | (src[:, 1] == dst[:, 1]) & (sport <= dport)))
+
+    keys = np.empty((len(columns), 5), dtype=np.uint64)
+    keys[:, 0:2] = np.where(from_a[:, None], src, dst)
+    keys[:, 2:4] = np.where(from_a[:, None], dst, src)
+    a_port = np.where(from_a, sport, dport)
+    b_port = np.where(from_a, dport, sport)
+    keys[:, 4] = a_port << np.uint64(32) | b_port << np.uint64(16) | columns['proto'].astype(np.uint64)
+
+    flags = columns['tcp_flags']
+    syn = flags & TCP_SYN != 0
+    ack = flags & TCP_ACK != 0
+    bits = np.zeros(len(columns), dtype=np.uint8)
+    bits[syn & ~ack] = np.where(from_a, SYN_A, SYN_B)[syn & ~ack]
+    bits[syn & ack] = np.where(from_a, SYN_ACK_A, SYN_ACK_B)[syn & ack]
+    bits[~syn & ack] = np.where(from_a, ACK_A, ACK_B)[~syn & ack]
+    bits[flags & TCP_RST != 0] |= RST_SEEN
+    bits[flags & TCP_FIN != 0] |= FIN_SEEN
+    return keys, _hash_keys(keys), bits
+
+
+def _group_entries(keys, hashes, bits, packets, byte_counts, first_ts, last_ts):
+    # One entry per flow; equal keys have equal hashes so sorting by hash
+    # brings them together
+    order = np.argsort(hashes, kind='stable')
+    keys, hashes = keys[order], hashes[order]
+    change = (hashes[1:] != hashes[:-1]) | ~_same_keys(keys[1:], keys[:-1])
+    starts = np.flatnonzero(np.concatenate([[True], change]))
+    grouped = (keys[starts], hashes[starts], np.bitwise_or.reduceat(bits[order], starts),
+               np.add.reduceat(packets[order], starts), np.add.reduceat(byte_counts[order], starts),
+               np.minimum.reduceat(first_ts[order], starts), np.maximum.reduceat(last_ts[order], starts))
+    # Back in order of first packet: entries taken a slice at a time would
+    # otherwise all hash into the same part of the table
+    arrival = np.argsort(order[starts])
+    return tuple(entry[arrival] for entry in grouped)
+
+
+def _upsert(table, keys, hashes, bits, packets, byte_counts, first_ts, last_ts):
+    # Linear probing, one probe step for all pending entries per round. An
+    # entry either finds its flow, claims a free slot (the first entry wins
+    # when several want the same one) or moves on to the next slot.
+    mask = table['capacity'] - 1
+    # The high bits of the hash are the best mixed ones
+    pos = (hashes >> np.uint64(65 - table['capacity'].bit_length())).astype(np.int64)
+    pending = np.arange(len(keys))
+    while len(pending):
+        slots = pos[pending]
+        used = table['used'][slots]
+        same = used.copy()
+        same[used] = _same_keys(table['keys'][slots[used]], keys[pending[used]])
+
+        hits, hit_slots = pending[same], slots[same]
+        np.bitwise_or.at(table['bits'], hit_slots, bits[hits])
+        np.add.at(table['packets'], hit_slots, packets[hits])
+        np.add.at(table['bytes'], hit_slots, byte_counts[hits])
+        np.minimum.at(table['first_ts'], hit_slots, first_ts[hits])
+        np.maximum.at(table['last_ts'], hit_slots, last_ts[hits])
+
+        free, free_slots = pending[~used], slots[~used]
+        claimed, first = np.unique(free_slots, return_index=True)
+        winners = free[first]
+        table['used'][claimed] = True
+        table['hashes'][claimed] = hashes[winners]
+        table['keys'][claimed] = keys[winners]
+        table['bits'][claimed] = bits[winners]
+        table['packets'][claimed] = packets[winners]
+        table['bytes'][claimed] = byte_counts[winners]
+        table['first_ts'][claimed] = first_ts[winners]
+        table['last_ts'][claimed] = last_ts[winners]
+        table['live'] += len(claimed)
+
+        # Losers retry the same slot, now taken, and match it if it is their flow
+        losers = np.ones(len(free), dtype=bool)
+        losers[first] = False
+        moving = pending[used & ~same]
+        pos[moving] = (pos[moving] + 1) & mask
+        pending = np.concatenate([free[losers], moving])
+
+
+def _finish(table, slots):
+    # Folds the handshake outcome of the flows in `slots` into the counters and
+    # tallies, see flow_outcomes
+    outcomes = flow_outcomes({name: table[name][slots] for name in OUTCOME_FIELDS})
+    for name in FLOW_COUNTERS[:-1]:
+        table[name] += int(np.count_nonzero(outcomes[name]))
+    for (side, metric), sketch in table['tallies'].items():
+        topk_update(sketch, outcomes[side][outcomes[metric]])
+
+
+def flow_outcomes(flows):
+    bits = flows['bits']
+    keys = flows['keys']
+    by_a = bits & SYN_A != 0
+    by_b = ~by_a & (bits & SYN_B != 0)
+    handshakes = by_a | by_b
+    established = by_a & (bits & ACK_A != 0) | by_b & (bits & ACK_B != 0)
+    # A handshake that never completed, whether or not it was reset after
+    half_open = handshakes & ~established
+    server_port = np.where(by_b, keys[:, 4] >> np.uint64(32), keys[:, 4] >> np.uint64(16) & np.uint64(0xFFFF))
+    duration = flows['last_ts'] - flows['first_ts']
+    slow = (established & np.isin(server_port, SLOW_HTTP_PORTS) & (duration >= SLOW_FLOW_SECONDS)
+            & (flows['bytes'] <= SLOW_FLOW_MAX_RATE * duration))
+    a_address = np.ascontiguousarray(keys[:, 0:2].astype('>u8')).view('V16').ravel()
+    b_address = np.ascontiguousarray(keys[:, 2:4].astype('>u8')).view('V16').ravel()
+    return {
+        'flows': np.ones(len(bits), dtype=bool),
+        'handshakes': handshakes,
+        'established': established,
+        'half_open': half_open,
+        'reset': half_open & (bits & RST_SEEN != 0),
+        'slow': slow,
+        'sources': np.where(by_b, b_address, a_address),
+        'targets': np.where(by_b, a_address, b_address),
+    }
+
+
+def _rebuild(table, keep):
+    # Reinserts the flows at `keep` into emptied arrays, which also clears the
+    # probe runs of the flows that were finished
+    entries = [table[name][keep] for name in ENTRY_FIELDS]
+    table['used'][:] = False
+    table['live'] = 0
+    _upsert(table, *entries)
+
+
+def _grow(table, needed):
+    # Doubles the slots until `needed` live flows fit, or the maximum is reached
+    capacity = table['capacity']
+    while capacity < table['max_capacity'] and int(capacity * FLOW_MAX_LOAD) < needed:
+        capacity *= 2
+    if capacity == table['capacity']:
+        return
+    slots = np.flatnonzero(table['used'])
+    entries = [table[name][slots] for name in ENTRY_FIELDS]
+    table.update(_flow_slots(capacity))
+    table['live'] = 0
+    _upsert(table, *entries)
+
+
+def _make_room(table, incoming):
+    # Flows are only finished early once the table cannot grow any more
+    _grow(table, table['live'] + incoming)
+    limit = int(table['capacity'] * FLOW_MAX_LOAD)
+    if table['live'] + incoming <= limit:
+        return
+    slots = np.flatnonzero(table['used'])
+    idle = table['last_ts'][slots] < table['now'] - FLOW_IDLE_SECONDS
+    closed = table['bits'][slots] & (RST_SEEN | FIN_SEEN) != 0
+    done = idle | closed
+    # Still too full: the flows that were quiet the longest go too, down to
+    # half the limit so this does not run again on the next chunk
+    room = min(limit // 2, limit - incoming)
+    if len(slots) - np.count_nonzero(done) > room:
+        order = np.argsort(table['last_ts'][slots[~done]], kind='stable')
+        oldest = slots[~done][order[:len(slots) - np.count_nonzero(done) - room]]
+        table['evicted'] += len(oldest)
+        done[np.isin(slots, oldest)] = True
+    _finish(table, slots[done])
+    _rebuild(table, slots[~done])
+
+
+def _insert(table, entries):
+    # A slice at a time, so the table always has room for the whole slice
+    step = max(1, int(table['max_capacity'] * FLOW_MAX_LOAD) // 2)
+    for start in range(0, len(entries[0]), step):
+        part = [entry[start:start + step] for entry in entries]
+        _make_room(table, len(part[0]))
+        _upsert(table, *part)
+
+
+def flow_update(table, columns):
+    if not len(columns):
+        return
+    keys, hashes, bits = flow_entries(columns)
+    ts = columns['ts'].astype(np.float64)
+    entries = _group_entries(keys, hashes, bits, np.ones(len(columns), dtype=np.int64),
+                             columns['wirelen'].astype(np.int64), ts, ts)
+    table['now'] = max(table['now'], float(ts.max()))
+    _insert(table, entries)
+
+
+def merge_flow_tables(first, second):
+    # Flows live in both tables continue across them: a SYN in one segment and
+    # the ACK that completes it in the next make one established flow
+    merged = new_flow_table(first['max_capacity'], first['tallies'][FLOW_TALLIES[0]]['capacity'])
+    merged['now'] = max(first['now'], second['now'])
+    for table in (first, second):
+        for name in FLOW_COUNTERS:
+            merged[name] += table[name]
+        for name, sketch in table['tallies'].items():
+            merged['tallies'][name] = merge_topk_sketches(merged['tallies'][name], sketch)
+    slots = [np.flatnonzero(table['used']) for table in (first, second)]
+    entries = [np.concatenate([table[name][used] for table, used in zip((first, second), slots)])
+               for name in ENTRY_FIELDS]
+    if len(entries[0]):
+        _insert(merged, _group_entries(*entries))
+    return merged
+
+
+def flow_table_snapshot(table):
+    # The table with the arrays of its live flows only, as checkpoints keep
+    # it; see restore_flow_table
+    slots = np.flatnonzero(table['used'])
+    snapshot = {name: table[name] for name in ('max_capacity', 'now') + FLOW_COUNTERS}
+    snapshot['tallies'] = table['tallies']
+    snapshot['entries'] = {name: table[name][slots] for name in ENTRY_FIELDS}
+    return snapshot
+
+
+def restore_flow_table(snapshot):
+    table = new_flow_table(snapshot['max_capacity'], snapshot['tallies'][FLOW_TALLIES[0]]['capacity'])
+    table['now'] = snapshot['now']
+    table.update((name, snapshot[name]) for name in FLOW_COUNTERS)
+    table['tallies'] = dict(snapshot['tallies'])
+    if len(snapshot['entries']['keys']):
+        _insert(table, [snapshot['entries'][name] for name in ENTRY_FIELDS])
+    return table
+
+
+def flow_results(table):
+    # Counters and tallies with the flows still live finished too; the table
+    # itself is left as it is, so a live capture can keep feeding it
+    results = {name: table[name] for name in FLOW_COUNTERS}
+    tallies = dict(table['tallies'])
+    slots = np.flatnonzero(table['used'])
+    if len(slots):
+        outcomes = flow_outcomes({name: table[name][slots] for name in OUTCOME_FIELDS})
+        for name in FLOW_COUNTERS[:-1]:
+            results[name] += int(np.count_nonzero(outcomes[name]))
+        for (side, metric), sketch in tallies.items():
+            rest = new_topk_sketch(sketch['keys'].dtype, sketch['capacity'])
+            topk_update(rest, outcomes[side][outcomes[metric]])
+            tallies[(side, metric)] = merge_topk_sketches(sketch, rest)
+    results['tallies'] = tallies
+    return results
+
+
+def half_open_rows(results, limit):
+    # [(ip, role, half_open, handshakes)] for the top `limit` targets and
+    # sources by half-open handshakes; handshakes is None for an address the
+    # handshakes sketch does not track
+    rows = []
+    for side, role in (('targets', 'target'), ('sources', 'source')):
+        handshakes = results['tallies'][(side, 'handshakes')]
+        tracked = dict(zip(map(bytes, handshakes['keys']), handshakes['counts'].tolist()))
+        for key, count, _ in topk_items(results['tallies'][(side, 'half_open')], limit):
+            rows.append((format_address(key), role, count, tracked.get(bytes(key))))
+    return rows
@@ -0,0 +1,73 @@
+import hashlib
+
+# MD5 is kept for the file_hash column of older analyses, SHA-256 is the
+# integrity hash for the chain of custody
+HASH_ALGORITHMS = ('md5', 'sha256')
+HASH_BUFFER_SIZE = 4 << 20
+
+
+def new_hashers():
+    return {name: hashlib.new(name) for name in HASH_ALGORITHMS}
+
+
+def update_hashers(hashers, data):
+    for hasher in hashers.values():
+        hasher.update(data)
+
+
+def hexdigests(hashers):
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def copy_and_hash(source, destination=None, consumer=None, prefix=None):
+    # Reads `source` once, writing every block to `destination` (if any) and
+    # feeding it to all hashers on the way. `consumer` is called with every
+    # block too; the block is only valid until it returns. With `prefix`, the
+    # SHA-256 of the first `prefix` bytes is taken on the way as well, as
+    # 'prefix_sha256' (None if the source is shorter).
+    hashers = new_hashers()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    pos = 0
+    prefix_digest = hashlib.sha256().hexdigest() if prefix == 0 else None
+    while True:
+        size = source.readinto(buffer)
+        if not size:
+            break
+        block = view[:size]
+        if prefix is not None and pos < prefix <= pos + size:
+            prefix_hasher = hashers['sha256'].copy()
+            prefix_hasher.update(block[:prefix - pos])
+            prefix_digest = prefix_hasher.hexdigest()
+        pos += size
+        update_hashers(hashers, block)
+        if destination is not None:
+            destination.write(block)
+        if consumer is not None:
+            if destination is not None:
+                # Keep the evidence on disk up to date with what was consumed
+                destination.flush()
+            consumer(block)
+    digests = hexdigests(hashers)
+    if prefix is not None:
+        digests['prefix_sha256'] = prefix_digest
+    return digests
+
+
+def calculate_file_hashes(file_path, prefix=None):
+    with open(file_path, 'rb') as f:
+        return copy_and_hash(f, prefix=prefix)
+
+
+def calculate_prefix_hash(file_path, length):
+    # SHA-256 of the first `length` bytes of a file, None if it is shorter
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(HASH_BUFFER_SIZE, remaining))
+            if not data:
+                return None
+            hasher.update(data)
+            remaining -= len(data)
+    return hasher.hexdigest()
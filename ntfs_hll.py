@@ -0,0 +1,231 @@
+import io
+import zlib
+
+import numpy as np
+
+from ntfs_reader import format_address
+
+# A sketch has 2**precision one-byte registers and a standard error of about
+# 1.04 / sqrt(2**precision): 0.8% for the whole capture, 1.6% per
+# destination and 3.3% per time bucket
+HLL_PRECISION = 14
+HLL_DESTINATION_PRECISION = 12
+HLL_BUCKET_PRECISION = 10
+# Destinations, the busiest ones, that get their own sketches
+DISTINCT_DESTINATIONS = 32
+DISTINCT_BUCKET_SECONDS = 60
+
+# Source diversity of a target that points to a distributed attack; a
+# spoofed flood spreads over many /24s as well as many addresses
+DDOS_MIN_SOURCES = 100
+DDOS_MIN_NETWORKS = 10
+DOS_MAX_SOURCES = 3
+
+IPV4_MAPPED_HIGH = np.uint64(0)
+IPV4_MAPPED_LOW = np.uint64(0xFFFF << 32)
+IPV4_NETWORK_MASK = np.uint64(~0xFF & 0xFFFFFFFFFFFFFFFF)
+# IPv6 sources are grouped by /48 instead
+IPV6_NETWORK_MASK = np.uint64(~0xFFFF & 0xFFFFFFFFFFFFFFFF)
+
+_MIX = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+
+# HyperLogLog sketches of the distinct source addresses, and of the distinct
+# source /24 networks, seen in a capture, toward each of its busiest
+# destinations and in each time bucket. Memory is fixed per sketch whatever
+# the number of (possibly spoofed) sources, and two sketches merge by taking
+# the larger register, so the capture-wide and per-bucket counts of segments,
+# files, resumed analyses and whole cases combine exactly as if they had been
+# counted together. Per-destination counts are approximate across such
+# splits: a destination only counts sources from the chunk it became one of
+# the busiest, and merges keep the busiest destinations only.
+def _address_words(addresses):
+    words = np.ascontiguousarray(addresses).view('>u8').reshape(-1, 2).astype(np.uint64)
+    return words[:, 0], words[:, 1]
+
+
+def _network_words(high, low):
+    ipv4 = (high == IPV4_MAPPED_HIGH) & (low & np.uint64(0xFFFFFFFF << 32) == IPV4_MAPPED_LOW)
+    return (np.where(ipv4, high, high & IPV6_NETWORK_MASK),
+            np.where(ipv4, low & IPV4_NETWORK_MASK, np.uint64(0)))
+
+
+def _hash_words(high, low):
+    hashes = high * _MIX[0] ^ low
+    hashes ^= hashes >> np.uint64(30)
+    hashes *= _MIX[1]
+    hashes ^= hashes >> np.uint64(27)
+    hashes *= _MIX[2]
+    return hashes ^ hashes >> np.uint64(31)
+
+
+def _bit_length(values):
+    lengths = np.minimum(np.frexp(values.astype(np.float64))[1], 64).astype(np.int64)
+    # Converting to float may round up to the next power of two
+    over = (lengths > 0) & (np.uint64(1) << np.maximum(lengths - 1, 0).astype(np.uint64) > values)
+    return lengths - over
+
+
+def hll_add(registers, hashes, rows=None):
+    # Folds hashes into a sketch, or into rows of a 2-D array of sketches
+    precision = registers.shape[-1].bit_length() - 1
+    index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - precision)) - 1)
+    ranks = (64 - precision + 1 - _bit_length(rest)).astype(np.uint8)
+    np.maximum.at(registers, index if rows is None else (rows, index), ranks)
+
+
+def hll_estimate(registers):
+    # Distinct count of a sketch, or of every sketch along the last axis
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=-1)
+    zeros = np.count_nonzero(registers == 0, axis=-1)
+    # Linear counting is the better estimate while many registers are empty
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.rint(np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)).astype(np.int64)
+
+
+def new_distinct_state(bucket_seconds=DISTINCT_BUCKET_SECONDS):
+    return {
+        'sources': np.zeros(1 << HLL_PRECISION, dtype=np.uint8),
+        'networks': np.zeros(1 << HLL_PRECISION, dtype=np.uint8),
+        'bucket_seconds': bucket_seconds,
+        # Sorted bucket numbers (timestamp // bucket_seconds), one row of each
+        # sketch array per bucket
+        'buckets': np.zeros(0, dtype=np.int64),
+        'bucket_sources': np.zeros((0, 1 << HLL_BUCKET_PRECISION), dtype=np.uint8),
+        'bucket_networks': np.zeros((0, 1 << HLL_BUCKET_PRECISION), dtype=np.uint8),
+        # Sorted raw destination addresses, one row per destination
+        'destinations': np.zeros(0, dtype='V16'),
+        'destination_sources': np.zeros((0, 1 << HLL_DESTINATION_PRECISION), dtype=np.uint8),
+        'destination_networks': np.zeros((0, 1 << HLL_DESTINATION_PRECISION), dtype=np.uint8),
+    }
+
+
+def _align(keys, arrays, wanted):
+    # Rows for the sorted keys `wanted`: existing rows are kept, missing ones
+    # start empty and rows of keys not wanted are dropped
+    aligned = [np.zeros((len(wanted), array.shape[1]), dtype=array.dtype) for array in arrays]
+    if len(keys) and len(wanted):
+        pos = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        found = keys[pos] == wanted
+        for target, array in zip(aligned, arrays):
+            target[found] = array[pos[found]]
+    return aligned
+
+
+def _rows(keys, values):
+    # Row of every value in the sorted keys, -1 where it has none
+    if not len(keys):
+        return np.full(len(values), -1, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+    return np.where(keys[pos] == values, pos, -1)
+
+
+def distinct_update(state, ts, src, dst, destinations):
+    # `destinations` are the addresses to keep sketches for from now on, the
+    # busiest ones so far; a destination counts its sources from the chunk it
+    # became one of them
+    if not len(ts):
+        return
+    high, low = _address_words(src)
+    source_hashes = _hash_words(high, low)
+    network_hashes = _hash_words(*_network_words(high, low))
+    hll_add(state['sources'], source_hashes)
+    hll_add(state['networks'], network_hashes)
+
+    buckets = (ts // state['bucket_seconds']).astype(np.int64)
+    wanted = np.union1d(state['buckets'], np.unique(buckets))
+    if len(wanted) != len(state['buckets']):
+        state['bucket_sources'], state['bucket_networks'] = _align(
+            state['buckets'], (state['bucket_sources'], state['bucket_networks']), wanted)
+        state['buckets'] = wanted
+    rows = np.searchsorted(state['buckets'], buckets)
+    hll_add(state['bucket_sources'], source_hashes, rows)
+    hll_add(state['bucket_networks'], network_hashes, rows)
+
+    wanted = np.sort(np.asarray(destinations, dtype='V16'))
+    if len(wanted) != len(state['destinations']) or (wanted != state['destinations']).any():
+        state['destination_sources'], state['destination_networks'] = _align(
+            state['destinations'], (state['destination_sources'], state['destination_networks']), wanted)
+        state['destinations'] = wanted
+    rows = _rows(state['destinations'], dst)
+    tracked = rows >= 0
+    hll_add(state['destination_sources'], source_hashes[tracked], rows[tracked])
+    hll_add(state['destination_networks'], network_hashes[tracked], rows[tracked])
+
+
+def merge_distinct_states(first, second, destinations=None):
+    # Destinations of both states, or only `destinations` when given
+    merged = {
+        'sources': np.maximum(first['sources'], second['sources']),
+        'networks': np.maximum(first['networks'], second['networks']),
+        'bucket_seconds': first['bucket_seconds'],
+    }
+    for key, names in (('buckets', ('bucket_sources', 'bucket_networks')),
+                       ('destinations', ('destination_sources', 'destination_networks'))):
+        if key == 'destinations' and destinations is not None:
+            wanted = np.sort(np.asarray(destinations, dtype='V16'))
+        else:
+            wanted = np.union1d(first[key], second[key])
+        parts = [_align(state[key], [state[name] for name in names], wanted) for state in (first, second)]
+        merged[key] = wanted
+        for name, one, other in zip(names, *parts):
+            merged[name] = np.maximum(one, other)
+    return merged
+
+
+def distinct_summary(state, limit=DISTINCT_DESTINATIONS):
+    # Estimates of a state: {'sources', 'networks', 'destinations': [(ip,
+    # sources, networks)] most sources first, 'peak': (bucket start, sources,
+    # networks) of the bucket with the most sources, or None}
+    summary = {
+        'sources': int(hll_estimate(state['sources'])),
+        'networks': int(hll_estimate(state['networks'])),
+        'destinations': [],
+        'peak': None,
+    }
+    if len(state['destinations']):
+        sources = hll_estimate(state['destination_sources'])
+        networks = hll_estimate(state['destination_networks'])
+        order = np.lexsort((np.arange(len(sources)), -sources))[:limit]
+        summary['destinations'] = [(format_address(state['destinations'][i]), int(sources[i]), int(networks[i]))
+                                   for i in order]
+    if len(state['buckets']):
+        sources = hll_estimate(state['bucket_sources'])
+        i = int(np.argmax(sources))
+        summary['peak'] = (int(state['buckets'][i]) * state['bucket_seconds'], int(sources[i]),
+                           int(hll_estimate(state['bucket_networks'][i])))
+    return summary
+
+
+def merged_distinct_summary(states):
+    # Summary of several states together, e.g. of every file of a case; None
+    # when there are none
+    merged = None
+    for state in states:
+        merged = state if merged is None else merge_distinct_states(merged, state)
+    return distinct_summary(merged) if merged is not None else None
+
+
+def classify_sources(sources, networks):
+    # How spread out the traffic toward a target is, the DoS / DDoS distinction
+    if sources >= DDOS_MIN_SOURCES and networks >= DDOS_MIN_NETWORKS:
+        return "distributed, consistent with a DDoS attack"
+    if sources <= DOS_MAX_SOURCES:
+        return "single or few sources, consistent with a DoS attack"
+    return "several sources"
+
+
+def distinct_to_blob(state):
+    buffer = io.BytesIO()
+    np.savez(buffer, **state)
+    return zlib.compress(buffer.getvalue())
+
+
+def distinct_from_blob(blob):
+    with np.load(io.BytesIO(zlib.decompress(blob)), allow_pickle=False) as data:
+        state = {name: data[name] for name in data.files}
+    state['bucket_seconds'] = int(state['bucket_seconds'])
+    return state
@@ -0,0 +1,324 @@
+import datetime
+import io
+import ipaddress
+import mmap
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from ntfs_pcap import PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN, IPPROTO_TCP, IPPROTO_UDP, read_pcap_header, \
+    is_plain_pcap
+from ntfs_reader import PACKET_DTYPE, IPV4_MAPPED_PREFIX, decode_columns, iter_capture_columns
+from ntfs_sketch import unique_keys
+from ntfs_store import is_store_pcap, new_store_cursor, store_read
+
+# Saved with every index; bump it whenever the layout of the index changes
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.idx.npz'
+# Postings of the index: packets by source, destination, port (either end) and IP protocol
+INDEX_KEYS = ('src', 'dst', 'port', 'proto')
+INDEX_KEY_DTYPES = {'src': 'V16', 'dst': 'V16', 'port': '<u2', 'proto': 'u1'}
+# Pending packets are turned into postings once there are this many
+INDEX_COMPACT_PACKETS = 1 << 20
+# Fastest deflate level: most of the size is saved already and saving the
+# index stays a small part of the analysis
+INDEX_COMPRESS_LEVEL = 1
+PROTOCOL_NUMBERS = {'icmp': 1, 'tcp': IPPROTO_TCP, 'udp': IPPROTO_UDP, 'icmp6': 58}
+
+
+# Sidecar index of a capture: the offset and timestamp of every packet by
+# packet number, and for every source, destination, port and protocol the
+# numbers of the packets that have it (a posting list, in capture order).
+# It is built from the same columns as the analysis, in the same pass, and
+# saved next to the capture as a hidden .npz file so glob patterns over
+# outputs/ do not pick it up.
+def packet_index_path(pcap_file):
+    directory, name = os.path.split(pcap_file)
+    return os.path.join(directory, f".{name}{INDEX_SUFFIX}")
+
+
+def new_packet_index():
+    return {
+        'packets': 0,
+        'offsets': [],
+        'ts': [],
+        # (keys, packet numbers) of the packets not turned into postings yet
+        'pending': {key: [] for key in INDEX_KEYS},
+        'pending_packets': 0,
+        # (keys, counts, packet numbers grouped by key) of every compacted run of packets
+        'parts': {key: [] for key in INDEX_KEYS},
+    }
+
+
+def index_update(index, columns):
+    numbers = np.arange(index['packets'], index['packets'] + len(columns), dtype=np.uint32)
+    is_ip = columns['ip_version'] != 0
+    has_ports = columns['has_ports']
+    # A packet is listed once under a port both of its ends use
+    other_port = has_ports & (columns['dport'] != columns['sport'])
+    port_numbers = np.concatenate([numbers[has_ports], numbers[other_port]])
+    port_order = np.argsort(port_numbers, kind='stable')
+    # Entries of every key are in capture order
+    entries = {
+        'src': (columns['src'][is_ip], numbers[is_ip]),
+        'dst': (columns['dst'][is_ip], numbers[is_ip]),
+        'port': (np.concatenate([columns['sport'][has_ports], columns['dport'][other_port]])[port_order],
+                 port_numbers[port_order]),
+        'proto': (columns['proto'][is_ip], numbers[is_ip]),
+    }
+    for key, entry in entries.items():
+        index['pending'][key].append(entry)
+    index['offsets'].append(columns['offset'].astype(np.int64))
+    index['ts'].append(columns['ts'].astype(np.float64))
+    index['packets'] += len(columns)
+    index['pending_packets'] += len(columns)
+    if index['pending_packets'] >= INDEX_COMPACT_PACKETS:
+        _compact(index)
+
+
+def _compact(index):
+    for key in INDEX_KEYS:
+        pending = index['pending'][key]
+        if not pending:
+            continue
+        keys = np.concatenate([entry[0] for entry in pending])
+        numbers = np.concatenate([entry[1] for entry in pending])
+        uniq, inverse = unique_keys(keys)
+        # Stable, so the packets of every key stay in capture order
+        order = np.argsort(inverse, kind='stable')
+        index['parts'][key].append((uniq, np.bincount(inverse, minlength=len(uniq)), numbers[order]))
+        index['pending'][key] = []
+    index['pending_packets'] = 0
+
+
+def merge_packet_indexes(first, second):
+    # `second` covers the packets right after those of `first`. Both are
+    # compacted first, which changes how they are kept but not what they hold.
+    _compact(first)
+    _compact(second)
+    shift = np.uint32(first['packets'])
+    return {
+        'packets': first['packets'] + second['packets'],
+        'offsets': first['offsets'] + second['offsets'],
+        'ts': first['ts'] + second['ts'],
+        'pending': {key: [] for key in INDEX_KEYS},
+        'pending_packets': 0,
+        'parts': {key: first['parts'][key] + [(keys, counts, numbers + shift)
+                                              for keys, counts, numbers in second['parts'][key]]
+                  for key in INDEX_KEYS},
+    }
+
+
+def _merge_postings(parts, key_dtype):
+    # One posting list per key; parts are in capture order, so a stable sort
+    # by key keeps every list in capture order
+    if not parts:
+        return np.zeros(0, dtype=key_dtype), np.zeros(1, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+    keys, inverse = unique_keys(np.concatenate([part[0] for part in parts]))
+    ids = np.repeat(inverse, np.concatenate([part[1] for part in parts]))
+    numbers = np.concatenate([part[2] for part in parts])
+    starts = np.zeros(len(keys) + 1, dtype=np.uint32)
+    starts[1:] = np.cumsum(np.bincount(ids, minlength=len(keys)))
+    return keys, starts, numbers[np.argsort(ids, kind='stable')]
+
+
+def save_packet_index(pcap_file, index):
+    _compact(index)
+    file_stat = os.stat(pcap_file)
+    arrays = {
+        'version': np.int64(INDEX_VERSION),
+        # The index is only used while the capture keeps this size and mtime
+        'file_size': np.int64(file_stat.st_size),
+        'file_mtime': np.int64(file_stat.st_mtime_ns),
+        'offsets': np.concatenate(index['offsets']) if index['offsets'] else np.zeros(0, dtype=np.int64),
+        'ts': np.concatenate(index['ts']) if index['ts'] else np.zeros(0, dtype=np.float64),
+    }
+    for key in INDEX_KEYS:
+        keys, starts, numbers = _merge_postings(index['parts'][key], INDEX_KEY_DTYPES[key])
+        arrays[f'{key}_keys'] = keys
+        arrays[f'{key}_starts'] = starts
+        arrays[f'{key}_packets'] = numbers
+
+    # Same layout as np.savez_compressed, at a faster compression level
+    index_file = packet_index_path(pcap_file)
+    temp_file = index_file + '.tmp'
+    with zipfile.ZipFile(temp_file, 'w', zipfile.ZIP_DEFLATED, compresslevel=INDEX_COMPRESS_LEVEL) as archive:
+        for name, array in arrays.items():
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, array)
+    os.replace(temp_file, index_file)
+    return index_file
+
+
+def load_packet_index(pcap_file):
+    # {name: array} of the capture's index, or None if it has none or the
+    # capture changed since it was built
+    try:
+        file_stat = os.stat(pcap_file)
+        with np.load(packet_index_path(pcap_file)) as data:
+            if (int(data['version']) != INDEX_VERSION or int(data['file_size']) != file_stat.st_size
+                    or int(data['file_mtime']) != file_stat.st_mtime_ns):
+                return None
+            return {name: data[name] for name in data.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def build_packet_index(pcap_file):
+    index = new_packet_index()
+    for columns in iter_capture_columns(pcap_file):
+        index_update(index, columns)
+    save_packet_index(pcap_file, index)
+
+
+def open_packet_index(pcap_file):
+    # Captures analyzed before indexes existed, or taken from the analysis
+    # cache, are indexed on first use
+    index = load_packet_index(pcap_file)
+    if index is None:
+        build_packet_index(pcap_file)
+        index = load_packet_index(pcap_file)
+    return index
+
+
+def remove_packet_index(pcap_file):
+    try:
+        os.remove(packet_index_path(pcap_file))
+    except FileNotFoundError:
+        pass
+
+
+def address_key(address):
+    # Raw address as kept in the src/dst columns, IPv4 mapped into IPv6
+    address = ipaddress.ip_address(address)
+    raw = address.packed if address.version == 6 else IPV4_MAPPED_PREFIX + address.packed
+    return np.frombuffer(raw, dtype='V16')[0]
+
+
+def protocol_number(proto):
+    if isinstance(proto, str) and not proto.isdigit():
+        if proto.lower() not in PROTOCOL_NUMBERS:
+            raise ValueError(f"Unknown protocol: {proto}")
+        return PROTOCOL_NUMBERS[proto.lower()]
+    return int(proto)
+
+
+def parse_capture_time(text, reference_ts=None):
+    # Epoch seconds, an ISO date and time, or a time of day (HH:MM[:SS]) on the
+    # date of `reference_ts`, e.g. the capture's first packet; local time like
+    # tcpdump prints
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        pass
+    try:
+        clock = datetime.time.fromisoformat(text)
+    except ValueError:
+        raise ValueError(f"Invalid time: {text}") from None
+    day = datetime.date.fromtimestamp(reference_ts) if reference_ts is not None else datetime.date.today()
+    return datetime.datetime.combine(day, clock).timestamp()
+
+
+def posting(index, key, value):
+    keys = index[f'{key}_keys']
+    value = np.array(value, dtype=keys.dtype)
+    i = int(np.searchsorted(keys, value))
+    if i == len(keys) or keys[i] != value:
+        return np.zeros(0, dtype=np.uint32)
+    starts = index[f'{key}_starts']
+    return index[f'{key}_packets'][starts[i]:starts[i + 1]]
+
+
+def query_packet_index(index, src=None, dst=None, host=None, port=None, proto=None, start=None, end=None):
+    # Numbers of the packets matching every condition given, in capture order.
+    # Hosts are IP address strings, `host` matches either end; times are epoch
+    # seconds, `end` excluded.
+    selections = []
+    if src is not None:
+        selections.append(posting(index, 'src', address_key(src)))
+    if dst is not None:
+        selections.append(posting(index, 'dst', address_key(dst)))
+    if host is not None:
+        key = address_key(host)
+        selections.append(np.union1d(posting(index, 'src', key), posting(index, 'dst', key)))
+    if port is not None:
+        selections.append(posting(index, 'port', int(port)))
+    if proto is not None:
+        selections.append(posting(index, 'proto', protocol_number(proto)))
+
+    # Shortest posting list first, every intersection only gets smaller
+    selections.sort(key=len)
+    numbers = None
+    for selection in selections:
+        numbers = selection if numbers is None else np.intersect1d(numbers, selection, assume_unique=True)
+    if start is None and end is None:
+        return np.arange(len(index['ts']), dtype=np.uint32) if numbers is None else numbers
+
+    ts = index['ts'] if numbers is None else index['ts'][numbers]
+    mask = np.ones(len(ts), dtype=bool)
+    if start is not None:
+        mask &= ts >= start
+    if end is not None:
+        mask &= ts < end
+    return np.flatnonzero(mask).astype(np.uint32) if numbers is None else numbers[mask]
+
+
+def filter_packet_index(index, src=None, dst=None, host=None, port=None, proto=None, start=None, end=None):
+    # query_packet_index with the times given as text, see parse_capture_time
+    first_ts = float(index['ts'][0]) if len(index['ts']) else None
+    start = parse_capture_time(start, first_ts) if start else None
+    end = parse_capture_time(end, first_ts) if end else None
+    return query_packet_index(index, src, dst, host, port, proto, start, end)
+
+
+def iter_indexed_records(pcap_file, index, numbers):
+    # Raw records (header and data) of the given packets of a pcap, read
+    # directly at their offsets; the first item is the pcap global header.
+    # Only pcap files and pcaps in the evidence store can be read this way.
+    offsets = index['offsets'][numbers]
+    if is_plain_pcap(pcap_file):
+        with open(pcap_file, 'rb') as f:
+            global_header = f.read(PCAP_GLOBAL_HEADER_LEN)
+            header = read_pcap_header(io.BytesIO(global_header))
+            yield global_header
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                caplen_at = struct.Struct(header.endian + 'I').unpack_from
+                for offset in offsets.tolist():
+                    yield mm[offset:offset + PCAP_RECORD_HEADER_LEN + caplen_at(mm, offset + 8)[0]]
+        return
+
+    cursor = new_store_cursor(pcap_file)
+    global_header = store_read(cursor, 0, PCAP_GLOBAL_HEADER_LEN)
+    caplen_at = struct.Struct(read_pcap_header(io.BytesIO(global_header)).endian + 'I').unpack_from
+    yield global_header
+    for offset in offsets.tolist():
+        record_header = store_read(cursor, offset, offset + PCAP_RECORD_HEADER_LEN)
+        caplen = caplen_at(record_header, 8)[0]
+        yield record_header + store_read(cursor, offset + PCAP_RECORD_HEADER_LEN,
+                                         offset + PCAP_RECORD_HEADER_LEN + caplen)
+
+
+def read_indexed_columns(pcap_file, index, numbers):
+    # Columns of the given packets; pcaps, plain or in the evidence store, only
+    # have those packets read, other formats are scanned for their offsets
+    if is_plain_pcap(pcap_file) or is_store_pcap(pcap_file):
+        records = iter_indexed_records(pcap_file, index, numbers)
+        header = read_pcap_header(io.BytesIO(next(records)))
+        records = list(records)
+        if not records:
+            return np.zeros(0, dtype=PACKET_DTYPE)
+        lengths = np.array([len(record) for record in records], dtype=np.int64)
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        columns = decode_columns(np.frombuffer(b''.join(records), dtype=np.uint8), starts, header)
+        columns['offset'] = index['offsets'][numbers]
+        return columns
+
+    wanted = index['offsets'][numbers]
+    chunks = [columns[np.isin(columns['offset'], wanted)] for columns in iter_capture_columns(pcap_file)]
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=PACKET_DTYPE)
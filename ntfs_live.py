@@ -0,0 +1,101 @@
+import os
+import time
+
+import numpy as np
+
+from ntfs_analysis import CHECK_WINDOWS, check_alerts, apply_ratio_checks, print_analysis_details
+from ntfs_data import insert_pcap_analyses
+from ntfs_engine import (
+    ANALYZER_VERSION, COUNTER_NAMES, new_analysis_state, update_analysis_state, counter_masks,
+    analysis_details_from_state,
+)
+from ntfs_index import save_packet_index
+from ntfs_reader import new_pcap_stream, feed_pcap_stream
+
+# Sliding windows, in seconds of capture time, the ratio checks are evaluated over
+LIVE_WINDOWS = CHECK_WINDOWS
+
+
+# Analysis of a capture while tcpdump is still writing it. Packets go through
+# the same counters as a file analysis; per-second counters of the last
+# max(LIVE_WINDOWS) seconds feed the rolling checks.
+def new_live_state():
+    return {
+        'stream': new_pcap_stream(),
+        'analysis': new_analysis_state(build_index=True),
+        'seconds': {},
+        'current': None,
+        'alerts': {window: None for window in LIVE_WINDOWS},
+    }
+
+
+def window_counts(live, end, window):
+    counts = np.zeros(len(COUNTER_NAMES), dtype=np.int64)
+    for second in range(end - window + 1, end + 1):
+        if second in live['seconds']:
+            counts += live['seconds'][second]
+    return dict(zip(COUNTER_NAMES, counts.tolist()))
+
+
+def check_windows(live, end):
+    # Alerts print only when a window's verdict changes, not on every second
+    for window in LIVE_WINDOWS:
+        counts = window_counts(live, end, window)
+        alerts = check_alerts(counts)
+        if alerts == (live['alerts'][window] or ()):
+            continue
+        stamp = time.strftime('%H:%M:%S', time.localtime(end))
+        if alerts:
+            for message in alerts:
+                print(f"[{stamp}] {window}s window: {message} "
+                      f"(SYN {counts['syn_count']}, SYN-ACK {counts['syn_ack_count']}, "
+                      f"TCP {counts['tcp_count']}, UDP {counts['udp_count']})")
+        elif live['alerts'][window]:
+            print(f"[{stamp}] {window}s window: back within thresholds.")
+        live['alerts'][window] = alerts
+
+
+def feed_live_capture(live, data):
+    columns = feed_pcap_stream(live['stream'], data)
+    if not len(columns):
+        return
+    update_analysis_state(live['analysis'], columns)
+
+    masks = counter_masks(columns)
+    per_packet = np.stack([masks[name] for name in COUNTER_NAMES], axis=1).astype(np.int64)
+    seconds, inverse = np.unique(np.floor(columns['ts']).astype(np.int64), return_inverse=True)
+    per_second = np.zeros((len(seconds), len(COUNTER_NAMES)), dtype=np.int64)
+    np.add.at(per_second, inverse.ravel(), per_packet)
+
+    # Capture time, not wall-clock time, decides when a second is complete
+    for second, counts in zip(seconds.tolist(), per_second):
+        if live['current'] is not None and second > live['current']:
+            check_windows(live, live['current'])
+        if second in live['seconds']:
+            live['seconds'][second] += counts
+        else:
+            live['seconds'][second] = counts
+        if live['current'] is None or second > live['current']:
+            live['current'] = second
+
+    oldest = live['current'] - max(LIVE_WINDOWS) + 1
+    for second in [second for second in live['seconds'] if second < oldest]:
+        del live['seconds'][second]
+
+
+def finish_live_capture(live, connection, case_name, org_name, output_file, file_hashes):
+    # The last, possibly partial, second still gets its checks
+    if live['current'] is not None:
+        check_windows(live, live['current'])
+
+    # The counters and the packet index already cover the whole capture, so it is not read again
+    save_packet_index(output_file, live['analysis']['index'])
+    file_stat = os.stat(output_file)
+    analysis_details = analysis_details_from_state(live['analysis'])
+    analysis_details.update(analyzer_version=ANALYZER_VERSION, file_size=file_stat.st_size,
+                            file_mtime=file_stat.st_mtime_ns, file_sha256=file_hashes['sha256'])
+    apply_ratio_checks(analysis_details)
+    print_analysis_details(analysis_details)
+    if insert_pcap_analyses(connection, case_name, org_name,
+                            [(os.path.basename(output_file), analysis_details, file_hashes['md5'])]):
+        print("Analysis complete. Details stored in the database.")
@@ -0,0 +1,114 @@
+import gzip
+import lzma
+import struct
+from collections import namedtuple
+
+# zstd-compressed captures need the zstandard package; gzip and xz only the
+# standard library
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAP_GLOBAL_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IP = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8, 0x9100)
+
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+IPPROTO_FRAGMENT = 44
+
+# pcapng block types and options, see the pcapng specification
+PCAPNG_SECTION_HEADER = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_INTERFACE_DESCRIPTION = 1
+PCAPNG_OBSOLETE_PACKET = 2
+PCAPNG_SIMPLE_PACKET = 3
+PCAPNG_ENHANCED_PACKET = 6
+PCAPNG_OPTION_END = 0
+PCAPNG_IF_TSRESOL = 9
+PCAPNG_IF_TSOFFSET = 14
+# Timestamps are in microseconds unless if_tsresol says otherwise
+PCAPNG_DEFAULT_TSRESOL = 6
+
+# Compression formats recognized by their magic number
+COMPRESSION_MAGIC = {
+    'gzip': b'\x1f\x8b',
+    'zstd': b'\x28\xb5\x2f\xfd',
+    'xz': b'\xfd7zXZ\x00',
+}
+CAPTURE_EXTENSIONS = ('.pcap', '.pcapng')
+COMPRESSED_EXTENSIONS = ('.gz', '.zst', '.xz')
+
+# BSD loopback address families for IPv6 (libpcap only matches these on DLT_NULL)
+NULL_AF_INET = 2
+NULL_AF_INET6 = (24, 28, 30)
+
+PcapHeader = namedtuple('PcapHeader', 'endian nanosecond snaplen linktype')
+
+def capture_extension(filename):
+    # '.pcap', '.pcapng', optionally followed by a compression extension, or
+    # None if the name is not one of a capture
+    name = filename.lower()
+    compressed = next((ext for ext in COMPRESSED_EXTENSIONS if name.endswith(ext)), '')
+    name = name[:len(name) - len(compressed)]
+    capture = next((ext for ext in CAPTURE_EXTENSIONS if name.endswith(ext)), None)
+    return capture + compressed if capture else None
+
+
+def capture_compression(path):
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    return next((name for name, prefix in COMPRESSION_MAGIC.items() if magic.startswith(prefix)), None)
+
+
+def open_capture(path):
+    # Binary file object of the capture, decompressed on the fly if needed
+    compression = capture_compression(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'xz':
+        return lzma.open(path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError("Reading zstd-compressed captures needs the zstandard package")
+        # Captures compressed in several frames (e.g. appended segments) are read whole
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True,
+                                                          closefd=True)
+    return open(path, 'rb')
+
+
+def is_plain_pcap(path):
+    # Uncompressed classic pcap, the format that can be memory-mapped and split
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    return len(magic) == 4 and (struct.unpack('<I', magic)[0] in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC)
+                                or struct.unpack('>I', magic)[0] in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC))
+
+
+def read_pcap_header(f):
+    header = f.read(PCAP_GLOBAL_HEADER_LEN)
+    if len(header) < PCAP_GLOBAL_HEADER_LEN:
+        raise ValueError("File is too short to be a pcap file")
+
+    for endian in ('<', '>'):
+        magic = struct.unpack(endian + 'I', header[:4])[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            _, _, _, _, snaplen, network = struct.unpack(endian + 'HHiIII', header[4:])
+            return PcapHeader(endian, magic == PCAP_MAGIC_NSEC, snaplen, network & 0xffff)
+
+    raise ValueError("Unsupported capture format (not a pcap file)")
@@ -0,0 +1,534 @@
+import io
+import mmap
+import socket
+import struct
+
+import numpy as np
+
+from ntfs_pcap import (
+    read_pcap_header,
+    open_capture,
+    is_plain_pcap,
+    PCAP_GLOBAL_HEADER_LEN,
+    PCAP_RECORD_HEADER_LEN,
+    LINKTYPE_NULL,
+    LINKTYPE_ETHERNET,
+    LINKTYPE_RAW,
+    LINKTYPE_LOOP,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_IPV4,
+    LINKTYPE_IPV6,
+    LINKTYPE_LINUX_SLL2,
+    ETHERTYPE_IP,
+    ETHERTYPE_IPV6,
+    ETHERTYPE_VLAN,
+    IPPROTO_TCP,
+    IPPROTO_UDP,
+    IPPROTO_FRAGMENT,
+    NULL_AF_INET,
+    NULL_AF_INET6,
+    PCAPNG_SECTION_HEADER,
+    PCAPNG_BYTE_ORDER_MAGIC,
+    PCAPNG_INTERFACE_DESCRIPTION,
+    PCAPNG_OBSOLETE_PACKET,
+    PCAPNG_SIMPLE_PACKET,
+    PCAPNG_ENHANCED_PACKET,
+    PCAPNG_OPTION_END,
+    PCAPNG_IF_TSRESOL,
+    PCAPNG_IF_TSOFFSET,
+    PCAPNG_DEFAULT_TSRESOL,
+)
+from ntfs_store import read_seek_table, iter_store_frames, read_store_range, frame_index, store_content_size
+
+CHUNK_PACKETS = 1 << 18
+# Decompressed bytes read at a time from captures that cannot be memory-mapped
+STREAM_READ_BYTES = 4 << 20
+
+# Parallel analysis splits captures into segments of about this size
+SEGMENT_BYTES = 64 << 20
+# A candidate split point must start this many consecutive plausible records
+BOUNDARY_CHAIN = 16
+BOUNDARY_SCAN_LIMIT = 16 << 20
+MAX_RECORD_LEN = 1 << 18
+MAX_WIRE_LEN = 1 << 24
+MAX_CAPTURE_SPAN = 366 * 24 * 3600
+
+# Addresses are kept as 16 raw bytes, IPv4 in its IPv4-mapped IPv6 form
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+PACKET_DTYPE = np.dtype([
+    ('offset', '<i8'),
+    ('ts', '<f8'),
+    ('caplen', '<u4'),
+    ('wirelen', '<u4'),
+    ('ip_version', 'u1'),
+    ('encapsulated', '?'),
+    ('proto', 'u1'),
+    ('fragment', '<u2'),
+    # IPv4 only: the more-fragments flag and the identification shared by the
+    # fragments of a datagram
+    ('more_fragments', '?'),
+    ('ip_id', '<u2'),
+    # Length of the IP payload according to the header, not to what was captured
+    ('ip_payload', '<u2'),
+    ('src', 'V16'),
+    ('dst', 'V16'),
+    ('has_ports', '?'),
+    ('sport', '<u2'),
+    ('dport', '<u2'),
+    ('has_flags', '?'),
+    ('tcp_flags', 'u1'),
+])
+
+
+def format_address(raw):
+    raw = bytes(raw)
+    if raw.startswith(IPV4_MAPPED_PREFIX):
+        return socket.inet_ntop(socket.AF_INET, raw[12:])
+    return socket.inet_ntop(socket.AF_INET6, raw)
+
+
+def _record_offsets(mm, endian, start, end, limit):
+    caplen_at = struct.Struct(endian + 'I').unpack_from
+    size = len(mm)
+    offsets = []
+    pos = start
+    # Records that start before `end` belong to this range, even if they run past it
+    while pos < end and pos + PCAP_RECORD_HEADER_LEN <= size and len(offsets) < limit:
+        caplen = caplen_at(mm, pos + 8)[0]
+        if pos + PCAP_RECORD_HEADER_LEN + caplen > size:
+            # Truncated final record
+            break
+        offsets.append(pos)
+        pos += PCAP_RECORD_HEADER_LEN + caplen
+    return np.array(offsets, dtype=np.int64), pos
+
+
+class _Gather:
+    # Bounds-checked byte gathers from the mapped file, relative to each packet
+
+    def __init__(self, buf, data_start, caplen):
+        self.buf = buf
+        self.last = len(buf) - 1
+        self.data_start = data_start
+        self.caplen = caplen
+
+    def available(self, pos, length):
+        return self.caplen >= pos + length
+
+    def u8(self, pos, valid=None):
+        index = np.minimum(self.data_start + pos, self.last)
+        values = self.buf[index].astype(np.uint32)
+        if valid is None:
+            valid = self.available(pos, 1)
+        return np.where(valid, values, 0)
+
+    def u16(self, pos, valid=None):
+        if valid is None:
+            valid = self.available(pos, 2)
+        return (self.u8(pos, valid) << 8) | self.u8(pos + 1, valid)
+
+    def u32(self, pos, endian='>', valid=None):
+        if valid is None:
+            valid = self.available(pos, 4)
+        b = [self.u8(pos + i, valid).astype(np.uint64) for i in range(4)]
+        if endian == '<':
+            b.reverse()
+        return (b[0] << 24) | (b[1] << 16) | (b[2] << 8) | b[3]
+
+    def raw(self, pos, length, valid):
+        index = (self.data_start + pos)[:, None] + np.arange(length)
+        values = self.buf[np.minimum(index, self.last)]
+        return np.where(valid[:, None], values, 0).astype(np.uint8)
+
+
+def _network_layer(gather, linktype, endian, n):
+    ethertype = np.zeros(n, dtype=np.uint32)
+    net = np.zeros(n, dtype=np.int64)
+    encapsulated = np.zeros(n, dtype=bool)
+
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype = gather.u16(np.full(n, 12))
+        net = np.full(n, 14, dtype=np.int64)
+        vlan = np.isin(ethertype, ETHERTYPE_VLAN) & gather.available(net, 4)
+        while vlan.any():
+            ethertype = np.where(vlan, gather.u16(net + 2), ethertype)
+            net = np.where(vlan, net + 4, net)
+            encapsulated |= vlan
+            vlan &= np.isin(ethertype, ETHERTYPE_VLAN) & gather.available(net, 4)
+    elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        version = gather.u8(net) >> 4
+        ethertype = np.select([version == 4, version == 6], [ETHERTYPE_IP, ETHERTYPE_IPV6], 0)
+    elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        family = gather.u32(net, '>' if linktype == LINKTYPE_LOOP else endian)
+        ethertype = np.select([family == NULL_AF_INET, np.isin(family, NULL_AF_INET6)],
+                              [ETHERTYPE_IP, ETHERTYPE_IPV6], 0)
+        net = np.full(n, 4, dtype=np.int64)
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype = gather.u16(np.full(n, 14))
+        net = np.full(n, 16, dtype=np.int64)
+    elif linktype == LINKTYPE_LINUX_SLL2:
+        ethertype = gather.u16(np.zeros(n, dtype=np.int64))
+        net = np.full(n, 20, dtype=np.int64)
+
+    return ethertype, net, encapsulated
+
+
+def decode_columns(buf, offsets, header):
+    n = len(offsets)
+    if n == 0:
+        return np.zeros(n, dtype=PACKET_DTYPE)
+
+    endian = header.endian
+    record = _Gather(buf, offsets, np.full(n, PCAP_RECORD_HEADER_LEN))
+    ts_sec = record.u32(np.zeros(n, dtype=np.int64), endian)
+    ts_frac = record.u32(np.full(n, 4), endian)
+    caplen = record.u32(np.full(n, 8), endian)
+    wirelen = record.u32(np.full(n, 12), endian)
+    ts = ts_sec + ts_frac / (1e9 if header.nanosecond else 1e6)
+    return decode_packets(buf, offsets, offsets + PCAP_RECORD_HEADER_LEN, ts, caplen, wirelen,
+                          header.linktype, endian)
+
+
+def decode_packets(buf, offsets, data_start, ts, caplen, wirelen, linktype, endian):
+    # Columns of packets whose link-layer data starts at `data_start` in `buf`;
+    # `offsets` only label the packets, see PACKET_DTYPE
+    n = len(offsets)
+    columns = np.zeros(n, dtype=PACKET_DTYPE)
+    if n == 0:
+        return columns
+
+    columns['offset'] = offsets
+    columns['ts'] = ts
+    columns['caplen'] = caplen
+    columns['wirelen'] = wirelen
+
+    gather = _Gather(buf, data_start, np.asarray(caplen).astype(np.int64))
+    ethertype, net, encapsulated = _network_layer(gather, linktype, endian, n)
+    columns['encapsulated'] = encapsulated
+
+    src = np.zeros((n, 16), dtype=np.uint8)
+    dst = np.zeros((n, 16), dtype=np.uint8)
+
+    # IPv4
+    v4 = (ethertype == ETHERTYPE_IP) & gather.available(net, 20)
+    ihl = (gather.u8(net, v4) & 0x0f).astype(np.int64) * 4
+    proto4 = gather.u8(net + 9, v4)
+    flags_fragment4 = gather.u16(net + 6, v4)
+    fragment4 = flags_fragment4 & 0x1fff
+    payload4 = np.maximum(gather.u16(net + 2, v4).astype(np.int64) - ihl, 0)
+    src[v4, 10:12] = 0xff
+    dst[v4, 10:12] = 0xff
+    src[v4, 12:] = gather.raw(net + 12, 4, v4)[v4]
+    dst[v4, 12:] = gather.raw(net + 16, 4, v4)[v4]
+    transport4 = net + ihl
+    first4 = v4 & (fragment4 == 0)
+    ports4 = first4 & np.isin(proto4, (IPPROTO_TCP, IPPROTO_UDP)) & gather.available(transport4, 4)
+    flags4 = first4 & (proto4 == IPPROTO_TCP) & gather.available(transport4, 14)
+
+    # IPv6, `tcp`/`udp` look through a single fragment header, `port` does not
+    v6 = (ethertype == ETHERTYPE_IPV6) & gather.available(net, 40)
+    next_header = gather.u8(net + 6, v6)
+    transport6 = net + 40
+    fragmented6 = v6 & (next_header == IPPROTO_FRAGMENT) & gather.available(transport6, 1)
+    proto6 = np.where(fragmented6, gather.u8(transport6, fragmented6), next_header)
+    src[v6] = gather.raw(net + 8, 16, v6)[v6]
+    dst[v6] = gather.raw(net + 24, 16, v6)[v6]
+    ports6 = v6 & np.isin(next_header, (IPPROTO_TCP, IPPROTO_UDP)) & gather.available(transport6, 4)
+
+    transport = np.where(v4, transport4, transport6)
+    has_ports = ports4 | ports6
+
+    columns['ip_version'] = np.select([v4, v6], [4, 6], 0)
+    columns['proto'] = np.select([v4, v6], [proto4, proto6], 0)
+    columns['fragment'] = np.select([v4, v6], [fragment4, fragmented6], 0)
+    columns['more_fragments'] = v4 & (flags_fragment4 & 0x2000 != 0)
+    columns['ip_id'] = np.where(v4, gather.u16(net + 4, v4), 0)
+    columns['ip_payload'] = np.select([v4, v6], [payload4, gather.u16(net + 4, v6)], 0)
+    columns['src'] = src.view('V16').ravel()
+    columns['dst'] = dst.view('V16').ravel()
+    columns['has_ports'] = has_ports
+    columns['sport'] = gather.u16(transport, has_ports)
+    columns['dport'] = gather.u16(transport + 2, has_ports)
+    # tcp[13] is computed from the IPv4 header length, so it never matches IPv6
+    columns['has_flags'] = flags4
+    columns['tcp_flags'] = gather.u8(transport + 13, flags4)
+    return columns
+
+
+def _plausible_chain(mm, record, pos, frac_limit, first_ts):
+    size = len(mm)
+    for _ in range(BOUNDARY_CHAIN):
+        if pos == size:
+            return True
+        if pos + PCAP_RECORD_HEADER_LEN > size:
+            return False
+        ts_sec, ts_frac, caplen, wirelen = record.unpack_from(mm, pos)
+        if (ts_frac >= frac_limit or caplen > MAX_RECORD_LEN or caplen > wirelen
+                or wirelen > MAX_WIRE_LEN or abs(ts_sec - first_ts) > MAX_CAPTURE_SPAN):
+            return False
+        pos += PCAP_RECORD_HEADER_LEN + caplen
+    return True
+
+
+def find_record_boundary(mm, header, target):
+    record = struct.Struct(header.endian + 'IIII')
+    frac_limit = 1000000000 if header.nanosecond else 1000000
+    first_ts = record.unpack_from(mm, PCAP_GLOBAL_HEADER_LEN)[0]
+    for pos in range(target, min(target + BOUNDARY_SCAN_LIMIT, len(mm))):
+        if _plausible_chain(mm, record, pos, frac_limit, first_ts):
+            return pos
+    return None
+
+
+def plan_segments(pcap_file, segment_bytes=SEGMENT_BYTES, start=PCAP_GLOBAL_HEADER_LEN):
+    # Split points are guesses: whoever analyzes the segment before one must
+    # confirm its records end exactly there (see ntfs_engine.analyze_segments).
+    # `start` is a record start, e.g. where a previous analysis stopped.
+    with open(pcap_file, 'rb') as f:
+        header = read_pcap_header(f)
+        f.seek(0, 2)
+        size = f.tell()
+        bounds = [start]
+        if size > start + PCAP_RECORD_HEADER_LEN + segment_bytes:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                target = start + segment_bytes
+                while target < size:
+                    boundary = find_record_boundary(mm, header, target)
+                    if boundary is None or boundary >= size:
+                        break
+                    bounds.append(boundary)
+                    target = boundary + segment_bytes
+        bounds.append(max(size, start))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_packet_columns(pcap_file, start=PCAP_GLOBAL_HEADER_LEN, end=None, chunk_packets=CHUNK_PACKETS):
+    with open(pcap_file, 'rb') as f:
+        header = read_pcap_header(f)
+        f.seek(0, 2)
+        if f.tell() <= PCAP_GLOBAL_HEADER_LEN:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        try:
+            pos = start
+            end = len(mm) if end is None else min(end, len(mm))
+            while True:
+                offsets, pos = _record_offsets(mm, header.endian, pos, end, chunk_packets)
+                if not len(offsets):
+                    break
+                yield decode_columns(buf, offsets, header)
+        finally:
+            # The array view has to go before the mapping can be closed
+            del buf
+            mm.close()
+
+
+def iter_store_columns(pcap_file, start=PCAP_GLOBAL_HEADER_LEN, end=None, chunk_packets=CHUNK_PACKETS):
+    # Same as iter_packet_columns for a pcap in the compressed evidence store,
+    # decompressing only the frames from `start` on
+    frames = read_seek_table(pcap_file)
+    header = read_pcap_header(io.BytesIO(read_store_range(pcap_file, 0, PCAP_GLOBAL_HEADER_LEN, frames)))
+    size = store_content_size(frames)
+    end = size if end is None else min(end, size)
+    # Unconsumed tail of the frames so far, a view of the last one when possible
+    tail = memoryview(b'')
+    base = pos = start
+    for offset, data in iter_store_frames(pcap_file, frames, frame_index(frames, start)):
+        if pos >= end:
+            break
+        if len(tail):
+            # Only the record cut by the frame boundary is copied
+            block = memoryview(b''.join((tail, data)))
+        else:
+            base = max(offset, pos)
+            block = memoryview(data)[base - offset:]
+        # Records that start before `end` are read to their end, in the next frames if needed
+        buf = np.frombuffer(block, dtype=np.uint8)
+        while True:
+            offsets, stop = _record_offsets(block, header.endian, pos - base, end - base, chunk_packets)
+            if not len(offsets):
+                break
+            columns = decode_columns(buf, offsets, header)
+            columns['offset'] += base
+            pos = base + stop
+            yield columns
+        tail = block[pos - base:]
+        base = pos
+
+
+# Incremental decoding of a pcap byte stream (e.g. `tcpdump -w -`). Blocks can
+# be fed as they arrive; records are decoded once they are complete.
+def new_pcap_stream():
+    return {'header': None, 'pending': bytearray(), 'consumed': 0}
+
+
+def feed_pcap_stream(stream, data):
+    pending = stream['pending']
+    pending += data
+    if stream['header'] is None:
+        if len(pending) < PCAP_GLOBAL_HEADER_LEN:
+            return np.zeros(0, dtype=PACKET_DTYPE)
+        stream['header'] = read_pcap_header(io.BytesIO(pending[:PCAP_GLOBAL_HEADER_LEN]))
+        del pending[:PCAP_GLOBAL_HEADER_LEN]
+        stream['consumed'] = PCAP_GLOBAL_HEADER_LEN
+
+    offsets, pos = _record_offsets(pending, stream['header'].endian, 0, len(pending), len(pending))
+    block = bytes(pending[:pos])
+    del pending[:pos]
+    columns = decode_columns(np.frombuffer(block, dtype=np.uint8), offsets, stream['header'])
+    # Offsets relative to the start of the stream, like those read from a file
+    columns['offset'] += stream['consumed']
+    stream['consumed'] += pos
+    return columns
+
+
+# Incremental decoding of a pcapng byte stream. Interfaces of every section seen
+# so far are kept in one table; packets refer to them by their index in it.
+def new_pcapng_stream():
+    return {'pending': bytearray(), 'consumed': 0, 'endian': None, 'section': 0, 'interfaces': []}
+
+
+def _pcapng_interface(block, endian):
+    # (linktype, endian, ticks per second, timestamp offset, snaplen) of an
+    # interface description block
+    linktype, _, snaplen = struct.unpack_from(endian + 'HHI', block, 8)
+    tsresol = PCAPNG_DEFAULT_TSRESOL
+    tsoffset = 0
+    pos = 16
+    while pos + 4 <= len(block) - 4:
+        code, length = struct.unpack_from(endian + 'HH', block, pos)
+        if code == PCAPNG_OPTION_END:
+            break
+        if code == PCAPNG_IF_TSRESOL and length >= 1:
+            tsresol = block[pos + 4]
+        elif code == PCAPNG_IF_TSOFFSET and length >= 8:
+            tsoffset = struct.unpack_from(endian + 'q', block, pos + 4)[0]
+        pos += 4 + (length + 3) // 4 * 4
+    ticks = 2 ** (tsresol & 0x7f) if tsresol & 0x80 else 10 ** tsresol
+    return linktype, endian, ticks, tsoffset, snaplen
+
+
+def feed_pcapng_stream(stream, data):
+    pending = stream['pending']
+    pending += data
+    interfaces = stream['interfaces']
+    endian = stream['endian']
+    section = stream['section']
+    # Block type and length, then the fields of an enhanced packet block, in one unpack
+    block_fields = struct.Struct((endian or '<') + 'IIIIIII').unpack_from
+    # Block offset, data offset, interface, ts high, ts low, caplen, wirelen and
+    # block length of every packet, flattened for speed
+    packets = []
+    add = packets.extend
+    size = len(pending)
+    pos = 0
+    while size - pos >= 12:
+        if size - pos >= 28:
+            block_type, block_len, interface, ts_high, ts_low, caplen, wirelen = block_fields(pending, pos)
+        else:
+            block_type, block_len = struct.unpack_from((endian or '<') + 'II', pending, pos)
+
+        if block_type == PCAPNG_SECTION_HEADER:
+            # The section header's byte-order magic sets the endianness of the section
+            if struct.unpack_from('<I', pending, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = '<'
+            elif struct.unpack_from('>I', pending, pos + 8)[0] == PCAPNG_BYTE_ORDER_MAGIC:
+                endian = '>'
+            else:
+                raise ValueError("Corrupt pcapng section header")
+            block_fields = struct.Struct(endian + 'IIIIIII').unpack_from
+            block_len = struct.unpack_from(endian + 'I', pending, pos + 4)[0]
+        elif endian is None:
+            raise ValueError("Unsupported capture format (not a pcapng file)")
+
+        if block_len < 12 or block_len % 4:
+            raise ValueError(f"Corrupt pcapng block at offset {stream['consumed'] + pos}")
+        if pos + block_len > size:
+            break
+
+        if block_type == PCAPNG_ENHANCED_PACKET:
+            add((pos, pos + 28, section + interface, ts_high, ts_low, caplen, wirelen, block_len - 32))
+        elif block_type == PCAPNG_SIMPLE_PACKET:
+            # No timestamp, always on the section's first interface
+            wirelen = struct.unpack_from(endian + 'I', pending, pos + 8)[0]
+            snaplen = interfaces[section][4] if section < len(interfaces) else 0
+            add((pos, pos + 12, section, 0, 0, min(wirelen, snaplen or wirelen), wirelen, block_len - 16))
+        elif block_type == PCAPNG_OBSOLETE_PACKET:
+            interface = struct.unpack_from(endian + 'H', pending, pos + 8)[0]
+            add((pos, pos + 28, section + interface, ts_high, ts_low, caplen, wirelen, block_len - 32))
+        elif block_type == PCAPNG_INTERFACE_DESCRIPTION:
+            interfaces.append(_pcapng_interface(pending[pos:pos + block_len], endian))
+        elif block_type == PCAPNG_SECTION_HEADER:
+            # Interfaces are numbered from 0 again in every section
+            section = len(interfaces)
+        pos += block_len
+
+    stream['endian'] = endian
+    stream['section'] = section
+    block = bytes(pending[:pos])
+    del pending[:pos]
+    consumed = stream['consumed']
+    stream['consumed'] += pos
+    if not packets:
+        return np.zeros(0, dtype=PACKET_DTYPE)
+
+    fields = np.array(packets, dtype=np.int64).reshape(-1, 8)
+    buf = np.frombuffer(block, dtype=np.uint8)
+    # A captured length running past its block is cut to the block
+    caplen = np.minimum(fields[:, 5], fields[:, 7])
+    ticks = (fields[:, 3].astype(np.uint64) << np.uint64(32)) | fields[:, 4].astype(np.uint64)
+    columns = np.zeros(len(fields), dtype=PACKET_DTYPE)
+    keep = fields[:, 2] < len(interfaces)
+    # Link type and timestamp resolution are per interface
+    for interface in np.unique(fields[keep, 2]).tolist():
+        linktype, interface_endian, ticks_per_second, tsoffset, _ = interfaces[interface]
+        mask = fields[:, 2] == interface
+        selected = fields[mask]
+        columns[mask] = decode_packets(buf, selected[:, 0] + consumed, selected[:, 1],
+                                       ticks[mask] / ticks_per_second + tsoffset, caplen[mask], selected[:, 6],
+                                       linktype, interface_endian)
+    # Packets of undeclared interfaces cannot be decoded
+    return columns[keep]
+
+
+def new_capture_stream():
+    return {'format': None, 'pending': bytearray(), 'stream': None}
+
+
+def feed_capture_stream(stream, data):
+    # pcap or pcapng, told apart by the first block
+    if stream['format'] is None:
+        stream['pending'] += data
+        if len(stream['pending']) < 4:
+            return np.zeros(0, dtype=PACKET_DTYPE)
+        data = bytes(stream['pending'])
+        if struct.unpack_from('<I', data)[0] == PCAPNG_SECTION_HEADER:
+            stream['format'], stream['stream'] = 'pcapng', new_pcapng_stream()
+        else:
+            stream['format'], stream['stream'] = 'pcap', new_pcap_stream()
+        stream['pending'] = None
+    if stream['format'] == 'pcapng':
+        return feed_pcapng_stream(stream['stream'], data)
+    return feed_pcap_stream(stream['stream'], data)
+
+
+def iter_capture_columns(path, chunk_bytes=STREAM_READ_BYTES):
+    # Columns of any supported capture: plain pcap files are memory-mapped,
+    # pcapng and compressed captures are decoded as they are read
+    if is_plain_pcap(path):
+        yield from iter_packet_columns(path)
+        return
+
+    stream = new_capture_stream()
+    with open_capture(path) as f:
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+            columns = feed_capture_stream(stream, data)
+            if len(columns):
+                yield columns
+    if stream['format'] is None or (stream['format'] == 'pcap' and stream['stream']['header'] is None):
+        raise ValueError("File is too short to be a pcap file")
@@ -4,27 +4,59 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import mm
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
-from ntfs_data import create_connection, get_pcap_analysis_for_case
+from reportlab.pdfgen import canvas as pdf_canvas
+import hashlib
+import io
+import os
+import time
+from ntfs_data import iter_pcap_analysis_for_case, get_analysis_talkers, get_analysis_verdicts
+from ntfs_analysis import flagged_windows, format_verdict_window, FLAGGED_WINDOWS_LIMIT
+from ntfs_engine import TOP_IPS_LIMIT
+from ntfs_series import series_from_blob
+from ntfs_hll import distinct_from_blob, distinct_summary, classify_sources
+
+# pypdf is only needed to assemble cached fragments; without it every report
+# is laid out in one pass
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:
+    PdfReader = PdfWriter = None
+
+# Rendered sections are cached in this folder, keyed by a hash of their content
+REPORT_CACHE_DIR = "report_cache"
+# Bump whenever the layout or wording of any section changes, e.g. "2" added
+# the source diversity and detection sections to the analyses
+REPORT_TEMPLATE_VERSION = "2"
 
 def add_page_number(canvas, doc):
     page_num = canvas.getPageNumber()
     text = f"Page {page_num}"
     canvas.drawRightString(200 * mm, 20 * mm, text)
 
-def generate_pdf_report(case_details, pcap_files):
+def generate_pdf_report(case_details, pcap_files, connection):
     if not case_details or len(case_details) < 3:
         print("Error: Insufficient case details or case not found.")
         return
     
     case_name = case_details[0]
-    org_name = case_details[1]
-    investigator_name = case_details[2]
-    date = case_details[3]
-    
     pdf_file = f"{case_name}_report.pdf"
-    doc = SimpleDocTemplate(pdf_file, pagesize=A4)
-    elements = []
-    
+    styles = report_styles()
+
+    if PdfWriter is None:
+        # Flowables are produced while the document is laid out, so only one page
+        # of analysis rows is held in memory whatever the size of the case
+        doc = SimpleDocTemplate(pdf_file, pagesize=A4)
+        flowables = FlowableStream(iter_report_flowables(case_details, pcap_files, connection, styles))
+
+        # Add the page numbers
+        doc.build(flowables, onLaterPages=add_page_number)
+    else:
+        build_report_from_fragments(pdf_file, case_details, pcap_files, connection, styles)
+
+    print(f"Report generated: {pdf_file}")
+    return pdf_file
+
+def report_styles():
     styles = getSampleStyleSheet()
     
     # Define custom styles
@@ -84,6 +116,25 @@ def generate_pdf_report(case_details, pcap_files):
         spaceAfter=20
     )
 
+    return {
+        'sample': styles,
+        'title': title_style,
+        'subtitle': subtitle_style,
+        'left_aligned_subtitle': left_aligned_subtitle_style,
+        'normal_centered': normal_centered,
+        'normal_left': normal_left,
+        'heading_left': heading_left,
+        'findings_title': findings_title_style,
+    }
+
+# Cover, summary, attack types and introduction pages, the same in every report
+def static_flowables(styles):
+    title_style = styles['title']
+    subtitle_style = styles['subtitle']
+    left_aligned_subtitle_style = styles['left_aligned_subtitle']
+    normal_left = styles['normal_left']
+    elements = []
+
     # Cover Page
 
     page_width, page_height = A4
@@ -193,6 +244,14 @@ def generate_pdf_report(case_details, pcap_files):
     """, normal_left))
 
     elements.append(PageBreak())
+    return elements
+
+def case_flowables(case_details, pcap_files, styles):
+    case_name, org_name, investigator_name, date = case_details[:4]
+    subtitle_style = styles['subtitle']
+    heading_left = styles['heading_left']
+    normal_left = styles['normal_left']
+    elements = []
 
 
     # Anaysis Details
@@ -207,88 +266,298 @@ def generate_pdf_report(case_details, pcap_files):
     """
     elements.append(Paragraph(case_info, normal_left))
 
-    
-
     # PCAP Files Page
-    elements.append(Paragraph("PCAP Files:", styles['Heading1']))
-    
-    pcap_table_data = [["Pcap File", "Date", "Status"]]
+    elements.append(Paragraph("PCAP Files:", styles['sample']['Heading1']))
+    yield from elements
+
+    pcap_table_data = []
     for file in pcap_files:
         pcap_table_data.append([file[0], file[1], file[2]])
-    
-    pcap_table = Table(pcap_table_data, colWidths=[300, 100, 100])
-    pcap_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 12),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-    ]))
-    elements.append(pcap_table)
-    elements.append(PageBreak())
+        if len(pcap_table_data) == PCAP_TABLE_ROWS:
+            yield pcap_files_table(pcap_table_data)
+            pcap_table_data = []
+    if pcap_table_data:
+        yield pcap_files_table(pcap_table_data)
+
+
+TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 12),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+])
+
+# Rows of the pcap files table laid out as one Table
+PCAP_TABLE_ROWS = 40
+
+
+class FlowableStream:
+    # List-like front of a flowable generator for doc.build, which only reads,
+    # deletes and inserts at the head of the list; at most `lookahead`
+    # flowables are materialized at a time
+    def __init__(self, flowables, lookahead=16):
+        self._source = iter(flowables)
+        self._buffer = []
+        self._lookahead = lookahead
+
+    def _fill(self, count):
+        while len(self._buffer) < count:
+            try:
+                self._buffer.append(next(self._source))
+            except StopIteration:
+                break
+
+    def __len__(self):
+        self._fill(self._lookahead)
+        return len(self._buffer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self._fill(max(index.stop or 0, self._lookahead))
+        else:
+            self._fill(index + 1)
+        return self._buffer[index]
+
+    def __setitem__(self, index, value):
+        self._buffer[index] = value
+
+    def __delitem__(self, index):
+        if not isinstance(index, slice):
+            self._fill(index + 1)
+        del self._buffer[index]
+
+    def insert(self, index, value):
+        self._buffer.insert(index, value)
+
+
+def iter_report_flowables(case_details, pcap_files, connection, styles):
+    yield from static_flowables(styles)
+    yield from case_flowables(case_details, pcap_files, styles)
+    yield PageBreak()
 
     # PCAP Analysis Page
-    elements.append(Paragraph("PCAP Analysis Report:", styles['Heading1']))
-
-    connection = create_connection("ntfs.db")
-    pcap_analysis = get_pcap_analysis_for_case(connection, case_name)
-
-    if not pcap_analysis:
-        elements.append(Paragraph("No analysis data found.", styles['Normal']))
-
-    else:
-        for analysis in pcap_analysis:
-            analysis_info = f"""
-            <b>PCAP File:</b> {analysis[3]}<br/>
-            <b>Total Packets:</b> {analysis[4]}<br/>
-            <b>TCP Count:</b> {analysis[6]}<br/>
-            <b>UDP Count:</b> {analysis[7]}<br/>
-            <b>HTTP Count:</b> {analysis[8]}<br/>
-            <b>SYN Count:</b> {analysis[9]}<br/>
-            <b>SYN-ACK Count:</b> {analysis[10]}<br/>
-            <b>ACK Count:</b> {analysis[11]}<br/>
-            <b>SYN without ACK Count:</b> {analysis[12]}<br/>
-            <b>SYN-ACK Ratio:</b> {analysis[13]}<br/>
-            <b>SYN-ACK Ratio Result:</b> {analysis[14]}<br/>
-            <b>Proportionality Ratio Result:</b> {analysis[15]}<br/>
-            <b>File Hash:</b> {analysis[16]}<br/>
-            <b>Analysis Date:</b> {analysis[17]}<br/><br/>
-            """
-            elements.append(Paragraph(analysis_info, styles['Normal']))
-
-            # Table for the list of IP addresses
-            ip_addresses = eval (analysis[5])
-            ip_data = [["IP", "Count"]] 
-
-            for ip, count in ip_addresses:
-                ip_data.append([ip, count])
-
-            ip_table = Table(ip_data, colWidths=[200, 100])
-            ip_table.setStyle(TableStyle([
+    yield Paragraph("PCAP Analysis Report:", styles['sample']['Heading1'])
+
+    rows = 0
+    for analysis in report_progress(iter_pcap_analysis_for_case(connection, case_details[0], REPORT_ANALYSIS_COLUMNS)):
+        yield from analysis_flowables(connection, analysis, styles)
+        yield PageBreak()
+        yield Spacer(1, 12)
+        rows += 1
+
+    if not rows:
+        yield Paragraph("No analysis data found.", styles['sample']['Normal'])
+
+
+def report_progress(analyses):
+    start = last_progress = time.perf_counter()
+    rows = 0
+    for analysis in analyses:
+        yield analysis
+        rows += 1
+        now = time.perf_counter()
+        if now - last_progress >= 1:
+            print(f"\rReport: {rows} analyses, {rows / (now - start):.0f} rows/s", end="", flush=True)
+            last_progress = now
+
+    if last_progress > start:
+        elapsed = time.perf_counter() - start
+        print(f"\rReport: {rows} analyses, {rows / elapsed:.0f} rows/s")
+
+
+def pcap_files_table(pcap_table_data):
+    pcap_table = Table([["Pcap File", "Date", "Status"]] + pcap_table_data, colWidths=[300, 100, 100])
+    pcap_table.setStyle(TABLE_STYLE)
+    return pcap_table
+
+
+REPORT_ANALYSIS_COLUMNS = ['id', 'pcap_file_name', 'total_packets', 'tcp_count', 'udp_count', 'http_count',
+                           'syn_count', 'syn_ack_count', 'ack_count', 'syn_without_ack_count', 'syn_ack_ratio',
+                           'syn_ack_message', 'proportionality_message', 'file_hash', 'analysis_date',
+                           'series_bucket', 'series', 'distinct_sources', 'distinct_networks', 'source_sketch']
+
+
+def analysis_flowables(connection, analysis, styles):
+    analysis_info = f"""
+    <b>PCAP File:</b> {analysis['pcap_file_name']}<br/>
+    <b>Total Packets:</b> {analysis['total_packets']}<br/>
+    <b>TCP Count:</b> {analysis['tcp_count']}<br/>
+    <b>UDP Count:</b> {analysis['udp_count']}<br/>
+    <b>HTTP Count:</b> {analysis['http_count']}<br/>
+    <b>SYN Count:</b> {analysis['syn_count']}<br/>
+    <b>SYN-ACK Count:</b> {analysis['syn_ack_count']}<br/>
+    <b>ACK Count:</b> {analysis['ack_count']}<br/>
+    <b>SYN without ACK Count:</b> {analysis['syn_without_ack_count']}<br/>
+    <b>SYN-ACK Ratio:</b> {analysis['syn_ack_ratio']}<br/>
+    <b>SYN-ACK Ratio Result:</b> {analysis['syn_ack_message']}<br/>
+    <b>Proportionality Ratio Result:</b> {analysis['proportionality_message']}<br/>
+    <b>File Hash:</b> {analysis['file_hash']}<br/>
+    <b>Analysis Date:</b> {analysis['analysis_date']}<br/><br/>
+    """
+    flowables = [Paragraph(analysis_info, styles['sample']['Normal'])]
+
+    # Distinct sources toward the busiest destinations, the DoS / DDoS distinction
+    if analysis['source_sketch'] is not None:
+        diversity = distinct_summary(distinct_from_blob(analysis['source_sketch']))
+        diversity_info = (f"<b>Distinct Sources:</b> {diversity['sources']} from {diversity['networks']} /24 "
+                          f"networks (estimated)<br/>")
+        for ip, sources, networks in diversity['destinations'][:TOP_IPS_LIMIT]:
+            diversity_info += (f"<b>Traffic to {ip}:</b> {sources} sources from {networks} /24s, "
+                               f"{classify_sources(sources, networks)}<br/>")
+        flowables.append(Paragraph(diversity_info + "<br/>", styles['sample']['Normal']))
+
+    # Verdicts of the detection rules, most severe first
+    verdicts = get_analysis_verdicts(connection, analysis['id'])
+    if verdicts:
+        verdict_data = [["Severity", "Attack", "Target", "Window", "Evidence"]]
+        for verdict in verdicts:
+            verdict_data.append([verdict['severity'], Paragraph(verdict['attack'], styles['sample']['Normal']),
+                                 verdict['target'] or "-", format_verdict_window(verdict),
+                                 Paragraph(verdict['message'], styles['sample']['Normal'])])
+        verdict_table = Table(verdict_data, colWidths=[50, 90, 80, 110, 170])
+        verdict_table.setStyle(TABLE_STYLE)
+        flowables.append(Paragraph("<b>Detections:</b>", styles['sample']['Normal']))
+        flowables.append(verdict_table)
+        flowables.append(Spacer(1, 12))
+
+    # Table for the busiest source addresses
+    talkers = [talker for talker in get_analysis_talkers(connection, analysis['id']) if talker[1] == 'source']
+    ip_data = [["IP", "Packets", "Bytes"]]
+
+    for ip, _, packets, byte_count in talkers[:TOP_IPS_LIMIT]:
+        ip_data.append([ip, packets, byte_count if byte_count is not None else "-"])
+
+    ip_table = Table(ip_data, colWidths=[200, 100, 100])
+    ip_table.setStyle(TABLE_STYLE)
+    flowables.append(ip_table)
+
+    # Windows of the time series that trip the ratio checks, read from the series blob
+    if analysis['series'] is not None:
+        flagged = flagged_windows(series_from_blob(analysis['series']), analysis['series_bucket'])
+        flagged.sort(key=lambda row: (-row[1], row[0]))
+        flowables.append(Spacer(1, 12))
+        flowables.append(Paragraph(f"<b>Flagged Windows:</b> {len(flagged)}", styles['sample']['Normal']))
+        if flagged:
+            window_data = [["Start", "Window", "SYN", "SYN-ACK", "Message"]]
+            for start, window, counts, messages in flagged[:FLAGGED_WINDOWS_LIMIT]:
+                message = " ".join(messages).replace("\033[91m", "").replace("\033[0m", "")
+                window_data.append([time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), f"{window}s",
+                                    counts['syn_count'], counts['syn_ack_count'], Paragraph(message, styles['sample']['Normal'])])
+            window_table = Table(window_data, colWidths=[110, 50, 50, 60, 200])
+            window_table.setStyle(TableStyle([
                 ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
                 ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
                 ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
                 ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 12),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
                 ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
                 ('GRID', (0, 0), (-1, -1), 1, colors.black),
             ]))
-            elements.append(ip_table)
-            elements.append(PageBreak())
-            elements.append(Spacer(1, 12))
-
-            
+            flowables.append(window_table)
+
+    return flowables
+
+def fragment_key(kind, *parts):
+    # Content hash of one report section; any change to what the section shows,
+    # or to REPORT_TEMPLATE_VERSION, gives a new key
+    digest = hashlib.sha256(f"{REPORT_TEMPLATE_VERSION}\0{kind}".encode())
+    for part in parts:
+        data = part if isinstance(part, bytes) else repr(part).encode()
+        digest.update(len(data).to_bytes(8, 'little'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def render_fragment(path, flowables):
+    # Written under a temporary name so an interrupted build never leaves a
+    # truncated fragment behind
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    doc = SimpleDocTemplate(temp_path, pagesize=A4)
+    doc.build(flowables)
+    os.replace(temp_path, path)
+
+
+def fragment_path(key):
+    return os.path.join(REPORT_CACHE_DIR, f"{key}.pdf")
+
+
+def iter_report_fragments(case_details, pcap_files, connection, styles):
+    # (key, flowables factory) for every section of the report, in page order.
+    # Sections never share a page, so each one is laid out on its own.
+    yield fragment_key("static"), lambda: static_flowables(styles)
+    yield fragment_key("case", tuple(case_details), *map(tuple, pcap_files)), \
+        lambda: list(case_flowables(case_details, pcap_files, styles))
+
+    first = True
+    for analysis in report_progress(iter_pcap_analysis_for_case(connection, case_details[0], REPORT_ANALYSIS_COLUMNS)):
+        talkers = get_analysis_talkers(connection, analysis['id'])
+        verdicts = get_analysis_verdicts(connection, analysis['id'])
+        key = fragment_key("analysis", first,
+                           *[analysis[column] for column in REPORT_ANALYSIS_COLUMNS if column != 'id'], talkers,
+                           verdicts)
+
+        def flowables(analysis=analysis, first=first):
+            if first:
+                head = [Paragraph("PCAP Analysis Report:", styles['sample']['Heading1'])]
+            else:
+                head = [Spacer(1, 12)]
+            return head + analysis_flowables(connection, analysis, styles)
+
+        yield key, flowables
+        first = False
+
+    if first:
+        yield fragment_key("no_analysis"), lambda: [
+            Paragraph("PCAP Analysis Report:", styles['sample']['Heading1']),
+            Paragraph("No analysis data found.", styles['sample']['Normal']),
+        ]
+
+
+def page_number_overlay(first_page, last_page):
+    # One page per number, merged over the assembled pages
+    buffer = io.BytesIO()
+    overlay = pdf_canvas.Canvas(buffer, pagesize=A4)
+    for page_num in range(first_page, last_page + 1):
+        overlay.drawRightString(200 * mm, 20 * mm, f"Page {page_num}")
+        overlay.showPage()
+    overlay.save()
+    buffer.seek(0)
+    return PdfReader(buffer)
+
+
+def build_report_from_fragments(pdf_file, case_details, pcap_files, connection, styles):
+    # Only sections whose content changed since the last report are laid out
+    # again; the rest are reused from REPORT_CACHE_DIR and the report is
+    # assembled from the cached PDFs
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    writer = PdfWriter()
+    rendered = reused = 0
+    for key, flowables in iter_report_fragments(case_details, pcap_files, connection, styles):
+        path = fragment_path(key)
+        if os.path.exists(path):
+            reused += 1
+        else:
+            render_fragment(path, flowables())
+            rendered += 1
+        writer.append(path)
+
+    # Page numbers on every page but the first, as with onLaterPages
+    page_count = len(writer.pages)
+    if page_count > 1:
+        overlay = page_number_overlay(2, page_count)
+        for page, number_page in zip(writer.pages[1:], overlay.pages):
+            page.merge_page(number_page)
+
+    temp_file = f"{pdf_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'wb') as f:
+        writer.write(f)
+    os.replace(temp_file, pdf_file)
+    print(f"Report sections: {rendered} rendered, {reused} reused from {REPORT_CACHE_DIR}")
 
 
-    # Add the page numbers
-    doc.build(elements, onLaterPages=add_page_number)
-
-    print(f"Report generated: {pdf_file}")
-
 if __name__ == "__main__":
     # You can add test code or leave this block empty if not needed
     pass
@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+import io
+import os
+import shlex
+import signal
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ntfs_arguments import add_rotation_arguments
+from ntfs_capture import open_pcap_output
+from ntfs_columns import remove_column_store
+from ntfs_data import insert_pcap_file, update_pcap_file_status, get_case_details_by_id, unregister_column_store
+from ntfs_hash import new_hashers, update_hashers, hexdigests
+from ntfs_index import remove_packet_index
+from ntfs_pcap import PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN, read_pcap_header
+from ntfs_store import new_store_writer, store_write, store_close, STORE_EXTENSION
+
+READ_SIZE = 1 << 16
+# tcpdump -C counts file sizes in millions of bytes
+SIZE_UNIT = 1000000
+# Status of segments the ring or the disk cap deleted; their rows stay for the record
+EXPIRED_STATUS = 'expired'
+
+
+# Several tcpdump processes captured at once, one per interface/filter job.
+# Each one writes to stdout and the stream is cut into segment files here, at
+# record boundaries, so every segment is hashed while it is written and
+# registered as soon as it is complete; tcpdump's own -G/-C rotation does
+# neither. Completed segments beyond the ring size or the disk cap are deleted
+# oldest first. Writing, hashing and compressing segments and registering them
+# in the database run on one writer thread, in order, so the event loop keeps
+# draining every tcpdump pipe meanwhile.
+def new_capture_manager(connection, case_name, org_name, seconds=None, megabytes=None, ring_files=None,
+                        max_disk_mb=None, compress=False):
+    return {
+        'connection': connection,
+        'case_name': case_name,
+        'org_name': org_name,
+        'seconds': seconds,
+        'size_limit': megabytes * SIZE_UNIT if megabytes else None,
+        'ring_files': ring_files,
+        'disk_limit': max_disk_mb * SIZE_UNIT if max_disk_mb else None,
+        # Segments are written to the compressed evidence store: the size
+        # limit still counts pcap bytes, the disk cap what is on disk
+        'compress': compress,
+        # Completed segments still on disk, oldest first
+        'retained': [],
+        # (file_path, file_hashes) of every segment registered
+        'registered': [],
+        'writer': ThreadPoolExecutor(max_workers=1),
+    }
+
+
+def new_capture_job(interface=None, capture_filter=None, packet_count=None):
+    return {
+        'interface': interface,
+        'filter': capture_filter,
+        'count': packet_count,
+        'process': None,
+        'segment': None,
+        'ring': [],
+    }
+
+
+def parse_job(spec, default_filter):
+    # IFACE or IFACE=FILTER
+    interface, _, capture_filter = spec.partition('=')
+    return interface or None, capture_filter or default_filter
+
+
+def tcpdump_command(job):
+    # -U so segments are cut on time rather than when tcpdump's buffer fills
+    command = ["tcpdump", "-U", "-w", "-"]
+    if job['count']:
+        command.extend(["-c", str(job['count'])])
+    if job['interface']:
+        command.extend(["-i", job['interface']])
+    if job['filter']:
+        command.append(job['filter'])
+    return command
+
+
+def new_record_splitter():
+    return {'header': None, 'record': None, 'pending': bytearray()}
+
+
+def split_records(splitter, data):
+    # Complete pcap records of the stream so far, as bytes; the global header
+    # is kept in the splitter for the segment files
+    pending = splitter['pending']
+    pending += data
+    if splitter['header'] is None:
+        if len(pending) < PCAP_GLOBAL_HEADER_LEN:
+            return []
+        splitter['header'] = bytes(pending[:PCAP_GLOBAL_HEADER_LEN])
+        endian = read_pcap_header(io.BytesIO(splitter['header'])).endian
+        splitter['record'] = struct.Struct(endian + 'IIII')
+        del pending[:PCAP_GLOBAL_HEADER_LEN]
+
+    records = []
+    pos = 0
+    while len(pending) - pos >= PCAP_RECORD_HEADER_LEN:
+        caplen = splitter['record'].unpack_from(pending, pos)[2]
+        end = pos + PCAP_RECORD_HEADER_LEN + caplen
+        if end > len(pending):
+            break
+        records.append(bytes(pending[pos:end]))
+        pos = end
+    del pending[:pos]
+    return records
+
+
+def open_segment(manager, job, header):
+    output_file, f = open_pcap_output(manager['connection'], manager['case_name'], manager['org_name'],
+                                      extension=".pcap" + STORE_EXTENSION if manager['compress'] else ".pcap")
+    writer = new_store_writer(f) if manager['compress'] else None
+    if writer:
+        store_write(writer, header)
+    else:
+        f.write(header)
+    hashers = new_hashers()
+    update_hashers(hashers, header)
+    deadline = time.monotonic() + manager['seconds'] if manager['seconds'] else None
+    job['segment'] = {'path': output_file, 'file': f, 'writer': writer, 'hashers': hashers, 'bytes': len(header),
+                      'packets': 0, 'deadline': deadline}
+
+
+def close_segment(manager, job):
+    segment = job['segment']
+    job['segment'] = None
+    if segment['writer']:
+        store_close(segment['writer'])
+    segment['file'].close()
+    file_hashes = hexdigests(segment['hashers'])
+    print(f"[{job['interface'] or 'default'}] {segment['packets']} packets saved to {segment['path']}")
+    insert_pcap_file(manager['connection'], manager['case_name'], segment['path'], 'collected', file_hashes)
+    manager['registered'].append((segment['path'], file_hashes))
+
+    retained = {'path': segment['path'], 'bytes': os.path.getsize(segment['path']), 'job': job}
+    job['ring'].append(retained)
+    manager['retained'].append(retained)
+    enforce_limits(manager, job)
+
+
+def expire_segment(manager, retained):
+    try:
+        os.remove(retained['path'])
+    except FileNotFoundError:
+        pass
+    remove_packet_index(retained['path'])
+    remove_column_store(retained['path'])
+    unregister_column_store(manager['connection'], manager['case_name'], os.path.basename(retained['path']))
+    update_pcap_file_status(manager['connection'], retained['path'], EXPIRED_STATUS)
+    retained['job']['ring'].remove(retained)
+    manager['retained'].remove(retained)
+    print(f"Removed {retained['path']} to stay within the capture limits")
+
+
+def enforce_limits(manager, job):
+    while manager['ring_files'] and len(job['ring']) > manager['ring_files']:
+        expire_segment(manager, job['ring'][0])
+    # The newest segment is always kept, even if it alone is over the cap
+    while (manager['disk_limit'] and len(manager['retained']) > 1
+           and sum(retained['bytes'] for retained in manager['retained']) > manager['disk_limit']):
+        expire_segment(manager, manager['retained'][0])
+
+
+def write_records(manager, job, header, records):
+    for record in records:
+        segment = job['segment']
+        if segment and manager['size_limit'] and segment['packets'] \
+                and segment['bytes'] + len(record) > manager['size_limit']:
+            close_segment(manager, job)
+        if job['segment'] is None:
+            open_segment(manager, job, header)
+        segment = job['segment']
+        if segment['writer']:
+            store_write(segment['writer'], record)
+        else:
+            segment['file'].write(record)
+        update_hashers(segment['hashers'], record)
+        segment['bytes'] += len(record)
+        segment['packets'] += 1
+
+
+async def in_writer(manager, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(manager['writer'], function, *args)
+
+
+async def run_capture_job(manager, job):
+    command = tcpdump_command(job)
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        print("Error capturing packets:", e)
+        return
+    job['process'] = process
+    errors = asyncio.create_task(process.stderr.read())
+    splitter = new_record_splitter()
+
+    try:
+        while True:
+            segment = job['segment']
+            timeout = max(0, segment['deadline'] - time.monotonic()) if segment and segment['deadline'] else None
+            try:
+                data = await asyncio.wait_for(process.stdout.read(READ_SIZE), timeout)
+            except asyncio.TimeoutError:
+                # No packets until the end of the segment's time slot
+                await in_writer(manager, close_segment, manager, job)
+                continue
+            if not data:
+                break
+            if segment and segment['deadline'] and time.monotonic() >= segment['deadline']:
+                await in_writer(manager, close_segment, manager, job)
+            # The first read sets the header the segments start with
+            records = split_records(splitter, data)
+            await in_writer(manager, write_records, manager, job, splitter['header'], records)
+    finally:
+        if job['segment']:
+            await in_writer(manager, close_segment, manager, job)
+
+    returncode = await process.wait()
+    stderr = await errors
+    # Terminated by stop_capture_jobs is a normal end
+    if returncode not in (0, -signal.SIGTERM):
+        print(f"Error capturing packets on {job['interface'] or 'the default interface'}: tcpdump exited "
+              f"with status {returncode}")
+        if stderr:
+            print(stderr.decode('utf-8', 'replace').strip())
+
+
+def stop_capture_jobs(jobs):
+    for job in jobs:
+        if job['process'] and job['process'].returncode is None:
+            job['process'].terminate()
+
+
+async def run_capture_jobs_async(manager, jobs, duration=None):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    try:
+        tasks = asyncio.gather(*(run_capture_job(manager, job) for job in jobs))
+        stopped = asyncio.ensure_future(stop.wait())
+        await asyncio.wait([tasks, stopped], timeout=duration, return_when=asyncio.FIRST_COMPLETED)
+        # Ctrl-C or the duration ran out: tcpdump is stopped and the open
+        # segments are closed and registered like any other
+        stop_capture_jobs(jobs)
+        stopped.cancel()
+        await tasks
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+
+
+def run_capture_jobs(connection, case_id, jobs, seconds=None, megabytes=None, ring_files=None, max_disk_mb=None,
+                     duration=None, compress=False):
+    case_details = get_case_details_by_id(connection, case_id)
+    if not case_details:
+        print("Invalid case ID.")
+        return None
+
+    case_name, organization_name, _, _ = case_details
+    manager = new_capture_manager(connection, case_name, organization_name, seconds, megabytes, ring_files,
+                                  max_disk_mb, compress)
+    try:
+        asyncio.run(run_capture_jobs_async(manager, jobs, duration))
+    finally:
+        manager['writer'].shutdown()
+    return manager['registered']
+
+
+def capture_jobs_from_args(args):
+    for name in ('count', 'seconds', 'size', 'files', 'max_disk', 'duration'):
+        value = getattr(args, name)
+        if value is not None and value < 1:
+            print(f"--{name.replace('_', '-')} must be at least 1.")
+            return None
+    default_filter = " ".join(args.target) or None
+    return [new_capture_job(*parse_job(spec, default_filter), args.count) for spec in args.interface or [""]]
+
+
+def execute_capture_jobs(command, connection, case_id):
+    parser = argparse.ArgumentParser(prog="ntfs -m",
+                                     description="Capture on several interfaces at once into rotating files")
+    add_rotation_arguments(parser)
+    try:
+        # Quoted so an interface's filter can hold spaces
+        args = parser.parse_args(shlex.split(command)[2:])
+    except (SystemExit, ValueError):
+        return
+    jobs = capture_jobs_from_args(args)
+    if jobs:
+        print("Capturing, press Ctrl-C to stop.")
+        run_capture_jobs(connection, case_id, jobs, args.seconds, args.size, args.files, args.max_disk,
+                         args.duration, args.compress)
@@ -0,0 +1,388 @@
+import numpy as np
+
+from ntfs_reader import format_address
+from ntfs_series import (
+    SERIES_PACKETS, SERIES_BYTES, new_series, series_update, finish_series, merge_series, series_windows,
+)
+from ntfs_sketch import new_topk_sketch, topk_update, topk_items, merge_topk_sketches
+
+RULE_BUCKET_SECONDS = 1
+# Rates are taken over windows this long, so a burst of a second or two does
+# not trip a rule on its own
+RULE_WINDOW_SECONDS = 10
+RULE_SKETCH_CAPACITY = 256
+# Targets looked at by the rules that report one verdict per target
+RULE_TARGETS_LIMIT = 5
+
+IPPROTO_ICMP = 1
+IPPROTO_ICMPV6 = 58
+DNS_PORT = 53
+NTP_PORT = 123
+
+# Thresholds of the rules; a verdict is high severity once its peak reaches
+# SEVERE_FACTOR times the threshold
+SYN_FLOOD_MIN_RATE = 20             # SYNs a second
+SYN_FLOOD_MIN_RATIO = 4             # SYNs per SYN-ACK, as calculate_syn_ack_ratio
+UDP_FLOOD_MIN_RATE = 1000           # UDP packets a second
+UDP_FLOOD_MIN_SHARE = 0.5           # of the packets of the window
+ICMP_FLOOD_MIN_RATE = 100           # ICMP packets a second
+FRAGMENT_OVERLAP_MIN = 1            # datagrams with overlapping fragments
+AMPLIFICATION_MIN_BYTES = 1 << 20   # response bytes toward the target
+AMPLIFICATION_MIN_FACTOR = 10       # response bytes per request byte
+SLOW_HTTP_MIN_FLOWS = 10            # low-and-slow connections to the target, see ntfs_flows
+SEVERE_FACTOR = 10
+
+SEVERITIES = ('low', 'medium', 'high')
+
+# Per-bucket packet and byte counts the rules look at
+RULE_FEATURES = ('packets', 'syn', 'syn_ack', 'udp', 'icmp', 'fragments', 'dns_responses', 'dns_requests',
+                 'ntp_responses', 'ntp_requests')
+# Features also tallied by address: (address column, metric)
+TARGET_FEATURES = {
+    'udp': ('dst', 'packets'),
+    'icmp': ('dst', 'packets'),
+    'dns_responses': ('dst', 'bytes'),
+    'dns_requests': ('src', 'bytes'),
+    'ntp_responses': ('dst', 'bytes'),
+    'ntp_requests': ('src', 'bytes'),
+}
+
+# Fragments are held this long for the rest of their datagram, as a host
+# reassembling them would, and no more than this many at a time
+FRAGMENT_TIMEOUT = 30
+FRAGMENT_PENDING_LIMIT = 1 << 16
+FRAGMENT_DTYPE = np.dtype([
+    ('ts', '<f8'),
+    ('src', 'V16'),
+    ('dst', 'V16'),
+    ('ip_id', '<u2'),
+    ('proto', 'u1'),
+    ('start', '<i8'),
+    ('end', '<i8'),
+])
+
+DETECTORS = []
+
+
+# Detection rules over what a single pass of the analysis collects: per-bucket
+# counts of a few packet features, sketches of the addresses behind some of
+# them, overlapping IPv4 fragments and the flow table's outcomes. Rules are
+# registered with @detector and all evaluated at the end of the pass, so a
+# new rule only needs new features, never another read of the capture. Each
+# rule returns findings that evaluate_rules turns into verdicts:
+# {'rule', 'attack', 'severity', 'target', 'start', 'end', 'evidence',
+# 'message'}, with start and end None for rules not tied to a time span.
+def detector(name, attack):
+    def register(check):
+        DETECTORS.append({'name': name, 'attack': attack, 'check': check})
+        return check
+    return register
+
+
+def new_rule_state(sketch_capacity=RULE_SKETCH_CAPACITY):
+    return {
+        'bucket_seconds': RULE_BUCKET_SECONDS,
+        'series': new_series(RULE_FEATURES),
+        'series_chunks': [],
+        'targets': {feature: new_topk_sketch('V16', sketch_capacity) for feature in TARGET_FEATURES},
+        'fragments': 0,
+        'overlapping': 0,
+        'overlap_targets': new_topk_sketch('V16', sketch_capacity),
+        # Fragments of datagrams that may still get an overlapping one
+        'pending': np.zeros(0, dtype=FRAGMENT_DTYPE),
+    }
+
+
+def feature_masks(columns, masks):
+    # `masks` are the counter masks of the analysis, see counter_masks
+    udp = masks['udp_count'] & columns['has_ports']
+    sport = columns['sport']
+    dport = columns['dport']
+    plain = (columns['ip_version'] != 0) & ~columns['encapsulated']
+    return {
+        'packets': masks['total_packets'],
+        'syn': masks['syn_without_ack_count'],
+        'syn_ack': masks['syn_ack_count'],
+        'udp': masks['udp_count'],
+        'icmp': plain & np.isin(columns['proto'], (IPPROTO_ICMP, IPPROTO_ICMPV6)),
+        'fragments': (columns['ip_version'] == 4) & ((columns['fragment'] != 0) | columns['more_fragments']),
+        'dns_responses': udp & (sport == DNS_PORT),
+        'dns_requests': udp & (dport == DNS_PORT),
+        'ntp_responses': udp & (sport == NTP_PORT),
+        'ntp_requests': udp & (dport == NTP_PORT),
+    }
+
+
+def _fragment_words(records):
+    src = np.ascontiguousarray(records['src']).view('>u8').reshape(-1, 2)
+    dst = np.ascontiguousarray(records['dst']).view('>u8').reshape(-1, 2)
+    datagram = records['ip_id'].astype(np.uint64) << np.uint64(8) | records['proto'].astype(np.uint64)
+    return [src[:, 0], src[:, 1], dst[:, 0], dst[:, 1], datagram]
+
+
+def _fold_fragments(state, records, now):
+    # Looks for fragments that overlap an earlier fragment of their datagram
+    # (teardrop and its variants), then keeps the fragments of the datagrams
+    # still in reassembly. Identical copies of a fragment are not an overlap.
+    if not len(records):
+        return
+    words = _fragment_words(records)
+    order = np.lexsort([records['start']] + words[::-1])
+    records = records[order]
+    words = [word[order] for word in words]
+    same = np.ones(len(records) - 1, dtype=bool)
+    for word in words:
+        same &= word[1:] == word[:-1]
+    group = np.concatenate([[0], np.cumsum(~same)])
+    # Furthest end so far within the datagram, offset by group so the running
+    # maximum restarts with every datagram
+    span = int(records['end'].max()) + 1
+    reach = np.maximum.accumulate(group * span + records['end']) - group * span
+    duplicate = (records['start'][1:] == records['start'][:-1]) & (records['end'][1:] == records['end'][:-1])
+    overlap = same & (records['start'][1:] < reach[:-1]) & ~duplicate
+    flagged = np.zeros(group[-1] + 1, dtype=bool)
+    flagged[group[1:][overlap]] = True
+    if flagged.any():
+        firsts = np.flatnonzero(np.concatenate([[True], ~same]))
+        state['overlapping'] += int(np.count_nonzero(flagged))
+        topk_update(state['overlap_targets'], records['dst'][firsts[flagged]])
+    keep = ~flagged[group] & (records['ts'] >= now - FRAGMENT_TIMEOUT)
+    pending = records[keep]
+    if len(pending) > FRAGMENT_PENDING_LIMIT:
+        pending = pending[np.argsort(pending['ts'], kind='stable')[-FRAGMENT_PENDING_LIMIT:]]
+    state['pending'] = pending
+
+
+def rule_update(state, columns, masks):
+    features = feature_masks(columns, masks)
+    series_update(state, state['bucket_seconds'], columns['ts'], columns['wirelen'], features)
+    wirelen = columns['wirelen'].astype(np.int64)
+    for feature, (field, metric) in TARGET_FEATURES.items():
+        mask = features[feature]
+        if mask.any():
+            topk_update(state['targets'][feature], columns[field][mask], wirelen[mask] if metric == 'bytes' else None)
+
+    fragments = columns[features['fragments']]
+    if len(fragments):
+        records = np.zeros(len(fragments), dtype=FRAGMENT_DTYPE)
+        for name in ('ts', 'src', 'dst', 'ip_id', 'proto'):
+            records[name] = fragments[name]
+        # The offset field counts 8-byte units
+        records['start'] = fragments['fragment'].astype(np.int64) * 8
+        records['end'] = records['start'] + fragments['ip_payload']
+        state['fragments'] += len(records)
+        _fold_fragments(state, np.concatenate([state['pending'], records]), float(columns['ts'].max()))
+
+
+def merge_rule_states(first, second):
+    merged = {
+        'bucket_seconds': first['bucket_seconds'],
+        'series': merge_series(finish_series(first), finish_series(second)),
+        'series_chunks': [],
+        'targets': {feature: merge_topk_sketches(sketch, second['targets'][feature])
+                    for feature, sketch in first['targets'].items()},
+        'fragments': first['fragments'] + second['fragments'],
+        'overlapping': first['overlapping'] + second['overlapping'],
+        'overlap_targets': merge_topk_sketches(first['overlap_targets'], second['overlap_targets']),
+        'pending': np.zeros(0, dtype=FRAGMENT_DTYPE),
+    }
+    # Fragments of one datagram split across the two
+    pending = np.concatenate([first['pending'], second['pending']])
+    if len(pending):
+        _fold_fragments(merged, pending, float(pending['ts'].max()))
+    return merged
+
+
+def _windows(state):
+    buckets_per_window = max(1, RULE_WINDOW_SECONDS // state['bucket_seconds'])
+    windowed = series_windows(finish_series(state), buckets_per_window)
+    window_seconds = buckets_per_window * state['bucket_seconds']
+    windows = {'seconds': window_seconds, 'start': windowed['bucket'] * window_seconds}
+    # Seconds of each window from its first to its last non-empty bucket, at
+    # least one bucket: rates of a short burst, or of a window the capture
+    # only starts or ends in, are not spread over the whole window
+    buckets = state['series']['bucket']
+    _, firsts = np.unique(buckets // buckets_per_window, return_index=True)
+    lasts = np.append(firsts[1:], len(buckets)) - 1
+    windows['covered'] = (buckets[lasts] - buckets[firsts] + 1) * state['bucket_seconds']
+    for feature in RULE_FEATURES:
+        windows[feature] = windowed[feature][:, SERIES_PACKETS]
+        windows[f"{feature}_bytes"] = windowed[feature][:, SERIES_BYTES]
+    return windows
+
+
+def _span(windows, flagged):
+    starts = windows['start'][flagged]
+    return float(starts.min()), float(starts.max() + windows['seconds'])
+
+
+def _severity(peak, threshold):
+    return 'high' if peak >= SEVERE_FACTOR * threshold else 'medium'
+
+
+def _top(sketch, limit=1):
+    # [(raw address, count)], highest count first
+    return [(bytes(key), int(count)) for key, count, _ in topk_items(sketch, limit)]
+
+
+def _tracked(sketch, key):
+    # Count of an address in a sketch, 0 when the sketch does not track it
+    found = np.flatnonzero(sketch['keys'] == np.void(key))
+    return int(sketch['counts'][found[0]]) if len(found) else 0
+
+
+def _flood(evidence, feature, min_rate, flagged=None):
+    # Windows where `feature` arrives at `min_rate` packets a second or more
+    windows = evidence['windows']
+    rate = windows[feature] / windows['covered']
+    flagged = rate >= min_rate if flagged is None else flagged & (rate >= min_rate)
+    if not flagged.any():
+        return None
+    start, end = _span(windows, flagged)
+    peak = float(rate[flagged].max())
+    return {
+        'start': start,
+        'end': end,
+        'severity': _severity(peak, min_rate),
+        'evidence': {
+            'peak_rate': round(peak, 1),
+            'windows': int(np.count_nonzero(flagged)),
+            'window_seconds': windows['seconds'],
+            'packets': int(windows[feature][flagged].sum()),
+            'bytes': int(windows[f"{feature}_bytes"][flagged].sum()),
+        },
+    }
+
+
+@detector('syn_flood', "SYN flood")
+def detect_syn_flood(evidence):
+    windows = evidence['windows']
+    finding = _flood(evidence, 'syn', SYN_FLOOD_MIN_RATE,
+                     windows['syn'] > SYN_FLOOD_MIN_RATIO * np.maximum(windows['syn_ack'], 1))
+    if not finding:
+        return []
+    targets = _top(evidence['flows']['tallies'][('targets', 'half_open')])
+    finding['target'] = format_address(targets[0][0]) if targets else None
+    finding['evidence']['half_open'] = targets[0][1] if targets else 0
+    finding['message'] = (f"Up to {finding['evidence']['peak_rate']:g} SYNs/s with more than "
+                          f"{SYN_FLOOD_MIN_RATIO} SYNs per SYN-ACK, {finding['evidence']['half_open']} handshakes "
+                          f"left half-open")
+    return [finding]
+
+
+@detector('udp_flood', "UDP flood")
+def detect_udp_flood(evidence):
+    windows = evidence['windows']
+    finding = _flood(evidence, 'udp', UDP_FLOOD_MIN_RATE,
+                     windows['udp'] >= UDP_FLOOD_MIN_SHARE * windows['packets'])
+    if not finding:
+        return []
+    targets = _top(evidence['targets']['udp'])
+    finding['target'] = format_address(targets[0][0]) if targets else None
+    finding['evidence']['target_packets'] = targets[0][1] if targets else 0
+    finding['message'] = f"Up to {finding['evidence']['peak_rate']:g} UDP packets/s, most of the traffic"
+    return [finding]
+
+
+@detector('icmp_flood', "ICMP flood")
+def detect_icmp_flood(evidence):
+    finding = _flood(evidence, 'icmp', ICMP_FLOOD_MIN_RATE)
+    if not finding:
+        return []
+    targets = _top(evidence['targets']['icmp'])
+    finding['target'] = format_address(targets[0][0]) if targets else None
+    finding['evidence']['target_packets'] = targets[0][1] if targets else 0
+    finding['message'] = f"Up to {finding['evidence']['peak_rate']:g} ICMP packets/s"
+    return [finding]
+
+
+@detector('fragment_overlap', "Overlapping IP fragments (teardrop)")
+def detect_fragment_overlap(evidence):
+    rules = evidence['rules']
+    findings = []
+    for target, count in _top(rules['overlap_targets'], RULE_TARGETS_LIMIT):
+        if count < FRAGMENT_OVERLAP_MIN:
+            continue
+        findings.append({
+            'target': format_address(target),
+            'start': None,
+            'end': None,
+            'severity': _severity(count, FRAGMENT_OVERLAP_MIN),
+            'evidence': {'overlapping_datagrams': count, 'fragments': rules['fragments']},
+            'message': f"{count} datagrams with overlapping fragments",
+        })
+    return findings
+
+
+def _amplification(evidence, service):
+    windows = evidence['windows']
+    findings = []
+    for target, response_bytes in _top(evidence['targets'][f"{service}_responses"], RULE_TARGETS_LIMIT):
+        request_bytes = _tracked(evidence['targets'][f"{service}_requests"], target)
+        if response_bytes < AMPLIFICATION_MIN_BYTES or response_bytes < AMPLIFICATION_MIN_FACTOR * request_bytes:
+            continue
+        flagged = windows[f"{service}_responses"] > 0
+        start, end = _span(windows, flagged)
+        # Responses without any request from the target: the queries were spoofed
+        factor = round(response_bytes / request_bytes, 1) if request_bytes else None
+        findings.append({
+            'target': format_address(target),
+            'start': start,
+            'end': end,
+            'severity': _severity(response_bytes, AMPLIFICATION_MIN_BYTES),
+            'evidence': {
+                'response_bytes': response_bytes,
+                'request_bytes': request_bytes,
+                'amplification': factor,
+                'peak_bytes_rate': round(float((windows[f"{service}_responses_bytes"] / windows['covered']).max()), 1),
+            },
+            'message': (f"{response_bytes} bytes of {service.upper()} responses, "
+                        + (f"{factor:g}x the bytes of its requests" if factor else "with no request from the target")),
+        })
+    return findings
+
+
+@detector('dns_amplification', "DNS amplification")
+def detect_dns_amplification(evidence):
+    return _amplification(evidence, 'dns')
+
+
+@detector('ntp_amplification', "NTP amplification")
+def detect_ntp_amplification(evidence):
+    return _amplification(evidence, 'ntp')
+
+
+@detector('slow_http', "Low-and-slow HTTP (Slowloris)")
+def detect_slow_http(evidence):
+    tallies = evidence['flows']['tallies']
+    findings = []
+    for target, count in _top(tallies[('targets', 'slow')], RULE_TARGETS_LIMIT):
+        if count < SLOW_HTTP_MIN_FLOWS:
+            continue
+        findings.append({
+            'target': format_address(target),
+            'start': None,
+            'end': None,
+            'severity': _severity(count, SLOW_HTTP_MIN_FLOWS),
+            'evidence': {'slow_connections': count, 'handshakes': _tracked(tallies[('targets', 'handshakes')], target)},
+            'message': f"{count} web connections held open with almost no data",
+        })
+    return findings
+
+
+def evaluate_rules(state, flows):
+    # Verdicts of every registered rule, most severe first; `flows` are the
+    # flow table's results, see flow_results
+    evidence = {
+        'rules': state,
+        'windows': _windows(state),
+        'targets': state['targets'],
+        'flows': flows,
+    }
+    verdicts = []
+    for rule in DETECTORS:
+        for finding in rule['check'](evidence):
+            verdicts.append({'rule': rule['name'], 'attack': rule['attack'], **finding})
+    verdicts.sort(key=lambda verdict: (-SEVERITIES.index(verdict['severity']), verdict['start'] is None,
+                                       verdict['start'] or 0))
+    return verdicts
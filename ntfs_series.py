@@ -0,0 +1,96 @@
+import io
+import zlib
+
+import numpy as np
+
+DEFAULT_BUCKET_SECONDS = 1
+
+# Every counter of a series row holds [packets, bytes]
+SERIES_PACKETS = 0
+SERIES_BYTES = 1
+
+
+# Time series of counters, one row per non-empty bucket of capture time sorted
+# by bucket number (timestamp // bucket seconds). Buckets with no packets are
+# not stored, so bogus timestamps far from the rest cost a single row.
+def series_dtype(counter_names):
+    return np.dtype([('bucket', '<i8')] + [(name, '<i8', (2,)) for name in counter_names])
+
+
+def new_series(counter_names):
+    return np.zeros(0, dtype=series_dtype(counter_names))
+
+
+def _group(buckets, rows):
+    # Sums rows that share a bucket number
+    uniq, inverse = np.unique(buckets, return_inverse=True)
+    grouped = np.zeros(len(uniq), dtype=rows.dtype)
+    grouped['bucket'] = uniq
+    inverse = inverse.ravel()
+    for name in rows.dtype.names[1:]:
+        np.add.at(grouped[name], inverse, rows[name])
+    return grouped
+
+
+def series_update(state, bucket_seconds, ts, wirelen, masks):
+    # Adds the series of one chunk of packets to state['series_chunks'];
+    # `masks` maps counter names to boolean masks over the chunk. The chunks
+    # are merged into state['series'] once, by finish_series, rather than
+    # re-sorting the whole series with every chunk.
+    if not len(ts):
+        return
+    buckets = (ts // bucket_seconds).astype(np.int64)
+    first = int(buckets.min())
+    span = int(buckets.max()) - first + 1
+    if span > len(buckets):
+        # Timestamps too scattered for a dense range
+        uniq, index = np.unique(buckets, return_inverse=True)
+        index = index.ravel()
+        span = len(uniq)
+    else:
+        uniq = np.arange(first, first + span, dtype=np.int64)
+        index = buckets - first
+
+    chunk = np.zeros(span, dtype=state['series'].dtype)
+    chunk['bucket'] = uniq
+    for name, mask in masks.items():
+        selected = index[mask]
+        chunk[name][:, SERIES_PACKETS] = np.bincount(selected, minlength=span)
+        chunk[name][:, SERIES_BYTES] = np.bincount(selected, weights=wirelen[mask], minlength=span)
+    state['series_chunks'].append(chunk[np.bincount(index, minlength=span) > 0])
+
+
+def finish_series(state):
+    # Merges the chunks collected by series_update into state['series']
+    if state['series_chunks']:
+        rows = np.concatenate([state['series']] + state['series_chunks'])
+        state['series'] = _group(rows['bucket'], rows)
+        state['series_chunks'] = []
+    return state['series']
+
+
+def merge_series(first, second):
+    if not len(first):
+        return second
+    if not len(second):
+        return first
+    rows = np.concatenate([first, second])
+    return _group(rows['bucket'], rows)
+
+
+def series_windows(series, buckets_per_window):
+    # Sums the series over consecutive windows of `buckets_per_window` buckets;
+    # the bucket column then holds window numbers
+    if buckets_per_window <= 1:
+        return series
+    return _group(series['bucket'] // buckets_per_window, series)
+
+
+def series_to_blob(series):
+    buffer = io.BytesIO()
+    np.save(buffer, series, allow_pickle=False)
+    return zlib.compress(buffer.getvalue())
+
+
+def series_from_blob(blob):
+    return np.load(io.BytesIO(zlib.decompress(blob)), allow_pickle=False)
@@ -0,0 +1,117 @@
+import numpy as np
+
+# Number of counters kept per sketch; memory stays fixed at this many keys
+# no matter how many distinct (possibly spoofed) addresses the capture has.
+DEFAULT_SKETCH_CAPACITY = 4096
+
+
+# Space-Saving heavy-hitter sketch kept as arrays so whole chunks can be folded
+# in at once. Every tracked key has an estimate that never undercounts and an
+# error such that `count - error` never overcounts. Two sketches over
+# different chunks or files merge into a sketch with the same guarantees.
+def new_topk_sketch(key_dtype, capacity=DEFAULT_SKETCH_CAPACITY):
+    return {
+        'capacity': capacity,
+        'total': 0,
+        'keys': np.zeros(0, dtype=key_dtype),
+        'counts': np.zeros(0, dtype=np.int64),
+        'errors': np.zeros(0, dtype=np.int64),
+    }
+
+
+def _floor(sketch):
+    # Anything not tracked by a full sketch was counted at most this many times
+    if len(sketch['keys']) < sketch['capacity']:
+        return 0
+    return int(sketch['counts'].min())
+
+
+def unique_keys(keys):
+    # np.unique(keys, return_inverse=True), faster for raw address keys:
+    # sorting void keys compares bytes one by one, big-endian 64-bit words
+    # sort the same
+    if keys.dtype.kind != 'V' or keys.dtype.itemsize % 8:
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        return uniq, inverse.ravel()
+    if not len(keys):
+        return keys, np.zeros(0, dtype=np.intp)
+    words = np.ascontiguousarray(keys).view('>u8').reshape(len(keys), -1).astype(np.uint64)
+    # Words the same in every key, like the prefix of IPv4-mapped addresses, do not change the order
+    words = words[:, (words != words[0]).any(axis=0)]
+    if words.shape[1] <= 1:
+        column = words[:, 0] if words.shape[1] else np.zeros(len(keys), dtype=np.uint64)
+        _, first, inverse = np.unique(column, return_index=True, return_inverse=True)
+        return keys[first], inverse.ravel()
+    order = np.lexsort(words.T[::-1])
+    words = words[order]
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (words[1:] != words[:-1]).any(axis=1)
+    inverse = np.empty(len(order), dtype=np.intp)
+    inverse[order] = np.cumsum(new) - 1
+    return keys[order[new]], inverse
+
+
+def _combine(capacity, parts):
+    keys = np.concatenate([part[0] for part in parts])
+    uniq, inverse = unique_keys(keys)
+    counts = np.zeros(len(uniq), dtype=np.int64)
+    errors = np.zeros(len(uniq), dtype=np.int64)
+
+    start = 0
+    for part_keys, part_counts, part_errors, floor in parts:
+        index = inverse[start:start + len(part_keys)]
+        start += len(part_keys)
+        np.add.at(counts, index, part_counts)
+        np.add.at(errors, index, part_errors)
+        if floor:
+            missing = np.ones(len(uniq), dtype=bool)
+            missing[index] = False
+            counts[missing] += floor
+            errors[missing] += floor
+
+    if len(uniq) > capacity:
+        # Highest counts win, ties go to the smaller key so merges are deterministic
+        keep = np.lexsort((np.arange(len(uniq)), -counts))[:capacity]
+        keep.sort()
+        uniq, counts, errors = uniq[keep], counts[keep], errors[keep]
+
+    return uniq, counts, errors
+
+
+def topk_update(sketch, keys, weights=None):
+    if not len(keys):
+        return
+    chunk_keys, inverse = unique_keys(keys)
+    if weights is None:
+        chunk_counts = np.bincount(inverse, minlength=len(chunk_keys)).astype(np.int64)
+    else:
+        chunk_counts = np.zeros(len(chunk_keys), dtype=np.int64)
+        np.add.at(chunk_counts, inverse, weights)
+
+    # The chunk is counted exactly, so only the sketch side carries a floor
+    sketch['keys'], sketch['counts'], sketch['errors'] = _combine(sketch['capacity'], [
+        (sketch['keys'], sketch['counts'], sketch['errors'], _floor(sketch)),
+        (chunk_keys, chunk_counts, np.zeros(len(chunk_keys), dtype=np.int64), 0),
+    ])
+    sketch['total'] += int(chunk_counts.sum())
+
+
+def merge_topk_sketches(first, second):
+    capacity = min(first['capacity'], second['capacity'])
+    merged = new_topk_sketch(first['keys'].dtype, capacity)
+    merged['keys'], merged['counts'], merged['errors'] = _combine(capacity, [
+        (first['keys'], first['counts'], first['errors'], _floor(first)),
+        (second['keys'], second['counts'], second['errors'], _floor(second)),
+    ])
+    merged['total'] = first['total'] + second['total']
+    return merged
+
+
+def topk_items(sketch, k):
+    order = np.lexsort((np.arange(len(sketch['keys'])), -sketch['counts']))[:k]
+    return [(sketch['keys'][i], int(sketch['counts'][i]), int(sketch['errors'][i])) for i in order]
+
+
+def topk_error_bound(sketch):
+    # Worst-case overestimate for any key, tracked or not
+    return sketch['total'] // sketch['capacity']
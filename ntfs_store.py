@@ -0,0 +1,357 @@
+import bisect
+import os
+import shutil
+import struct
+
+# The evidence store needs the zstandard package, like zstd-compressed captures
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from ntfs_data import get_case_details_by_id, get_pcap_file_hashes_for_case, update_pcap_file_path, \
+    register_column_stores, unregister_column_store
+from ntfs_hash import copy_and_hash, new_hashers, update_hashers, hexdigests
+from ntfs_pcap import PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN, PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC, capture_compression
+
+# Evidence files kept compressed are named like the original with this added
+STORE_EXTENSION = '.zst'
+# Uncompressed bytes per frame: the unit of random access
+STORE_FRAME_BYTES = 1 << 20
+STORE_COMPRESSION_LEVEL = 3
+# Records longer than this are not waited for to cut frames at record boundaries
+MAX_RECORD_BYTES = 1 << 18
+
+# Seek table of the zstd seekable format: a skippable frame after the data
+# frames, with the compressed and decompressed size of each of them
+SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER = struct.Struct('<IBI')
+SEEK_TABLE_ENTRY = struct.Struct('<II')
+SEEK_TABLE_CHECKSUM_FLAG = 0x80
+SKIPPABLE_HEADER_LEN = 8
+
+
+# Evidence files are written as seekable zstd: independent frames of
+# STORE_FRAME_BYTES, followed by a table of their sizes. Any zstd tool can
+# still decompress the whole file; with the table, a byte range of the
+# original is read by decompressing only the frames that hold it. Frames of a
+# pcap are cut at record boundaries, so every frame but the first starts with
+# a record and frames can be decoded on their own.
+def new_store_writer(f, level=STORE_COMPRESSION_LEVEL, frame_bytes=STORE_FRAME_BYTES):
+    if zstandard is None:
+        raise ValueError("The compressed evidence store needs the zstandard package")
+    return {
+        'file': f,
+        'compressor': zstandard.ZstdCompressor(level=level, write_checksum=True),
+        'frame_bytes': frame_bytes,
+        'pending': bytearray(),
+        # Record length reader of a pcap, False once the data is known not to be one
+        'record': None,
+        # Start of the first record of `pending` not walked yet
+        'next_record': PCAP_GLOBAL_HEADER_LEN,
+        # (compressed size, decompressed size) of every frame written
+        'frames': [],
+    }
+
+
+def _pcap_record_reader(header):
+    magic = header[:4]
+    for endian in ('<', '>'):
+        if struct.unpack(endian + 'I', magic)[0] in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            return struct.Struct(endian + 'I').unpack_from
+    return False
+
+
+def _write_frame(writer, size):
+    pending = writer['pending']
+    frame = writer['compressor'].compress(bytes(pending[:size]))
+    writer['file'].write(frame)
+    writer['frames'].append((len(frame), size))
+    del pending[:size]
+
+
+def store_write(writer, data):
+    pending = writer['pending']
+    pending += data
+    if writer['record'] is None:
+        if len(pending) < PCAP_GLOBAL_HEADER_LEN:
+            return
+        writer['record'] = _pcap_record_reader(pending)
+
+    frame_bytes = writer['frame_bytes']
+    if not writer['record']:
+        while len(pending) >= frame_bytes:
+            _write_frame(writer, frame_bytes)
+        return
+
+    caplen_at = writer['record']
+    pos = writer['next_record']
+    while pos + PCAP_RECORD_HEADER_LEN <= len(pending):
+        record_len = PCAP_RECORD_HEADER_LEN + caplen_at(pending, pos + 8)[0]
+        if record_len > MAX_RECORD_BYTES:
+            # Not a sane pcap record: frames are cut at fixed sizes from here on
+            writer['record'] = False
+            writer['next_record'] = 0
+            store_write(writer, b'')
+            return
+        if pos + record_len > len(pending):
+            break
+        pos += record_len
+        if pos >= frame_bytes:
+            _write_frame(writer, pos)
+            pos = 0
+    writer['next_record'] = pos
+
+
+def store_close(writer):
+    if writer['pending']:
+        _write_frame(writer, len(writer['pending']))
+    frames = writer['frames']
+    table = b''.join(SEEK_TABLE_ENTRY.pack(*frame) for frame in frames)
+    table += SEEK_TABLE_FOOTER.pack(len(frames), 0, SEEKABLE_MAGIC)
+    writer['file'].write(struct.pack('<II', SKIPPABLE_FRAME_MAGIC, len(table)) + table)
+
+
+def store_consumer(writer, consumer=None):
+    # copy_and_hash consumer writing every block to the store, then passing it on
+    def consume(block):
+        store_write(writer, block)
+        if consumer is not None:
+            consumer(block)
+    return consume
+
+
+def write_store_file(source, destination_path):
+    # Compresses the readable `source` into a new evidence file; returns the
+    # hashes of the original content, the ones recorded for the evidence
+    with open(destination_path, 'xb') as f:
+        writer = new_store_writer(f)
+        file_hashes = copy_and_hash(source, consumer=store_consumer(writer))
+        store_close(writer)
+    return file_hashes
+
+
+def read_seek_table(path):
+    # [(compressed offset, decompressed offset, compressed size, decompressed size)]
+    # of every frame, or None if the file is not in the seekable format
+    with open(path, 'rb') as f:
+        f.seek(0, 2)
+        size = f.tell()
+        if size < SKIPPABLE_HEADER_LEN + SEEK_TABLE_FOOTER.size:
+            return None
+        f.seek(size - SEEK_TABLE_FOOTER.size)
+        count, descriptor, magic = SEEK_TABLE_FOOTER.unpack(f.read(SEEK_TABLE_FOOTER.size))
+        if magic != SEEKABLE_MAGIC:
+            return None
+        entry_len = SEEK_TABLE_ENTRY.size + (4 if descriptor & SEEK_TABLE_CHECKSUM_FLAG else 0)
+        table_len = count * entry_len + SEEK_TABLE_FOOTER.size
+        if table_len + SKIPPABLE_HEADER_LEN > size:
+            return None
+        f.seek(size - table_len - SKIPPABLE_HEADER_LEN)
+        skippable_magic, frame_len = struct.unpack('<II', f.read(SKIPPABLE_HEADER_LEN))
+        if skippable_magic != SKIPPABLE_FRAME_MAGIC or frame_len != table_len:
+            return None
+        table = f.read(count * entry_len)
+
+    frames = []
+    compressed_offset = decompressed_offset = 0
+    for i in range(count):
+        compressed_size, decompressed_size = SEEK_TABLE_ENTRY.unpack_from(table, i * entry_len)
+        frames.append((compressed_offset, decompressed_offset, compressed_size, decompressed_size))
+        compressed_offset += compressed_size
+        decompressed_offset += decompressed_size
+    return frames
+
+
+def is_store_file(path):
+    return read_seek_table(path) is not None
+
+
+def store_content_size(frames):
+    return frames[-1][1] + frames[-1][3] if frames else 0
+
+
+def iter_store_frames(path, frames, first=0, last=None):
+    # (decompressed offset, data) of frames first..last
+    if zstandard is None:
+        raise ValueError("Reading the compressed evidence store needs the zstandard package")
+    decompressor = zstandard.ZstdDecompressor()
+    with open(path, 'rb') as f:
+        for compressed_offset, decompressed_offset, compressed_size, _ in frames[first:last]:
+            f.seek(compressed_offset)
+            yield decompressed_offset, decompressor.decompress(f.read(compressed_size))
+
+
+def frame_index(frames, offset):
+    # Index of the frame holding decompressed byte `offset`
+    return max(bisect.bisect_right([frame[1] for frame in frames], offset) - 1, 0)
+
+
+def read_store_range(path, start, end, frames=None):
+    # Bytes [start, end) of the original content
+    frames = read_seek_table(path) if frames is None else frames
+    end = min(end, store_content_size(frames))
+    if start >= end:
+        return b''
+    parts = []
+    for offset, data in iter_store_frames(path, frames, frame_index(frames, start), frame_index(frames, end - 1) + 1):
+        parts.append(data[max(start - offset, 0):end - offset])
+    return b''.join(parts)
+
+
+def new_store_cursor(path, frames=None):
+    # Random reads of a store file, keeping the last frame decompressed so
+    # reads moving forward decompress every frame once
+    frames = read_seek_table(path) if frames is None else frames
+    return {'path': path, 'frames': frames, 'starts': [frame[1] for frame in frames], 'frame': None, 'data': b''}
+
+
+def store_read(cursor, start, end):
+    frames = cursor['frames']
+    parts = []
+    pos = start
+    while pos < end:
+        i = bisect.bisect_right(cursor['starts'], pos) - 1
+        if i < 0 or pos >= frames[i][1] + frames[i][3]:
+            break
+        if cursor['frame'] != i:
+            _, cursor['data'] = next(iter_store_frames(cursor['path'], frames, i, i + 1))
+            cursor['frame'] = i
+        offset = frames[i][1]
+        part = cursor['data'][pos - offset:end - offset]
+        parts.append(part)
+        pos += len(part)
+    return b''.join(parts)
+
+
+def is_store_pcap(path):
+    frames = read_seek_table(path)
+    return bool(frames) and bool(_pcap_record_reader(read_store_range(path, 0, 4, frames).ljust(4, b'\0')))
+
+
+def plan_store_segments(path, segment_bytes):
+    # Segments of a pcap in the store, split at frame boundaries so each one
+    # decompresses only its own frames
+    frames = read_seek_table(path)
+    bounds = [PCAP_GLOBAL_HEADER_LEN]
+    for _, decompressed_offset, _, _ in frames[1:]:
+        if decompressed_offset - bounds[-1] >= segment_bytes:
+            bounds.append(decompressed_offset)
+    bounds.append(store_content_size(frames))
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end] or [(bounds[0], bounds[0])]
+
+
+def calculate_evidence_hashes(path, prefix=None):
+    # Hashes of the original content: evidence files in the store are hashed
+    # as they are decompressed, frame by frame, so the digests match those
+    # taken when the capture was written or imported. `prefix` applies to
+    # files outside the store, see copy_and_hash
+    frames = read_seek_table(path)
+    if frames is None:
+        with open(path, 'rb') as f:
+            return copy_and_hash(f, prefix=prefix)
+    hashers = new_hashers()
+    for _, data in iter_store_frames(path, frames):
+        update_hashers(hashers, data)
+    return hexdigests(hashers)
+
+
+def store_evidence_file(file_path, expected_hashes=None):
+    # Compresses an evidence file into the store next to it and removes the
+    # original once the stored content is known to hash the same, and the same
+    # as recorded when it was captured or imported
+    stored_path = file_path + STORE_EXTENSION
+    with open(file_path, 'rb') as source:
+        file_hashes = write_store_file(source, stored_path)
+    try:
+        if expected_hashes and expected_hashes['sha256'] and expected_hashes['sha256'] != file_hashes['sha256']:
+            raise ValueError(f"{file_path} does not match its recorded SHA-256, leaving it as is")
+        if calculate_evidence_hashes(stored_path) != file_hashes:
+            raise ValueError(f"Stored copy of {file_path} does not match the original")
+    except Exception:
+        os.remove(stored_path)
+        raise
+    shutil.copystat(file_path, stored_path)
+    os.remove(file_path)
+    return stored_path, file_hashes
+
+
+def store_pcap_files(connection, case_id, pcap_filenames):
+    # Moves files of the case from outputs/ into the compressed evidence store.
+    # Returns the (file_path, file_hashes) of every file stored, and the names
+    # of those that could not be; files already compressed are left as they are
+    # Imported here, ntfs_index and ntfs_columns read files through this module
+    from ntfs_index import remove_packet_index
+    from ntfs_columns import column_store_is_current, move_column_store, remove_column_store
+    case_details = get_case_details_by_id(connection, case_id)
+    if not case_details:
+        print("Invalid case ID.")
+        return [], list(pcap_filenames)
+
+    recorded = {file_path: (md5, sha256) for file_path, _, md5, sha256
+                in get_pcap_file_hashes_for_case(connection, case_details[0])}
+    stored = []
+    failed = []
+    for pcap_filename in pcap_filenames:
+        file_path = os.path.join('outputs', pcap_filename)
+        if file_path not in recorded:
+            print(f"{pcap_filename} is not a file of this case.")
+            failed.append(pcap_filename)
+        elif not os.path.isfile(file_path):
+            print(f"File does not exist: {pcap_filename}")
+            failed.append(pcap_filename)
+        elif capture_compression(file_path):
+            print(f"{pcap_filename} is already compressed.")
+        else:
+            md5, sha256 = recorded[file_path]
+            has_columns = column_store_is_current(file_path)
+            try:
+                stored_path, file_hashes = store_evidence_file(file_path, {'md5': md5, 'sha256': sha256})
+            except Exception as e:
+                print(f"Error storing {pcap_filename}:", e)
+                failed.append(pcap_filename)
+                continue
+            update_pcap_file_path(connection, file_path, stored_path)
+            # The stored file gets a new index when it is next analyzed or queried
+            remove_packet_index(file_path)
+            # Its column store holds the same packets and is kept, under the stored name
+            unregister_column_store(connection, case_details[0], pcap_filename)
+            if has_columns:
+                register_column_stores(connection, case_details[0],
+                                       [(os.path.basename(stored_path), move_column_store(file_path, stored_path))])
+            else:
+                remove_column_store(file_path)
+            ratio = store_content_size(read_seek_table(stored_path)) / os.path.getsize(stored_path)
+            print(f"{pcap_filename} stored as {stored_path}, {ratio:.1f}x smaller.")
+            stored.append((stored_path, file_hashes))
+    return stored, failed
+
+
+def verify_pcap_files(connection, case_id):
+    # (file_path, result) of every file of the case: 'verified', 'mismatch',
+    # 'missing', 'expired' (deleted by a capture ring) or 'unhashed'
+    case_details = get_case_details_by_id(connection, case_id)
+    if not case_details:
+        print("Invalid case ID.")
+        return []
+
+    results = []
+    for file_path, status, md5, sha256 in get_pcap_file_hashes_for_case(connection, case_details[0]):
+        if status == 'expired':
+            result = 'expired'
+        elif not os.path.isfile(file_path):
+            result = 'missing'
+        elif not sha256:
+            result = 'unhashed'
+        else:
+            try:
+                file_hashes = calculate_evidence_hashes(file_path)
+            except Exception as e:
+                # e.g. a damaged frame of a compressed file
+                print(f"Error reading {file_path}:", e)
+                file_hashes = None
+            result = 'verified' if file_hashes == {'md5': md5, 'sha256': sha256} else 'mismatch'
+        print(f"{file_path}: {result}")
+        results.append((file_path, result))
+    return results
@@ -1,11 +1,11 @@
 import argparse
 import subprocess
 import os
+import sys
 from ntfs_data import create_connection, create_tables, get_existing_cases, get_case_details_by_id, get_pcap_files_for_case
 from ntfs_display import clear_screen, display_figlet_with_lolcat
-from ntfs_registration import register_case, choose_existing_case
-from ntfs_analysis import analyze_pcap_file, display_pcap_file, handle_command
-from ntfs_report import generate_pdf_report
+# ntfs_registration, ntfs_analysis and ntfs_report load numpy, tabulate and
+# reportlab; they are imported where the menu first needs them
 
 def display_cases_table(cases):
     table_header = "| {:<5} | {:<20} | {:<20} | {:<20} | {:<15} |".format("No", "Case Name", "Organization", "Investigator Name", "Date created")
@@ -19,16 +19,22 @@ def display_cases_table(cases):
         print(case_row)
 
 def main():
+    # With arguments the tool runs one scripted command, see ntfs_cli
+    if len(sys.argv) > 1:
+        from ntfs_cli import main as run_command
+        sys.exit(run_command(sys.argv[1:]))
+
+    # One connection for the whole session, the schema is brought up to date once
+    db_file = "ntfs.db"
+    connection = create_connection(db_file)
+    if connection is not None:
+        create_tables(connection)
+
     while True:
         clear_screen()
         display_figlet_with_lolcat("Network Forensic Tool", "standard")
         display_figlet_with_lolcat("Main Menu", "digital")
 
-        db_file = "ntfs.db"
-        connection = create_connection(db_file)
-        if connection is not None:
-            create_tables(connection)
-
         print("\n1. Register Case")
         print("2. Work on Existing Case")
         print("3. Retrieve Reports")
@@ -36,6 +42,7 @@ def main():
         choice = input("Enter your choice: ")
 
         if choice == '1':
+            from ntfs_registration import register_case
             case_id = register_case(connection)
             if case_id:
                 case_registered = True
@@ -43,6 +50,7 @@ def main():
                 continue  
             
         elif choice == '2':
+            from ntfs_registration import choose_existing_case
             case_id = choose_existing_case(connection)
             if case_id:
                 case_registered = True
@@ -57,7 +65,8 @@ def main():
                 case_id = input("\nEnter the ID of the case to generate report: ")
                 case_details = get_case_details_by_id(connection, case_id)
                 pcap_files = get_pcap_files_for_case(connection, case_details[0])
-                generate_pdf_report(case_details, pcap_files)
+                from ntfs_report import generate_pdf_report
+                generate_pdf_report(case_details, pcap_files, connection)
             else:
                 print("No existing cases found.")
             input("Press Enter to continue...")
@@ -71,6 +80,7 @@ def main():
             input("Press Enter to continue...")
 
         if case_id:
+            from ntfs_analysis import handle_command
             while True:
                 command = input("\nEnter command: ")
                 if command.startswith("ntfs "):
@@ -0,0 +1,76 @@
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ntfs_data import create_connection, create_tables, insert_registration
+
+CASE_NAME = "TEST"
+ORG_NAME = "org"
+LINKTYPE_ETHERNET = 1
+MAC = b'\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02'
+
+
+def ipv4(proto, payload, src=0x0A000001, dst=0xC0000201, options=b"", fragment=0):
+    ihl = (20 + len(options)) // 4
+    return struct.pack('>BBHHHBBHII', 0x40 | ihl, 0, 20 + len(options) + len(payload), 1, fragment, 64, proto, 0,
+                       src, dst) + options + payload
+
+
+def ipv6(next_header, payload):
+    return struct.pack('>IHBB', 0x60000000, len(payload), next_header, 64) + b'\x20\x01' + b'\x00' * 13 + b'\x01' \
+        + b'\x20\x01' + b'\x00' * 13 + b'\x02' + payload
+
+
+def tcp(sport, dport, flags, payload=b""):
+    return struct.pack('>HHIIBBHHH', sport, dport, 1, 0, 0x50, flags, 0xFFFF, 0, 0) + payload
+
+
+def udp(sport, dport, payload=b""):
+    return struct.pack('>HHHH', sport, dport, 8 + len(payload), 0) + payload
+
+
+def ethernet(ethertype, payload, vlan=None):
+    if vlan is not None:
+        return MAC + struct.pack('>HHH', 0x8100, vlan, ethertype) + payload
+    return MAC + struct.pack('>H', ethertype) + payload
+
+
+def pcap_header(linktype=LINKTYPE_ETHERNET, snaplen=65535):
+    return struct.pack('<IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, snaplen, linktype)
+
+
+def pcap_record(ts, frame, wirelen=None):
+    seconds = int(ts)
+    return struct.pack('<IIII', seconds, int(round((ts - seconds) * 1e6)), len(frame),
+                       wirelen or len(frame)) + frame
+
+
+def write_pcap(path, frames, start=1700000000.0, step=0.001):
+    # `frames` are Ethernet frames, one record each `step` seconds apart
+    return write_timed_pcap(path, [(start + i * step, frame) for i, frame in enumerate(frames)])
+
+
+def write_timed_pcap(path, packets):
+    # `packets` are (timestamp, Ethernet frame)
+    with open(path, 'wb') as f:
+        f.write(pcap_header())
+        for ts, frame in packets:
+            f.write(pcap_record(ts, frame))
+    return path
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch, capsys):
+    # The tool works relative to the current folder: ntfs.db and outputs/
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('outputs')
+    connection = create_connection('ntfs.db')
+    create_tables(connection)
+    case_id = insert_registration(connection, CASE_NAME, ORG_NAME, "investigator", "2024-01-01")
+    capsys.readouterr()
+    yield {'connection': connection, 'case_id': case_id, 'case_name': CASE_NAME, 'path': tmp_path}
+    connection.close()
@@ -0,0 +1,117 @@
+import os
+
+from ntfs_analysis import analyze_pcap_files
+from ntfs_bench import generate_pcap
+from ntfs_data import get_analysis_checkpoint
+from ntfs_engine import ANALYZER_VERSION, COUNTER_NAMES, analyze_single_pass
+from ntfs_series import DEFAULT_BUCKET_SECONDS
+
+
+def comparable(analysis_details):
+    # What a resumed analysis reproduces exactly; heavy hitters and
+    # per-destination source counts are approximate across the split
+    diversity = analysis_details['source_diversity']
+    return {
+        'counters': {key: analysis_details[key] for key in COUNTER_NAMES},
+        'series': analysis_details['series'].tobytes(),
+        'flow_count': analysis_details['flow_count'],
+        'half_open_count': analysis_details['half_open_count'],
+        'verdicts': analysis_details['verdicts'],
+        'sources': (diversity['sources'], diversity['networks'], diversity['peak']),
+    }
+
+
+def growing_capture(tmp_path, scenario='syn_flood', size=1 << 20, seed=3):
+    # The whole capture, and the same file as it was part way through, cut
+    # in the middle of a record
+    full_path = tmp_path / 'full.pcap'
+    generate_pcap(full_path, scenario, size, seed)
+    data = full_path.read_bytes()
+    return full_path, data, len(data) * 2 // 5 + 7
+
+
+def analysis_rows(connection, pcap_filename):
+    cursor = connection.execute("SELECT id, total_packets FROM pcap_analysis WHERE pcap_file_name=? ORDER BY id",
+                                (pcap_filename,))
+    return cursor.fetchall()
+
+
+def test_resumed_analysis_matches_full_analysis(tmp_path):
+    full_path, data, cut = growing_capture(tmp_path)
+    path = tmp_path / 'grow.pcap'
+    path.write_bytes(data[:cut])
+
+    first = analyze_single_pass(str(path), checkpoint=True)
+    blob, end_offset = first['checkpoint']
+    # Stopped after the last complete record
+    assert end_offset < cut
+
+    path.write_bytes(data)
+    resumed = analyze_single_pass(str(path), resume=(blob, end_offset), checkpoint=True)
+    full = analyze_single_pass(str(full_path))
+    assert comparable(resumed) == comparable(full)
+    assert resumed['checkpoint'][1] == len(data)
+
+
+def test_resume_over_several_workers(tmp_path):
+    full_path, data, cut = growing_capture(tmp_path, 'http_flood', seed=4)
+    path = tmp_path / 'grow.pcap'
+    path.write_bytes(data[:cut])
+    checkpoint = analyze_single_pass(str(path), workers=2, checkpoint=True)['checkpoint']
+
+    path.write_bytes(data)
+    resumed = analyze_single_pass(str(path), workers=3, resume=checkpoint)
+    assert comparable(resumed) == comparable(analyze_single_pass(str(full_path)))
+
+
+def test_incremental_analysis_updates_the_same_row(workspace, tmp_path):
+    connection, case_id, case_name = workspace['connection'], workspace['case_id'], workspace['case_name']
+    full_path, data, cut = growing_capture(tmp_path)
+    path = os.path.join('outputs', 'grow.pcap')
+    with open(path, 'wb') as f:
+        f.write(data[:cut])
+
+    analyze_pcap_files(['grow.pcap'], connection, case_id, incremental=True)
+    [(analysis_id, partial_packets)] = analysis_rows(connection, 'grow.pcap')
+    checkpoint = get_analysis_checkpoint(connection, case_name, 'grow.pcap', ANALYZER_VERSION, DEFAULT_BUCKET_SECONDS)
+    assert checkpoint[0] == analysis_id
+
+    with open(path, 'wb') as f:
+        f.write(data)
+    # Resumed without asking for it again, and still keeping a checkpoint
+    analyze_pcap_files(['grow.pcap'], connection, case_id)
+    full_packets = analyze_single_pass(str(full_path))['total_packets']
+    assert analysis_rows(connection, 'grow.pcap') == [(analysis_id, full_packets)]
+    assert partial_packets < full_packets
+    checkpoint = get_analysis_checkpoint(connection, case_name, 'grow.pcap', ANALYZER_VERSION, DEFAULT_BUCKET_SECONDS)
+    assert checkpoint[:2] == (analysis_id, len(data))
+
+
+def test_changed_prefix_is_analyzed_from_the_start(workspace, tmp_path, capsys):
+    connection, case_id = workspace['connection'], workspace['case_id']
+    _, data, cut = growing_capture(tmp_path)
+    path = os.path.join('outputs', 'grow.pcap')
+    with open(path, 'wb') as f:
+        f.write(data[:cut])
+    analyze_pcap_files(['grow.pcap'], connection, case_id, incremental=True)
+
+    # Rewritten rather than appended to: the checkpoint no longer applies
+    other_path = tmp_path / 'other.pcap'
+    generate_pcap(other_path, 'benign', 1 << 20, seed=5)
+    with open(path, 'wb') as f:
+        f.write(other_path.read_bytes())
+    capsys.readouterr()
+    analyze_pcap_files(['grow.pcap'], connection, case_id)
+    assert "analyzing it from the start" in capsys.readouterr().out
+    rows = analysis_rows(connection, 'grow.pcap')
+    assert len(rows) == 2
+    assert rows[1][1] == analyze_single_pass(str(other_path))['total_packets']
+
+
+def test_no_checkpoint_without_incremental(workspace, tmp_path):
+    connection, case_id, case_name = workspace['connection'], workspace['case_id'], workspace['case_name']
+    generate_pcap(os.path.join('outputs', 'static.pcap'), 'benign', 1 << 18, seed=6)
+    analyze_pcap_files(['static.pcap'], connection, case_id)
+    assert len(analysis_rows(connection, 'static.pcap')) == 1
+    assert get_analysis_checkpoint(connection, case_name, 'static.pcap', ANALYZER_VERSION,
+                                   DEFAULT_BUCKET_SECONDS) is None
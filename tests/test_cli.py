@@ -0,0 +1,109 @@
+import json
+import os
+
+import pytest
+
+from conftest import CASE_NAME, ethernet, ipv4, tcp, write_pcap
+from ntfs_bench import generate_pcap
+from ntfs_cli import main
+from ntfs_hash import calculate_file_hashes
+
+
+def run(capsys, *argv):
+    # (exit status, JSON document on stdout, messages on stderr)
+    capsys.readouterr()
+    status = main(list(argv))
+    out, err = capsys.readouterr()
+    return status, json.loads(out), err
+
+
+@pytest.fixture
+def imported(workspace, tmp_path, capsys):
+    # A capture imported into the case through the CLI
+    pcap_path = str(tmp_path / 'flood.pcap')
+    generate_pcap(pcap_path, 'syn_flood', 1 << 19, seed=13)
+    status, result, _ = run(capsys, 'import', '--case', CASE_NAME, pcap_path)
+    assert status == 0
+    [record] = result['imported']
+    return dict(workspace, pcap_path=pcap_path, pcap_filename=os.path.basename(record['file']), record=record)
+
+
+def test_register_and_list(workspace, capsys):
+    status, result, _ = run(capsys, 'register', 'OTHER', '--org', 'org', '--investigator', 'someone')
+    assert status == 0
+    assert set(result['case']) == {'id', 'name', 'organization', 'investigator', 'date'}
+    status, result, _ = run(capsys, 'list')
+    assert status == 0
+    assert sorted(case['name'] for case in result['cases']) == ['OTHER', CASE_NAME]
+
+
+def test_import_reports_the_hashes(imported):
+    record = imported['record']
+    hashes = calculate_file_hashes(imported['pcap_path'])
+    assert (record['md5'], record['sha256']) == (hashes['md5'], hashes['sha256'])
+    assert record['file'] == os.path.join('outputs', imported['pcap_filename'])
+
+
+def test_analyze_and_list_the_case(imported, capsys):
+    status, result, messages = run(capsys, 'analyze', '--case', CASE_NAME, imported['pcap_filename'])
+    assert status == 0 and result['failed'] == []
+    [analysis] = result['analyses']
+    assert analysis['pcap_file'] == imported['pcap_filename'] and not analysis['cached']
+    assert analysis['total_packets'] > 0 and analysis['half_open_count'] > 0
+    assert {verdict['rule'] for verdict in analysis['verdicts']} == {'syn_flood'}
+    assert all("\033[" not in message for message in analysis['alerts'])
+    # The tool's usual messages go to stderr, stdout only has the JSON
+    assert messages
+
+    status, result, _ = run(capsys, 'analyze', '--case', CASE_NAME, imported['pcap_filename'])
+    assert status == 0 and result['analyses'][0]['cached']
+
+    status, result, _ = run(capsys, 'list', '--case', CASE_NAME)
+    assert status == 0
+    assert [pcap_file['file'] for pcap_file in result['pcap_files']] == [imported['record']['file']]
+    [analysis] = result['analyses']
+    assert analysis['pcap_file_name'] == imported['pcap_filename']
+    assert [verdict['rule'] for verdict in analysis['verdicts']] == ['syn_flood']
+
+
+def test_packets_page(workspace, capsys):
+    frames = [ethernet(0x0800, ipv4(6, tcp(40000 + i, 80, 0x02))) for i in range(30)]
+    write_pcap(os.path.join('outputs', 'page.pcap'), frames)
+    status, result, _ = run(capsys, 'packets', '--case', CASE_NAME, 'page.pcap', '--offset', '10', '--limit', '3')
+    assert status == 0
+    assert (result['matched'], result['offset']) == (30, 10)
+    assert [packet['number'] for packet in result['packets']] == [11, 12, 13]
+    assert result['packets'][0]['sport'] == 40010 and result['packets'][0]['tcp_flags'] == 0x02
+
+
+def test_quiet_prints_only_the_result(imported, capsys):
+    status, result, messages = run(capsys, '-q', 'analyze', '--case', CASE_NAME, imported['pcap_filename'])
+    assert status == 0 and len(result['analyses']) == 1
+    assert messages == ""
+
+
+@pytest.mark.parametrize('argv, error', [
+    (['list', '--case', 'NOPE'], "Case not found: NOPE"),
+    (['register', CASE_NAME, '--org', 'org', '--investigator', 'someone'], f"Case name already exists: {CASE_NAME}"),
+    (['packets', '--case', CASE_NAME, 'missing.pcap'], "File does not exist: missing.pcap"),
+    (['analyze', '--case', CASE_NAME, '--all'], "No pcap files to analyze."),
+    (['query', '--case', CASE_NAME, '--group-by', 'src'],
+     "No column stores for this case, analyze its files with --columns first."),
+])
+def test_errors_are_json(workspace, capsys, argv, error):
+    status, result, _ = run(capsys, *argv)
+    assert status == 1
+    assert result == {'error': error}
+
+
+def test_invalid_filter_is_an_error(imported, capsys):
+    status, result, _ = run(capsys, 'packets', '--case', CASE_NAME, imported['pcap_filename'], '--start', 'soon')
+    assert (status, result) == (1, {'error': "Invalid time: soon"})
+    status, result, _ = run(capsys, 'packets', '--case', CASE_NAME, imported['pcap_filename'], '--limit', '-1')
+    assert (status, result) == (1, {'error': "--offset and --limit cannot be negative."})
+
+
+def test_failed_files_fail_the_command(workspace, tmp_path, capsys):
+    status, result, _ = run(capsys, 'import', '--case', CASE_NAME, str(tmp_path / 'missing.pcap'))
+    assert status == 1
+    assert result == {'imported': [], 'failed': [str(tmp_path / 'missing.pcap')]}
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from ntfs_analysis import analyze_pcap_files
+from ntfs_bench import generate_pcap
+from ntfs_columns import column_store_path, query_case_columns
+from ntfs_data import get_case_column_stores, insert_pcap_file
+from ntfs_engine import analyze_single_pass
+from ntfs_hash import calculate_file_hashes
+from ntfs_rotation import EXPIRED_STATUS, expire_segment, new_capture_job, new_capture_manager
+from ntfs_store import STORE_EXTENSION, store_pcap_files
+
+
+@pytest.fixture
+def analyzed_capture(workspace):
+    # A capture of the case analyzed with --columns
+    pcap_file_path = os.path.join('outputs', 'columns.pcap')
+    generate_pcap(pcap_file_path, 'udp_flood', 1 << 19, seed=10)
+    insert_pcap_file(workspace['connection'], workspace['case_name'], pcap_file_path, 'imported',
+                     calculate_file_hashes(pcap_file_path))
+    analyze_pcap_files(['columns.pcap'], workspace['connection'], workspace['case_id'], columns=True)
+    return dict(workspace, pcap_file_path=pcap_file_path,
+                packets=analyze_single_pass(pcap_file_path)['total_packets'])
+
+
+def case_query(workspace):
+    stores = get_case_column_stores(workspace['connection'], workspace['case_name'])
+    return [store[0] for store in stores], query_case_columns(stores, 'proto')
+
+
+def test_query_covers_analyzed_capture(analyzed_capture):
+    names, result = case_query(analyzed_capture)
+    assert names == ['columns.pcap']
+    assert result['files'] == ['columns.pcap'] and result['stale'] == []
+    assert result['packets'] == analyzed_capture['packets']
+
+
+def test_stored_capture_keeps_its_column_store(analyzed_capture):
+    pytest.importorskip('zstandard')
+    stored, failed = store_pcap_files(analyzed_capture['connection'], analyzed_capture['case_id'], ['columns.pcap'])
+    assert failed == [] and len(stored) == 1
+    stored_name = 'columns.pcap' + STORE_EXTENSION
+
+    assert not os.path.exists(column_store_path(analyzed_capture['pcap_file_path']))
+    assert os.path.isdir(column_store_path(os.path.join('outputs', stored_name)))
+    names, result = case_query(analyzed_capture)
+    assert names == [stored_name]
+    assert result['files'] == [stored_name] and result['stale'] == []
+    assert result['packets'] == analyzed_capture['packets']
+
+
+def test_expired_segment_drops_its_column_store(analyzed_capture):
+    connection, pcap_file_path = analyzed_capture['connection'], analyzed_capture['pcap_file_path']
+    manager = new_capture_manager(connection, analyzed_capture['case_name'], 'org', ring_files=1)
+    job = new_capture_job()
+    retained = {'path': pcap_file_path, 'bytes': os.path.getsize(pcap_file_path), 'job': job}
+    job['ring'].append(retained)
+    manager['retained'].append(retained)
+    expire_segment(manager, retained)
+    manager['writer'].shutdown()
+
+    assert not os.path.exists(pcap_file_path)
+    assert not os.path.exists(column_store_path(pcap_file_path))
+    assert get_case_column_stores(connection, analyzed_capture['case_name']) == []
+    status = connection.execute("SELECT Status FROM pcap_file WHERE FilePath=?", (pcap_file_path,)).fetchone()
+    assert status == (EXPIRED_STATUS,)
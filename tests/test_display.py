@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from conftest import ethernet, ipv4, tcp, udp, write_pcap
+from ntfs_analysis import handle_command
+from ntfs_index import packet_index_path
+
+START = 1700000000.0
+CLIENT = 0x0A000001
+SERVER = 0xC0000201
+
+
+@pytest.fixture
+def capture(workspace):
+    # 100 packets, every third one TCP to port 80 and the rest UDP to port 53
+    frames = [ethernet(0x0800, ipv4(6, tcp(40000 + i, 80, 0x10), src=CLIENT, dst=SERVER)) if i % 3 == 0
+              else ethernet(0x0800, ipv4(17, udp(50000 + i, 53), src=SERVER, dst=CLIENT))
+              for i in range(100)]
+    write_pcap(os.path.join('outputs', 'display.pcap'), frames, START, 1.0)
+    return workspace
+
+
+def display(workspace, capsys, arguments):
+    capsys.readouterr()
+    handle_command(f"ntfs -d display.pcap {arguments}", workspace['connection'], workspace['case_id'])
+    return capsys.readouterr().out.splitlines()
+
+
+def packet_numbers(lines):
+    return [int(line.split()[0]) for line in lines[:-1]]
+
+
+def test_first_page_of_matching_packets(capture, capsys):
+    lines = display(capture, capsys, "--port 80 --limit 5")
+    assert packet_numbers(lines) == [1, 4, 7, 10, 13]
+    assert "10.0.0.1.40000 > 192.0.2.1.80: tcp [.]" in lines[0]
+    assert lines[-1] == "Packets 1-5 of 34 matching, next page with --offset 5"
+    assert os.path.isfile(packet_index_path(os.path.join('outputs', 'display.pcap')))
+
+
+def test_next_pages_follow_on(capture, capsys):
+    assert packet_numbers(display(capture, capsys, "--port 80 --limit 5 --offset 5")) == [16, 19, 22, 25, 28]
+    lines = display(capture, capsys, "--port 80 --limit 5 --offset 30")
+    assert packet_numbers(lines) == [91, 94, 97, 100]
+    assert lines[-1] == "Packets 31-34 of 34 matching"
+
+
+def test_filters_combine(capture, capsys):
+    lines = display(capture, capsys, f"--src 192.0.2.1 --proto udp --start {START + 10} --end {START + 20}")
+    assert packet_numbers(lines) == [11, 12, 14, 15, 17, 18, 20]
+    assert lines[-1] == "Packets 1-7 of 7 matching"
+
+
+def test_nothing_to_show(capture, capsys):
+    assert display(capture, capsys, "--port 443") == ["No packets match."]
+    assert display(capture, capsys, "--port 80 --offset 40") == ["No packets after the first 40 of 34 matching."]
+    assert display(capture, capsys, "--start yesterday") == ["Invalid time: yesterday"]
+
+
+def test_missing_file(workspace, capsys):
+    handle_command("ntfs -d missing.pcap", workspace['connection'], workspace['case_id'])
+    assert capsys.readouterr().out.splitlines() == ["File does not exist"]
@@ -0,0 +1,128 @@
+import struct
+
+import numpy as np
+
+from conftest import ethernet, ipv4, ipv6, tcp, udp, write_pcap
+from ntfs_bench import generate_pcap
+from ntfs_engine import COUNTER_NAMES, analyze_single_pass
+from ntfs_series import finish_series, new_series, series_update
+
+
+def reference_counters(frames):
+    # Counters of the tcpdump filters the analysis stands for, decoded one
+    # frame at a time with struct
+    counts = dict.fromkeys(COUNTER_NAMES, 0)
+    for frame in frames:
+        counts['total_packets'] += 1
+        ethertype, = struct.unpack_from('>H', frame, 12)
+        if ethertype == 0x8100:
+            # `tcp`/`udp` without `vlan` do not match tagged frames
+            continue
+        net = frame[14:]
+        proto = None
+        ports = None
+        flags = None
+        if ethertype == 0x0800 and len(net) >= 20:
+            ihl = (net[0] & 0x0F) * 4
+            proto = net[9]
+            first = struct.unpack_from('>H', net, 6)[0] & 0x1FFF == 0
+            transport = net[ihl:]
+            if first and proto in (6, 17) and len(transport) >= 4:
+                ports = struct.unpack_from('>HH', transport)
+            if first and proto == 6 and len(transport) >= 14:
+                flags = transport[13]
+        elif ethertype == 0x86DD and len(net) >= 40:
+            proto = net[6]
+            if proto in (6, 17) and len(net) >= 44:
+                ports = struct.unpack_from('>HH', net, 40)
+        counts['tcp_count'] += proto == 6
+        counts['udp_count'] += proto == 17
+        counts['http_count'] += proto == 6 and ports is not None and 80 in ports
+        if flags is not None:
+            counts['syn_count'] += flags & 0x02 != 0
+            counts['syn_ack_count'] += flags & 0x12 == 0x12
+            counts['ack_count'] += flags & 0x10 != 0
+            counts['syn_without_ack_count'] += flags & 0x12 == 0x02
+    return counts
+
+
+def read_frames(path):
+    frames = []
+    with open(path, 'rb') as f:
+        f.read(24)
+        while True:
+            header = f.read(16)
+            if len(header) < 16:
+                return frames
+            frames.append(f.read(struct.unpack('<IIII', header)[2]))
+
+
+def edge_case_frames():
+    frames = []
+    for flags in (0x02, 0x12, 0x10, 0x18, 0x11, 0x04, 0x00):
+        frames.append(ethernet(0x0800, ipv4(6, tcp(40000, 80, flags))))
+        frames.append(ethernet(0x0800, ipv4(6, tcp(443, 50000, flags))))
+    frames.append(ethernet(0x0800, ipv4(6, tcp(80, 40000, 0x12), options=b'\x01' * 4)))
+    frames.append(ethernet(0x0800, ipv4(17, udp(5353, 53, b'x' * 20))))
+    frames.append(ethernet(0x0800, ipv4(17, udp(80, 80))))
+    frames.append(ethernet(0x0800, ipv4(1, b'\x08\x00' + b'\x00' * 6)))
+    # Later fragment: still `tcp`, but has neither ports nor flags
+    frames.append(ethernet(0x0800, ipv4(6, tcp(40000, 80, 0x02), fragment=100)))
+    # Cut after the ports, before the flags
+    frames.append(ethernet(0x0800, ipv4(6, tcp(40000, 80, 0x02)))[:14 + 20 + 8])
+    frames.append(ethernet(0x86DD, ipv6(6, tcp(40000, 80, 0x02))))
+    frames.append(ethernet(0x86DD, ipv6(17, udp(40000, 53))))
+    frames.append(ethernet(0x0800, ipv4(6, tcp(40000, 80, 0x02)), vlan=10))
+    frames.append(ethernet(0x0806, b'\x00' * 28))
+    return frames
+
+
+def engine_counters(path, workers=1):
+    analysis_details = analyze_single_pass(str(path), workers=workers)
+    return {key: analysis_details[key] for key in COUNTER_NAMES}
+
+
+def test_counters_match_reference_decode(tmp_path):
+    frames = edge_case_frames()
+    path = write_pcap(tmp_path / 'edge.pcap', frames)
+    assert engine_counters(path) == reference_counters(frames)
+
+
+def test_counters_of_synthetic_capture(tmp_path):
+    path = tmp_path / 'flood.pcap'
+    packets = generate_pcap(path, 'http_flood', 1 << 20, seed=1)
+    expected = reference_counters(read_frames(path))
+    assert expected['total_packets'] == packets
+    assert engine_counters(path) == expected
+    # Split over several processes, the counters add up the same
+    assert engine_counters(path, workers=3) == expected
+
+
+def test_series_adds_up_to_counters(tmp_path):
+    path = tmp_path / 'syn.pcap'
+    generate_pcap(path, 'syn_flood', 1 << 19, seed=2)
+    analysis_details = analyze_single_pass(str(path))
+    series = analysis_details['series']
+    # Each bucket holds (packets, bytes) per counter
+    totals = {name: int(series[name][:, 0].sum()) for name in COUNTER_NAMES}
+    assert totals == {key: analysis_details[key] for key in COUNTER_NAMES}
+
+
+def test_series_chunks_merge_once():
+    # Chunks overlapping in time and out of order add up like one chunk
+    ts = np.array([5.5, 3.2, 5.1, 900.0, 3.9, 4.0, 5.0, 900.5])
+    wirelen = np.arange(1, 9, dtype=np.uint32)
+    masks = {'total_packets': np.ones(8, dtype=bool), 'udp_count': ts > 4.5}
+    chunked = {'series': new_series(masks), 'series_chunks': []}
+    for start in range(0, 8, 3):
+        series_update(chunked, 1, ts[start:start + 3], wirelen[start:start + 3],
+                      {name: mask[start:start + 3] for name, mask in masks.items()})
+    whole = {'series': new_series(masks), 'series_chunks': []}
+    series_update(whole, 1, ts, wirelen, masks)
+
+    assert len(chunked['series_chunks']) == 3 and len(chunked['series']) == 0
+    series = finish_series(chunked)
+    assert chunked['series_chunks'] == []
+    assert series.tobytes() == finish_series(whole).tobytes()
+    assert series['bucket'].tolist() == [3, 4, 5, 900]
+    assert series['total_packets'].tolist() == [[2, 7], [1, 6], [3, 11], [2, 12]]
@@ -0,0 +1,89 @@
+import numpy as np
+
+from ntfs_flows import (
+    INITIAL_FLOW_CAPACITY, TCP_ACK, TCP_RST, TCP_SYN, flow_results, flow_update, half_open_rows, merge_flow_tables,
+    new_flow_table,
+)
+from ntfs_reader import IPV4_MAPPED_PREFIX, PACKET_DTYPE
+
+START = 1700000000.0
+VICTIM = 0xC000020A          # 192.0.2.10
+CLIENT = 0x0A000000
+
+
+def tcp_columns(packets):
+    # Reader columns of TCP packets given as (ts, src, sport, dst, dport, flags)
+    columns = np.zeros(len(packets), dtype=PACKET_DTYPE)
+    for i, (ts, src, sport, dst, dport, flags) in enumerate(packets):
+        columns[i]['src'] = IPV4_MAPPED_PREFIX + src.to_bytes(4, 'big')
+        columns[i]['dst'] = IPV4_MAPPED_PREFIX + dst.to_bytes(4, 'big')
+        columns[i]['ts'], columns[i]['sport'], columns[i]['dport'], columns[i]['tcp_flags'] = ts, sport, dport, flags
+    columns['ip_version'] = 4
+    columns['proto'] = 6
+    columns['has_ports'] = columns['has_flags'] = True
+    columns['wirelen'] = 60
+    return columns
+
+
+def handshake(i, ts, steps=('syn', 'syn_ack', 'ack')):
+    client, sport = CLIENT + i, 1024 + i % 60000
+    packets = {
+        'syn': (ts, client, sport, VICTIM, 80, TCP_SYN),
+        'syn_ack': (ts + 0.001, VICTIM, 80, client, sport, TCP_SYN | TCP_ACK),
+        'ack': (ts + 0.002, client, sport, VICTIM, 80, TCP_ACK),
+        'rst': (ts + 0.003, client, sport, VICTIM, 80, TCP_RST),
+    }
+    return [packets[step] for step in steps]
+
+
+def feed(table, packets, chunk=1000):
+    columns = tcp_columns(packets)
+    for start in range(0, len(columns), chunk):
+        flow_update(table, columns[start:start + chunk])
+    return flow_results(table)
+
+
+def test_handshake_outcomes_and_half_open_counts():
+    packets = [packet for i in range(30) for packet in handshake(i, START + i)]
+    packets += [packet for i in range(30, 50) for packet in handshake(i, START + i, ('syn', 'syn_ack'))]
+    packets += [packet for i in range(50, 60) for packet in handshake(i, START + i, ('syn', 'syn_ack', 'rst'))]
+    results = feed(new_flow_table(), packets, chunk=7)
+    assert {name: results[name] for name in ('flows', 'handshakes', 'established', 'half_open', 'reset')} == \
+        {'flows': 60, 'handshakes': 60, 'established': 30, 'half_open': 30, 'reset': 10}
+
+    rows = half_open_rows(results, 5)
+    assert rows[0] == ('192.0.2.10', 'target', 30, 60)
+    sources = [row for row in rows if row[1] == 'source']
+    assert len(sources) == 5 and all(row[2:] == (1, 1) for row in sources)
+
+
+def test_table_grows_with_the_flows():
+    table = new_flow_table()
+    assert table['capacity'] == INITIAL_FLOW_CAPACITY
+    count = 4 * INITIAL_FLOW_CAPACITY
+    results = feed(table, [packet for i in range(count) for packet in handshake(i, START + i * 0.001)])
+    assert table['capacity'] >= 2 * count
+    assert table['live'] == count and results['evicted'] == 0
+    assert results['flows'] == results['established'] == count
+
+
+def test_full_table_evicts_the_oldest_flows():
+    table = new_flow_table(max_capacity=1024)
+    count = 3000
+    results = feed(table, [packet for i in range(count) for packet in handshake(i, START + i * 0.001, ('syn',))])
+    assert table['capacity'] == 1024 and table['live'] <= 512
+    assert results['evicted'] > 0
+    # Evicted flows are finished, not lost
+    assert results['flows'] == results['half_open'] == count
+    # The flows still live are the latest ones
+    assert table['last_ts'][table['used']].min() > START + (count - table['live'] - 1) * 0.001
+
+
+def test_handshake_completes_across_merged_tables():
+    first, second = new_flow_table(), new_flow_table()
+    packets = [packet for i in range(20) for packet in handshake(i, START + i)]
+    feed(first, [packet for packet in packets if packet[5] != TCP_ACK])
+    feed(second, [packet for packet in packets if packet[5] == TCP_ACK])
+    results = flow_results(merge_flow_tables(first, second))
+    assert results['flows'] == results['established'] == 20
+    assert results['half_open'] == 0
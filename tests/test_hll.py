@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from ntfs_hll import (
+    DISTINCT_BUCKET_SECONDS, distinct_summary, hll_add, hll_estimate, merge_distinct_states, new_distinct_state,
+    distinct_update, _hash_words,
+)
+
+START = 1700000040.0
+VICTIM = 0xC000020A
+
+
+def ipv4_addresses(values):
+    # Raw 16-byte IPv4-mapped addresses, like the reader's src and dst columns
+    raw = np.zeros((len(values), 16), dtype=np.uint8)
+    raw[:, 10:12] = 0xFF
+    raw[:, 12:] = np.asarray(values, dtype='>u4').view(np.uint8).reshape(-1, 4)
+    return raw.view('V16').ravel()
+
+
+def update(state, sources, ts=START):
+    sources = np.asarray(sources, dtype=np.int64)
+    dst = ipv4_addresses(np.full(len(sources), VICTIM))
+    distinct_update(state, np.full(len(sources), ts), ipv4_addresses(sources), dst, dst[:1])
+
+
+def relative_error(estimate, expected):
+    return abs(estimate - expected) / expected
+
+
+@pytest.mark.parametrize('count', [10, 1000, 50000, 300000])
+def test_estimate_accuracy(count):
+    # Standard error of 2**14 registers is 0.8%, allow about four of them
+    registers = np.zeros(1 << 14, dtype=np.uint8)
+    hll_add(registers, _hash_words(np.zeros(count, dtype=np.uint64), np.arange(count, dtype=np.uint64)))
+    assert relative_error(int(hll_estimate(registers)), count) < 0.035
+
+
+def test_summary_counts_sources_and_networks():
+    state = new_distinct_state()
+    # 20000 sources over 200 /24 networks, each sent from more than once
+    sources = 0x0B000000 + np.arange(200).repeat(100) * 256 + np.tile(np.arange(100), 200)
+    update(state, np.concatenate([sources, sources[::7]]))
+    summary = distinct_summary(state)
+    assert relative_error(summary['sources'], 20000) < 0.035
+    assert relative_error(summary['networks'], 200) < 0.035
+    [(destination, sources, networks)] = summary['destinations']
+    assert destination == '192.0.2.10'
+    assert relative_error(sources, 20000) < 0.07 and relative_error(networks, 200) < 0.07
+
+
+def test_merge_equals_counting_together():
+    together, first, second = new_distinct_state(), new_distinct_state(), new_distinct_state()
+    parts = [(np.arange(0, 30000), START), (np.arange(20000, 60000), START + DISTINCT_BUCKET_SECONDS)]
+    for (sources, ts), state in zip(parts, (first, second)):
+        update(state, sources + 0x0B000000, ts)
+        update(together, sources + 0x0B000000, ts)
+    merged = merge_distinct_states(first, second)
+    for name in ('sources', 'networks', 'buckets', 'bucket_sources', 'destination_sources'):
+        assert merged[name].tobytes() == together[name].tobytes()
+    summary = distinct_summary(merged)
+    # The overlap is counted once
+    assert relative_error(summary['sources'], 60000) < 0.035
+    peak_start, peak_sources, _ = summary['peak']
+    assert peak_start == (START + DISTINCT_BUCKET_SECONDS) // DISTINCT_BUCKET_SECONDS * DISTINCT_BUCKET_SECONDS
+    assert relative_error(peak_sources, 40000) < 0.15
+
+
+def test_merge_keeps_only_given_destinations():
+    first, second = new_distinct_state(), new_distinct_state()
+    update(first, np.arange(100))
+    merged = merge_distinct_states(first, second, destinations=[])
+    assert distinct_summary(merged)['destinations'] == []
+    assert distinct_summary(merged)['sources'] == distinct_summary(first)['sources']
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pytest
+
+import ntfs_index
+from conftest import ethernet, ipv4, ipv6, tcp, udp, write_pcap
+from ntfs_index import (
+    filter_packet_index, index_update, load_packet_index, merge_packet_indexes, new_packet_index, open_packet_index,
+    packet_index_path, query_packet_index, read_indexed_columns, save_packet_index,
+)
+from ntfs_reader import iter_packet_columns
+
+START = 1700000000.0
+STEP = 0.5
+HOSTS = [0x0A000001, 0x0A000002, 0xC0000201]
+HOST_NAMES = ['10.0.0.1', '10.0.0.2', '192.0.2.1']
+
+
+def sample_packets():
+    # (frame, attributes) of TCP, UDP and ICMP packets between a few hosts,
+    # with an ARP and an IPv6 packet mixed in
+    packets = []
+    for i in range(300):
+        src, dst = i % 3, (i // 3) % 3
+        attributes = {'src': HOST_NAMES[src], 'dst': HOST_NAMES[dst]}
+        if i % 5 == 0:
+            frame = ipv4(1, b'\x08\x00' + bytes(10), src=HOSTS[src], dst=HOSTS[dst])
+            attributes.update(proto=1, ports=())
+        elif i % 2:
+            frame = ipv4(6, tcp(1024 + i % 7, 80, 0x02), src=HOSTS[src], dst=HOSTS[dst])
+            attributes.update(proto=6, ports=(1024 + i % 7, 80))
+        else:
+            frame = ipv4(17, udp(53, 53), src=HOSTS[src], dst=HOSTS[dst])
+            attributes.update(proto=17, ports=(53,))
+        packets.append((ethernet(0x0800, frame), attributes))
+    packets[10] = (ethernet(0x0806, bytes(28)), {'src': None, 'dst': None, 'proto': None, 'ports': ()})
+    packets[20] = (ethernet(0x86DD, ipv6(17, udp(5000, 53))),
+                   {'src': '2001::1', 'dst': '2001::2', 'proto': 17, 'ports': (5000, 53)})
+    return packets
+
+
+def expected(packets, src=None, dst=None, host=None, port=None, proto=None, start=None, end=None):
+    numbers = []
+    for i, (_, attributes) in enumerate(packets):
+        ts = START + i * STEP
+        if ((src is None or attributes['src'] == src) and (dst is None or attributes['dst'] == dst)
+                and (host is None or host in (attributes['src'], attributes['dst']))
+                and (port is None or port in attributes['ports'])
+                and (proto is None or attributes['proto'] == proto)
+                and (start is None or ts >= start) and (end is None or ts < end)):
+            numbers.append(i)
+    return numbers
+
+
+QUERIES = [
+    {},
+    {'src': '10.0.0.1'},
+    {'dst': '192.0.2.1', 'proto': 6},
+    {'host': '10.0.0.2'},
+    {'host': '10.0.0.2', 'port': 53},
+    {'port': 80, 'start': START + 20, 'end': START + 100},
+    {'proto': 1},
+    {'port': 53, 'host': '2001::1'},
+    {'src': '203.0.113.9'},
+    {'port': 1025, 'proto': 17},
+]
+
+
+@pytest.fixture
+def capture(tmp_path):
+    packets = sample_packets()
+    path = str(write_pcap(tmp_path / 'index.pcap', [frame for frame, _ in packets], START, STEP))
+    return path, packets
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_query_matches_every_packet(capture, query):
+    path, packets = capture
+    index = open_packet_index(path)
+    assert os.path.isfile(packet_index_path(path))
+    assert query_packet_index(index, **query).tolist() == expected(packets, **query)
+
+
+def test_compacted_and_merged_parts_answer_the_same(capture, monkeypatch):
+    path, packets = capture
+    monkeypatch.setattr(ntfs_index, 'INDEX_COMPACT_PACKETS', 40)
+    [columns] = list(iter_packet_columns(path))
+    first, second = new_packet_index(), new_packet_index()
+    for start in range(0, 200, 30):
+        index_update(first, columns[start:min(start + 30, 200)])
+    index_update(second, columns[200:])
+    save_packet_index(path, merge_packet_indexes(first, second))
+    index = load_packet_index(path)
+    for query in QUERIES:
+        assert query_packet_index(index, **query).tolist() == expected(packets, **query)
+
+
+def test_times_can_be_given_as_text(capture):
+    path, packets = capture
+    index = open_packet_index(path)
+    assert filter_packet_index(index, start=str(START + 10), end=str(START + 20)).tolist() == \
+        expected(packets, start=START + 10, end=START + 20)
+    with pytest.raises(ValueError):
+        filter_packet_index(index, start='not a time')
+
+
+def test_indexed_packets_are_read_directly(capture):
+    path, packets = capture
+    index = open_packet_index(path)
+    numbers = query_packet_index(index, port=80)[5:9]
+    columns = read_indexed_columns(path, index, numbers)
+    [everything] = list(iter_packet_columns(path))
+    assert columns.tobytes() == everything[numbers].tobytes()
+
+
+def test_changed_capture_is_indexed_again(capture):
+    path, packets = capture
+    open_packet_index(path)
+    write_pcap(path, [frame for frame, _ in packets[:50]], START, STEP)
+    assert load_packet_index(path) is None
+    assert len(open_packet_index(path)['ts']) == 50
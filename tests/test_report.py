@@ -0,0 +1,66 @@
+import os
+import re
+
+import pytest
+
+pytest.importorskip('reportlab')
+pytest.importorskip('pypdf')
+
+import ntfs_report
+from ntfs_analysis import analyze_pcap_files
+from ntfs_bench import generate_pcap
+from ntfs_data import get_case_details_by_id, get_pcap_files_for_case, insert_pcap_file
+from ntfs_hash import calculate_file_hashes
+from ntfs_report import generate_pdf_report
+
+
+@pytest.fixture
+def analyzed_case(workspace):
+    # Two analyzed captures, one of them with a detection verdict
+    connection = workspace['connection']
+    for pcap_filename, scenario in (('flood.pcap', 'syn_flood'), ('benign.pcap', 'benign')):
+        pcap_file_path = os.path.join('outputs', pcap_filename)
+        generate_pcap(pcap_file_path, scenario, 1 << 19, seed=11)
+        insert_pcap_file(connection, workspace['case_name'], pcap_file_path, 'imported',
+                         calculate_file_hashes(pcap_file_path))
+    analyze_pcap_files(['flood.pcap', 'benign.pcap'], connection, workspace['case_id'])
+    return workspace
+
+
+def build_report(workspace, capsys):
+    # (rendered, reused) sections of a new report of the case
+    connection = workspace['connection']
+    capsys.readouterr()
+    case_details = get_case_details_by_id(connection, workspace['case_id'])
+    pdf_file = generate_pdf_report(case_details, get_pcap_files_for_case(connection, case_details[0]), connection)
+    assert os.path.isfile(pdf_file)
+    rendered, reused = re.search(r"Report sections: (\d+) rendered, (\d+) reused", capsys.readouterr().out).groups()
+    return int(rendered), int(reused)
+
+
+def test_unchanged_sections_are_reused(analyzed_case, capsys):
+    # Static text, case details and one section per analysis
+    assert build_report(analyzed_case, capsys) == (4, 0)
+    assert build_report(analyzed_case, capsys) == (0, 4)
+
+
+def test_changed_verdicts_render_their_section_again(analyzed_case, capsys):
+    connection = analyzed_case['connection']
+    build_report(analyzed_case, capsys)
+    with connection:
+        assert connection.execute("DELETE FROM pcap_analysis_verdict").rowcount > 0
+    assert build_report(analyzed_case, capsys) == (1, 3)
+
+
+def test_new_analysis_renders_its_section(analyzed_case, capsys):
+    build_report(analyzed_case, capsys)
+    pcap_file_path = os.path.join('outputs', 'other.pcap')
+    generate_pcap(pcap_file_path, 'udp_flood', 1 << 18, seed=12)
+    analyze_pcap_files(['other.pcap'], analyzed_case['connection'], analyzed_case['case_id'])
+    assert build_report(analyzed_case, capsys) == (1, 4)
+
+
+def test_template_version_renders_everything(analyzed_case, capsys, monkeypatch):
+    build_report(analyzed_case, capsys)
+    monkeypatch.setattr(ntfs_report, 'REPORT_TEMPLATE_VERSION', ntfs_report.REPORT_TEMPLATE_VERSION + '-next')
+    assert build_report(analyzed_case, capsys) == (4, 0)
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import random
+import struct
+import sys
+
+import pytest
+
+from conftest import pcap_header, pcap_record
+from ntfs_bench import generate_pcap
+from ntfs_pcap import PCAP_GLOBAL_HEADER_LEN, PCAP_RECORD_HEADER_LEN
+from ntfs_rotation import EXPIRED_STATUS, SIZE_UNIT, new_capture_job, new_record_splitter, run_capture_jobs, \
+    split_records
+from ntfs_store import read_seek_table, read_store_range, store_content_size
+
+# Stands in for `tcpdump -U -w -`: writes the capture named by the
+# environment to stdout in small, unaligned chunks
+STUB_TCPDUMP = f"""#!{sys.executable}
+import os, sys
+data = open(os.environ['NTFS_STUB_PCAP'], 'rb').read()
+for i in range(0, len(data), 10007):
+    sys.stdout.buffer.write(data[i:i + 10007])
+    sys.stdout.buffer.flush()
+"""
+PCAP_HEADER = pcap_header()
+
+
+def record(frame):
+    return pcap_record(1700000000.0, frame)
+
+
+@pytest.fixture
+def capture(workspace, tmp_path, monkeypatch):
+    # A capture of a few MB played back by a stub tcpdump found first on PATH
+    pcap_path = tmp_path / 'capture.pcap'
+    generate_pcap(pcap_path, 'benign', 5 * SIZE_UNIT // 2, seed=7)
+    bin_path = tmp_path / 'bin'
+    bin_path.mkdir()
+    stub = bin_path / 'tcpdump'
+    stub.write_text(STUB_TCPDUMP)
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('NTFS_STUB_PCAP', str(pcap_path))
+    return dict(workspace, data=pcap_path.read_bytes())
+
+
+def segment_content(path):
+    frames = read_seek_table(path)
+    if frames is None:
+        with open(path, 'rb') as f:
+            return f.read()
+    return read_store_range(path, 0, store_content_size(frames), frames)
+
+
+def first_record_len(content):
+    return PCAP_RECORD_HEADER_LEN + struct.unpack_from('<I', content, PCAP_GLOBAL_HEADER_LEN + 8)[0]
+
+
+def file_statuses(connection, case_name):
+    return dict(connection.execute("SELECT FilePath, Status FROM pcap_file WHERE CaseName=?", (case_name,)))
+
+
+def test_split_records_across_reads():
+    records = [record(bytes([i]) * i) for i in range(60)]
+    data = PCAP_HEADER + b''.join(records)
+
+    rng = random.Random(8)
+    for _ in range(20):
+        splitter = new_record_splitter()
+        split = []
+        pos = 0
+        while pos < len(data):
+            size = rng.randint(1, 100)
+            split += split_records(splitter, data[pos:pos + size])
+            pos += size
+        assert splitter['header'] == PCAP_HEADER
+        assert split == records
+        assert not splitter['pending']
+
+
+def test_header_and_records_in_one_read():
+    splitter = new_record_splitter()
+    first = record(b'abcd')
+    assert split_records(splitter, PCAP_HEADER + first + first[:10]) == [first]
+    assert splitter['header'] == PCAP_HEADER
+    assert split_records(splitter, first[10:]) == [first]
+
+
+def test_size_rotation(capture):
+    connection, case_id, data = capture['connection'], capture['case_id'], capture['data']
+    registered = run_capture_jobs(connection, case_id, [new_capture_job()], megabytes=1)
+
+    assert len(registered) > 1
+    contents = [segment_content(path) for path, _ in registered]
+    # Every segment is a pcap of its own, cut between records, and only
+    # closed once the next record would not fit in it
+    for content, (path, file_hashes) in zip(contents, registered):
+        assert content[:PCAP_GLOBAL_HEADER_LEN] == data[:PCAP_GLOBAL_HEADER_LEN]
+        assert len(content) <= SIZE_UNIT
+        with open(path, 'rb') as f:
+            assert file_hashes['sha256'] == hashlib.sha256(f.read()).hexdigest()
+    for content, following in zip(contents, contents[1:]):
+        assert len(content) + first_record_len(following) > SIZE_UNIT
+    assert data[:PCAP_GLOBAL_HEADER_LEN] + b''.join(content[PCAP_GLOBAL_HEADER_LEN:] for content in contents) == data
+    assert set(file_statuses(connection, capture['case_name']).values()) == {'collected'}
+
+
+def test_ring_expires_oldest_segments(capture):
+    connection, case_id, data = capture['connection'], capture['case_id'], capture['data']
+    jobs = [new_capture_job('eth0'), new_capture_job('eth1')]
+    registered = run_capture_jobs(connection, case_id, jobs, megabytes=1, ring_files=2)
+
+    statuses = file_statuses(connection, capture['case_name'])
+    expired = [path for path, _ in registered if statuses[path] == EXPIRED_STATUS]
+    assert len(registered) > 4
+    assert len(expired) == len(registered) - 4
+    for path, _ in registered:
+        assert os.path.exists(path) == (path not in expired)
+    for job in jobs:
+        assert len(job['ring']) == 2
+        tail = b''.join(segment_content(retained['path'])[PCAP_GLOBAL_HEADER_LEN:] for retained in job['ring'])
+        assert data.endswith(tail)
+
+
+def test_compressed_segments(capture):
+    connection, case_id, data = capture['connection'], capture['case_id'], capture['data']
+    registered = run_capture_jobs(connection, case_id, [new_capture_job()], megabytes=1, compress=True)
+
+    contents = []
+    for path, file_hashes in registered:
+        assert read_seek_table(path) is not None
+        content = segment_content(path)
+        # Hashed as written, before compression
+        assert file_hashes['sha256'] == hashlib.sha256(content).hexdigest()
+        contents.append(content[PCAP_GLOBAL_HEADER_LEN:])
+    assert data[:PCAP_GLOBAL_HEADER_LEN] + b''.join(contents) == data
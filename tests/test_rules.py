@@ -0,0 +1,127 @@
+import pytest
+
+from conftest import ethernet, ipv4, tcp, udp, write_timed_pcap
+from ntfs_engine import analyze_single_pass
+from ntfs_rules import DETECTORS
+
+START = 1700000000.0
+VICTIM = 0xC000020A          # 192.0.2.10
+RESOLVER = 0x08080808
+CLIENT = 0x0A000001
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+TCP_SYN_ACK = 0x12
+
+
+def spread(frames, seconds, start=START):
+    # (timestamp, frame) of `frames` evenly over `seconds`
+    return [(start + i * seconds / len(frames), frame) for i, frame in enumerate(frames)]
+
+
+def syn(source, sport, dst=VICTIM):
+    return ethernet(0x0800, ipv4(6, tcp(sport, 80, TCP_SYN), src=source, dst=dst))
+
+
+def syn_ack(source, sport, dst=VICTIM):
+    return ethernet(0x0800, ipv4(6, tcp(80, sport, TCP_SYN_ACK), src=dst, dst=source))
+
+
+def udp_packet(source, sport, dport, payload_len, dst=VICTIM):
+    return ethernet(0x0800, ipv4(17, udp(sport, dport, bytes(payload_len)), src=source, dst=dst))
+
+
+def icmp_echo(source):
+    return ethernet(0x0800, ipv4(1, b'\x08\x00' + bytes(30), src=source, dst=VICTIM))
+
+
+def fragment(offset, payload_len, more):
+    # Offset in 8-byte units, with More Fragments set on all but the last
+    return ethernet(0x0800, ipv4(17, bytes(payload_len), src=CLIENT, dst=VICTIM,
+                                 fragment=offset | (0x2000 if more else 0)))
+
+
+def slow_connection(i, seconds):
+    # Handshake, then one keep-alive byte `seconds` later
+    client, sport = CLIENT + i, 40000 + i
+    start = START + i
+    return [
+        (start, ethernet(0x0800, ipv4(6, tcp(sport, 80, TCP_SYN), src=client, dst=VICTIM))),
+        (start + 0.01, ethernet(0x0800, ipv4(6, tcp(80, sport, TCP_SYN_ACK), src=VICTIM, dst=client))),
+        (start + 0.02, ethernet(0x0800, ipv4(6, tcp(sport, 80, TCP_ACK), src=client, dst=VICTIM))),
+        (start + seconds, ethernet(0x0800, ipv4(6, tcp(sport, 80, TCP_ACK, b'x'), src=client, dst=VICTIM))),
+    ]
+
+
+def verdict_rules(tmp_path, packets):
+    path = write_timed_pcap(tmp_path / 'rules.pcap', sorted(packets, key=lambda packet: packet[0]))
+    return {verdict['rule'] for verdict in analyze_single_pass(str(path))['verdicts']}
+
+
+def syn_flood(answered):
+    packets = spread([syn(0x0B000000 + i, 1024 + i) for i in range(300)], 10)
+    if answered:
+        packets += [(ts + 0.001, syn_ack(0x0B000000 + i, 1024 + i)) for i, (ts, _) in enumerate(packets)]
+    return packets
+
+
+def amplification(port, request_len):
+    # 1.2 MB of responses toward the victim, with or without its own requests
+    packets = spread([udp_packet(RESOLVER, port, 40000, 1200) for _ in range(1000)], 5)
+    if request_len:
+        packets += spread([udp_packet(VICTIM, 40000, port, request_len, dst=RESOLVER) for _ in range(1000)], 5)
+    return packets
+
+
+CASES = {
+    'syn_flood': (lambda: syn_flood(answered=False), [
+        lambda: syn_flood(answered=True),
+        lambda: spread([syn(0x0B000000 + i, 1024 + i) for i in range(100)], 10),
+    ]),
+    # A short burst is rated over the time it took, not the whole window
+    'udp_flood': (lambda: spread([udp_packet(CLIENT + i, 1024 + i, 9, 100) for i in range(8192)], 0.055), [
+        lambda: spread([udp_packet(CLIENT + i, 1024 + i, 9, 100) for i in range(8192)], 100),
+        lambda: (spread([udp_packet(CLIENT + i, 1024 + i, 9, 100) for i in range(2000)], 0.5)
+                 + spread([ethernet(0x0800, ipv4(6, tcp(40000, 443, TCP_ACK)))] * 3000, 0.5)),
+    ]),
+    'icmp_flood': (lambda: spread([icmp_echo(CLIENT + i) for i in range(500)], 1), [
+        lambda: spread([icmp_echo(CLIENT + i) for i in range(500)], 50),
+    ]),
+    'fragment_overlap': (lambda: spread([fragment(0, 24, True), fragment(1, 24, False)], 0.01), [
+        lambda: spread([fragment(0, 16, True), fragment(2, 16, False)], 0.01),
+        lambda: spread([fragment(0, 16, True), fragment(0, 16, True), fragment(2, 16, False)], 0.01),
+    ]),
+    'dns_amplification': (lambda: amplification(53, 0), [
+        lambda: amplification(53, 200),
+    ]),
+    'ntp_amplification': (lambda: amplification(123, 0), [
+        lambda: amplification(123, 200),
+    ]),
+    'slow_http': (lambda: [packet for i in range(12) for packet in slow_connection(i, 40)], [
+        lambda: [packet for i in range(12) for packet in slow_connection(i, 10)],
+        lambda: [packet for i in range(5) for packet in slow_connection(i, 40)],
+    ]),
+}
+
+
+def test_every_detector_has_cases():
+    assert {rule['name'] for rule in DETECTORS} == set(CASES)
+
+
+@pytest.mark.parametrize('rule', sorted(CASES))
+def test_detector_flags_attack(tmp_path, rule):
+    positive, _ = CASES[rule]
+    assert verdict_rules(tmp_path, positive()) == {rule}
+
+
+@pytest.mark.parametrize('rule, case', [(rule, i) for rule in sorted(CASES) for i in range(len(CASES[rule][1]))])
+def test_detector_ignores_lookalike(tmp_path, rule, case):
+    assert verdict_rules(tmp_path, CASES[rule][1][case]()) == set()
+
+
+def test_burst_rate_uses_covered_seconds(tmp_path):
+    packets = spread([udp_packet(CLIENT + i, 1024 + i, 9, 100) for i in range(8192)], 0.055)
+    [verdict] = analyze_single_pass(str(write_timed_pcap(tmp_path / 'burst.pcap', packets)))['verdicts']
+    # All in one 1-second bucket: rated over that second
+    assert verdict['evidence']['peak_rate'] == 8192
+    assert verdict['target'] == '192.0.2.10'
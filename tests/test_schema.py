@@ -0,0 +1,103 @@
+import sqlite3
+
+from ntfs_data import SCHEMA_VERSION, create_connection, create_tables, get_analysis_talkers, \
+    get_pcap_files_for_case, get_registration_id_by_name
+
+# The tables as the first release created them, at user_version 0
+VERSION_0_SQL = """
+CREATE TABLE IF NOT EXISTS registration (
+    id INTEGER PRIMARY KEY,
+    CaseName TEXT NOT NULL,
+    OrganizationName TEXT NOT NULL,
+    InvestigatorsName TEXT NOT NULL,
+    Date DATE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pcap_file (
+    id INTEGER PRIMARY KEY,
+    CaseName TEXT NOT NULL,
+    FilePath TEXT NOT NULL,
+    Date DATE NOT NULL,
+    Status TEXT NOT NULL DEFAULT 'collected',
+    FOREIGN KEY (CaseName) REFERENCES registration(CaseName)
+);
+CREATE TABLE IF NOT EXISTS pcap_analysis (
+    id INTEGER PRIMARY KEY,
+    CaseName TEXT NOT NULL,
+    org_name TEXT NOT NULL,
+    pcap_file_name TEXT NOT NULL,
+    total_packets INTEGER,
+    top_ips TEXT,
+    tcp_count INTEGER,
+    udp_count INTEGER,
+    http_count INTEGER,
+    syn_count INTEGER,
+    syn_ack_count INTEGER,
+    ack_count INTEGER,
+    syn_without_ack_count INTEGER,
+    syn_ack_ratio REAL,
+    syn_ack_message TEXT,
+    proportionality_message TEXT,
+    file_hash TEXT,
+    analysis_date DATE NOT NULL,
+    FOREIGN KEY (CaseName) REFERENCES registration(CaseName)
+);
+"""
+
+
+def schema(connection):
+    # Columns of every table and every index, whatever order they were added in
+    tables = {}
+    for name, kind in connection.execute("SELECT name, type FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"):
+        if kind == 'table':
+            tables[name] = connection.execute(f"PRAGMA table_info({name})").fetchall()
+        elif kind == 'index':
+            tables[name] = connection.execute(f"PRAGMA index_info({name})").fetchall()
+    return tables
+
+
+def version_0_database(path):
+    connection = sqlite3.connect(path)
+    connection.executescript(VERSION_0_SQL)
+    with connection:
+        connection.execute("INSERT INTO registration VALUES (1, 'OLD', 'org', 'investigator', '2023-05-01')")
+        connection.execute("INSERT INTO pcap_file VALUES (1, 'OLD', 'outputs/org-OLD-1.pcap', '2023-05-01', "
+                           "'imported')")
+        # top_ips as tcpdump printed them, addresses with their ports
+        connection.execute("""INSERT INTO pcap_analysis (id, CaseName, org_name, pcap_file_name, total_packets, top_ips,
+                                                         tcp_count, analysis_date)
+                              VALUES (1, 'OLD', 'org', 'org-OLD-1.pcap', 100,
+                                      "[('10.0.0.1.443', 40), ('10.0.0.1.80', 20), ('192.0.2.7', 30)]", 90,
+                                      '2023-05-01')""")
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == 0
+    connection.close()
+
+
+def test_version_0_database_is_migrated(tmp_path):
+    version_0_database(tmp_path / 'old.db')
+    connection = create_connection(str(tmp_path / 'old.db'))
+    create_tables(connection)
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+
+    fresh = create_connection(str(tmp_path / 'fresh.db'))
+    create_tables(fresh)
+    assert schema(connection) == schema(fresh)
+
+    # The evidence recorded before the migration is still there
+    assert get_registration_id_by_name(connection, 'OLD') == 1
+    assert get_pcap_files_for_case(connection, 'OLD') == [('outputs/org-OLD-1.pcap', '2023-05-01', 'imported')]
+    assert connection.execute("SELECT total_packets, tcp_count FROM pcap_analysis WHERE id=1").fetchone() == (100, 90)
+    talkers = {row[0]: row[2] for row in get_analysis_talkers(connection, 1)}
+    assert talkers == {'10.0.0.1': 60, '192.0.2.7': 30}
+    connection.close()
+    fresh.close()
+
+
+def test_current_database_is_left_alone(tmp_path, capsys):
+    connection = create_connection(str(tmp_path / 'ntfs.db'))
+    create_tables(connection)
+    capsys.readouterr()
+    before = schema(connection)
+    create_tables(connection)
+    assert capsys.readouterr().out == ""
+    assert schema(connection) == before
+    connection.close()
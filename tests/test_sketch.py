@@ -0,0 +1,68 @@
+import numpy as np
+
+from ntfs_sketch import merge_topk_sketches, new_topk_sketch, topk_error_bound, topk_items, topk_update
+
+CAPACITY = 64
+
+
+def skewed_keys(seed, n=20000, distinct=5000):
+    # A few heavy keys over a long tail of rare ones
+    rng = np.random.default_rng(seed)
+    return np.minimum(rng.zipf(1.3, n), distinct).astype(np.int64)
+
+
+def true_counts(*parts):
+    keys, counts = np.unique(np.concatenate(parts), return_counts=True)
+    return dict(zip(keys.tolist(), counts.tolist()))
+
+
+def sketch_of(keys, chunk=1000):
+    sketch = new_topk_sketch(np.int64, CAPACITY)
+    for start in range(0, len(keys), chunk):
+        topk_update(sketch, keys[start:start + chunk])
+    return sketch
+
+
+def assert_bounds(sketch, counts):
+    tracked = set()
+    for key, count, error in topk_items(sketch, CAPACITY):
+        tracked.add(int(key))
+        assert count - error <= counts.get(int(key), 0) <= count
+    # A key left out was counted at most the smallest tracked count times
+    floor = int(sketch['counts'].min())
+    assert all(count <= floor for key, count in counts.items() if key not in tracked)
+    assert max(error for _, _, error in topk_items(sketch, CAPACITY)) <= topk_error_bound(sketch)
+
+
+def test_chunked_updates_keep_bounds():
+    keys = skewed_keys(1)
+    sketch = sketch_of(keys)
+    assert len(sketch['keys']) == CAPACITY
+    assert sketch['total'] == len(keys)
+    assert_bounds(sketch, true_counts(keys))
+
+
+def test_merge_keeps_bounds():
+    first, second = skewed_keys(2), skewed_keys(3)
+    merged = merge_topk_sketches(sketch_of(first), sketch_of(second))
+    assert merged['total'] == len(first) + len(second)
+    counts = true_counts(first, second)
+    assert_bounds(merged, counts)
+    # The heaviest keys are found, in order
+    heaviest = sorted(counts, key=lambda key: -counts[key])[:3]
+    assert [int(key) for key, _, _ in topk_items(merged, 3)] == heaviest
+
+
+def test_merge_of_exact_sketches_is_exact():
+    # Sketches that never filled up count exactly, and so does their merge
+    first, second = np.arange(10).repeat(3), np.arange(5, 20)
+    merged = merge_topk_sketches(sketch_of(first), sketch_of(second))
+    assert {int(key): (count, error) for key, count, error in topk_items(merged, CAPACITY)} == \
+        {key: (count, 0) for key, count in true_counts(first, second).items()}
+
+
+def test_merge_does_not_depend_on_order():
+    first, second = sketch_of(skewed_keys(4)), sketch_of(skewed_keys(5))
+    one, other = merge_topk_sketches(first, second), merge_topk_sketches(second, first)
+    for name in ('keys', 'counts', 'errors'):
+        assert one[name].tolist() == other[name].tolist()
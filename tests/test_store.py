@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from ntfs_analysis import analyze_pcap_files
+from ntfs_bench import generate_pcap
+from ntfs_capture import import_pcap_file
+from ntfs_data import get_analysis_checkpoint, get_pcap_file_hashes_for_case
+from ntfs_engine import ANALYZER_VERSION, COUNTER_NAMES, analyze_single_pass
+from ntfs_series import DEFAULT_BUCKET_SECONDS
+from ntfs_store import STORE_EXTENSION, calculate_evidence_hashes, is_store_pcap
+
+pytest.importorskip('zstandard')
+
+
+@pytest.fixture
+def stored_capture(workspace, tmp_path):
+    # A capture imported into the compressed evidence store
+    pcap_path = tmp_path / 'evidence.pcap'
+    generate_pcap(pcap_path, 'http_flood', 1 << 20, seed=9)
+    import_pcap_file(str(pcap_path), workspace['connection'], workspace['case_id'], compress=True)
+    [pcap_filename] = os.listdir('outputs')
+    return dict(workspace, pcap_path=pcap_path, pcap_filename=pcap_filename)
+
+
+def stored_counters(connection, pcap_filename):
+    cursor = connection.execute(f"SELECT {', '.join(COUNTER_NAMES)} FROM pcap_analysis WHERE pcap_file_name=?",
+                                (pcap_filename,))
+    return [dict(zip(COUNTER_NAMES, row)) for row in cursor.fetchall()]
+
+
+def test_import_keeps_the_original_hashes(stored_capture):
+    connection, pcap_filename = stored_capture['connection'], stored_capture['pcap_filename']
+    path = os.path.join('outputs', pcap_filename)
+    assert pcap_filename.endswith('.pcap' + STORE_EXTENSION)
+    assert is_store_pcap(path)
+
+    [(file_path, _, md5, sha256)] = get_pcap_file_hashes_for_case(connection, stored_capture['case_name'])
+    assert file_path == path
+    original = calculate_evidence_hashes(str(stored_capture['pcap_path']))
+    assert (md5, sha256) == (original['md5'], original['sha256'])
+    assert calculate_evidence_hashes(path) == original
+
+
+def test_stored_capture_has_no_checkpoint(stored_capture):
+    # Offsets in the store are not positions in the file on disk
+    path = os.path.join('outputs', stored_capture['pcap_filename'])
+    analysis_details = analyze_single_pass(path, checkpoint=True)
+    assert 'checkpoint' not in analysis_details
+    assert analysis_details['total_packets'] == analyze_single_pass(str(stored_capture['pcap_path']))['total_packets']
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_stored_capture_is_analyzed(stored_capture, capsys, incremental):
+    connection, pcap_filename = stored_capture['connection'], stored_capture['pcap_filename']
+    capsys.readouterr()
+    analyze_pcap_files([pcap_filename], connection, stored_capture['case_id'], workers=2, incremental=incremental)
+    output = capsys.readouterr().out
+    assert "An error occurred" not in output and "Error inserting" not in output
+    assert "Details of 1 file(s) stored in the database." in output
+
+    # Same counters as the capture before it was compressed
+    plain = analyze_single_pass(str(stored_capture['pcap_path']))
+    assert stored_counters(connection, pcap_filename) == [{key: plain[key] for key in COUNTER_NAMES}]
+    # Never resumed, see test_stored_capture_has_no_checkpoint
+    assert get_analysis_checkpoint(connection, stored_capture['case_name'], pcap_filename, ANALYZER_VERSION,
+                                   DEFAULT_BUCKET_SECONDS) is None
+
+    # Analyzed again, the stored analysis is reused
+    analyze_pcap_files([pcap_filename], connection, stored_capture['case_id'])
+    assert "Cache hit" in capsys.readouterr().out
+    assert len(stored_counters(connection, pcap_filename)) == 1